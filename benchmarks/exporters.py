@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""Compare the built-in ScriptExporter with nbconvert's PythonExporter
+
+For each example notebook, this reports the cold time (a fresh interpreter
+importing the exporter and converting the notebook once) and the warm time
+(the mean of repeated conversions in an interpreter which has already
+imported everything).
+
+Usage: python benchmarks/exporters.py [NOTEBOOK ...]
+"""
+
+import pathlib
+import subprocess
+import sys
+import textwrap
+import timeit
+
+import nbformat
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+EXPORTERS = {
+    "native": (
+        "from xcengine.core import ScriptExporter",
+        "ScriptExporter()",
+    ),
+    "nbconvert": (
+        "from nbconvert import PythonExporter",
+        "PythonExporter()",
+    ),
+}
+
+
+def cold_time(exporter: str, notebook: pathlib.Path) -> float:
+    import_statement, constructor = EXPORTERS[exporter]
+    code = textwrap.dedent(f"""
+        import time
+        start = time.perf_counter()
+        import nbformat
+        {import_statement}
+        notebook = nbformat.read({str(notebook)!r}, as_version=4)
+        {constructor}.from_notebook_node(notebook)
+        print(time.perf_counter() - start)
+        """)
+    process = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=REPO_DIR,
+    )
+    return float(process.stdout)
+
+
+def warm_time(exporter: str, notebook: pathlib.Path, number: int) -> float:
+    import_statement, constructor = EXPORTERS[exporter]
+    namespace = {}
+    exec(import_statement, namespace)
+    namespace["notebook"] = nbformat.read(notebook, as_version=4)
+    # Warm up any lazily initialised state (e.g. nbconvert's templates).
+    eval(f"{constructor}.from_notebook_node(notebook)", namespace)
+    return (
+        timeit.timeit(
+            f"{constructor}.from_notebook_node(notebook)",
+            globals=namespace,
+            number=number,
+        )
+        / number
+    )
+
+
+def main():
+    sys.path.insert(0, str(REPO_DIR))
+    notebooks = [pathlib.Path(p) for p in sys.argv[1:]] or sorted(
+        (REPO_DIR / "examples").glob("*.ipynb")
+    )
+    print(f"{'notebook':<20}{'exporter':<12}{'cold (s)':>10}{'warm (ms)':>12}")
+    for notebook in notebooks:
+        for exporter in EXPORTERS:
+            cold = min(cold_time(exporter, notebook) for _ in range(3))
+            warm = warm_time(exporter, notebook, number=20) * 1000
+            print(
+                f"{notebook.name:<20}{exporter:<12}{cold:>10.3f}{warm:>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
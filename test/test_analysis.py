@@ -0,0 +1,71 @@
+import pytest
+
+from xcengine import analysis
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "cube",
+        "cube.time",
+        "cube['v'][0]",
+        "cube1.isel(time=0).v.plot.imshow()",
+        'cube.time.diff(dim="time").plot.line()',
+        "cube.v.plot()\nplt.show()",
+        "IPython.display.display(cube)",
+        "display(cube)",
+    ],
+)
+def test_is_display_only_true(source):
+    assert analysis.is_display_only(source)
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "",
+        "# Just a comment",
+        "cube = open_cube()",
+        "cube = open_cube()\ncube",
+        "cube.to_zarr('out.zarr')",
+        "import IPython.display",
+        "print(cube)",
+        "x = = 1",
+        'plt.savefig("out.png")',
+        'plt.savefig("out.png"); plt.close()',
+        'cube.v.plot().figure.savefig("out.png")',
+        "(n := len(items))",
+        "print(n := len(items))",
+        "plt.figure(figsize=(8, 6))",
+    ],
+)
+def test_is_display_only_false(source):
+    assert not analysis.is_display_only(source)
+
+
+def test_is_display_only_without_plots():
+    assert analysis.is_display_only("display(cube)\nplt.show()", plots=False)
+    assert not analysis.is_display_only("cube.v.plot()", plots=False)
+
+
+def test_saves_figures():
+    assert analysis.saves_figures('cube.v.plot()\nplt.savefig("out.png")')
+    assert analysis.saves_figures('fig.savefig("out.png")')
+    assert not analysis.saves_figures("cube.v.plot()\nplt.show()")
+    assert not analysis.saves_figures("x = = 1")
+
+
+def test_is_display_only_ipython_syntax():
+    assert analysis.parse_cell("%time cube = open_cube()") is not None
+    assert not analysis.is_display_only("%time cube = open_cube()")
+
+
+def test_attribute_chain():
+    node = analysis.parse_cell("cube.isel(time=0).v.plot.imshow()").body[0]
+    assert analysis.attribute_chain(node.value) == [
+        "cube",
+        "isel",
+        "v",
+        "plot",
+        "imshow",
+    ]
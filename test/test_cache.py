@@ -0,0 +1,51 @@
+import logging
+import pathlib
+
+from xcengine.cache import ConversionCache
+
+
+def test_cache_key_depends_on_all_parts(tmp_path):
+    path = tmp_path / "foo.txt"
+    path.write_text("foo")
+    key = ConversionCache.key(path, "bar")
+    assert key == ConversionCache.key(path, b"bar")
+    assert key != ConversionCache.key(path, "baz")
+    assert ConversionCache.key("ab", "c") != ConversionCache.key("a", "bc")
+    path.write_text("qux")
+    assert key != ConversionCache.key(path, "bar")
+
+
+def test_cache_put_and_get(tmp_path):
+    cache = ConversionCache(tmp_path / "cache")
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    (source_dir / "a.py").write_text("a = 1")
+    (source_dir / "b.py").write_text("b = 2")
+    (source_dir / "c.py").write_text("c = 3")
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    assert not cache.get("somekey", target_dir)
+    cache.put("somekey", source_dir, ["a.py", "b.py"])
+    assert cache.get("somekey", target_dir)
+    assert sorted(p.name for p in target_dir.iterdir()) == ["a.py", "b.py"]
+    assert (target_dir / "b.py").read_text() == "b = 2"
+
+
+def test_cache_reports(tmp_path):
+    cache = ConversionCache(tmp_path / "cache")
+    assert cache.reports("somekey") == []
+    reports = [(logging.WARNING, "careful"), (logging.INFO, "note")]
+    cache.put("somekey", tmp_path, [], reports)
+    assert cache.reports("somekey") == reports
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    assert cache.get("somekey", target_dir)
+    assert list(target_dir.iterdir()) == []
+
+
+def test_cache_default_dir(monkeypatch):
+    monkeypatch.setenv("XCENGINE_CACHE_DIR", "/foo/bar")
+    assert ConversionCache().cache_dir == pathlib.Path("/foo/bar")
+    monkeypatch.delenv("XCENGINE_CACHE_DIR")
+    monkeypatch.setenv("XDG_CACHE_HOME", "/baz")
+    assert ConversionCache().cache_dir == pathlib.Path("/baz/xcengine")
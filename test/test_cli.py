@@ -0,0 +1,156 @@
+import re
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from xcengine.cli import cli, make_container_script_args
+
+# Generous enough for slow CI machines, but far below the time taken to
+# import the Docker SDK, nbformat and nbconvert.
+IMPORT_TIME_BUDGET_MS = 250
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, check=True
+    )
+
+
+def test_cli_import_is_lazy():
+    process = run_python(
+        "-c",
+        "import sys, xcengine.cli; "
+        "print(' '.join(m for m in ('docker', 'nbconvert', 'nbformat', "
+        "'xarray', 'IPython', 'yaml', 'xcengine.core') "
+        "if m in sys.modules))",
+    )
+    assert process.stdout.strip() == ""
+
+
+def test_core_import_is_lazy():
+    process = run_python(
+        "-c",
+        "import sys, xcengine.core; "
+        "print(' '.join(m for m in ('docker', 'nbconvert', 'nbformat', "
+        "'xarray', 'IPython') if m in sys.modules))",
+    )
+    assert process.stdout.strip() == ""
+
+
+def test_core_import_leaves_logging_unconfigured():
+    process = run_python(
+        "-c",
+        "import logging, xcengine.core; print(logging.getLogger().handlers)",
+    )
+    assert process.stdout.strip() == "[]"
+
+
+def test_cli_import_time():
+    # Take the best of several runs to reduce noise from the machine load.
+    times = []
+    for _ in range(3):
+        process = run_python("-X", "importtime", "-c", "import xcengine.cli")
+        match = re.search(
+            r"^import time:\s+\d+ \|\s+(\d+) \| xcengine\.cli$",
+            process.stderr,
+            re.MULTILINE,
+        )
+        times.append(int(match.group(1)) / 1000)
+    assert min(times) < IMPORT_TIME_BUDGET_MS
+
+
+def test_cli_help():
+    result = CliRunner().invoke(cli, ["--help"])
+    assert result.exit_code == 0
+    for command in "make-script", "image", "eoap":
+        assert command in result.output
+
+
+def test_lint(tmp_path):
+    import nbformat
+
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_markdown_cell("# Title"),
+                nbformat.v4.new_code_cell("x = 1\nvalues = cube.v.values"),
+            ]
+        ),
+        notebook,
+    )
+    result = CliRunner().invoke(cli, ["lint", str(notebook)])
+    assert result.exit_code == 1
+    assert f"{notebook}: cell 1, line 2: XCE001" in result.output
+
+
+def test_make_script_directory_with_one_notebook(tmp_path):
+    import nbformat
+
+    (tmp_path / "notebooks").mkdir()
+    nbformat.write(
+        nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell("x = 1")]),
+        tmp_path / "notebooks" / "single.ipynb",
+    )
+    for spec in "notebooks", "notebooks/*.ipynb":
+        output = tmp_path / "out" / spec.replace("*", "all")
+        result = CliRunner().invoke(
+            cli,
+            ["make-script", "--no-cache", str(tmp_path / spec), str(output)],
+        )
+        assert result.exit_code == 0, result.output
+        assert (output / "single" / "user_code.py").is_file()
+        assert not (output / "user_code.py").exists()
+    result = CliRunner().invoke(
+        cli,
+        ["eoap", str(tmp_path / "notebooks")],
+    )
+    assert result.exit_code == 2
+    assert "--output-dir is required" in result.output
+
+
+def test_make_script_execute_parameters(tmp_path):
+    import nbformat
+
+    parameters_cell = nbformat.v4.new_code_cell("size = int('3')")
+    parameters_cell.metadata["tags"] = ["parameters"]
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(nbformat.v4.new_notebook(cells=[parameters_cell]), notebook)
+    args = ["make-script", "--no-cache", str(notebook), str(tmp_path / "out")]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 1
+    assert "line 1: size = int('3')" in str(result.exception)
+    assert not (tmp_path / "out" / "user_code.py").exists()
+    result = CliRunner().invoke(cli, args + ["--execute-parameters"])
+    assert result.exit_code == 0, result.output
+    assert "size" in (tmp_path / "out" / "parameters.yaml").read_text()
+
+
+def test_make_container_script_args(tmp_path):
+    encoding = tmp_path / "encoding.yaml"
+    output = tmp_path / "output"
+    output.mkdir()
+    args, files = make_container_script_args(
+        output,
+        only=("cube",),
+        output_encoding=encoding,
+        chunk_size="16MiB",
+        resume=True,
+    )
+    assert args == [
+        "--only",
+        "cube",
+        "--output-encoding",
+        "/home/mambauser/output-encoding.yaml",
+        "--chunk-size",
+        "16MiB",
+        "--resume",
+    ]
+    assert files.keys() == {"output", "output-encoding.yaml"}
+    assert files["output"].path == output
+    assert files["output-encoding.yaml"] == encoding
+    assert make_container_script_args(output, True, resume=True)[1] == {
+        "output": output
+    }
+    assert make_container_script_args(output) == ([], {})
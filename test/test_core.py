@@ -1,12 +1,18 @@
+import json
+import logging
 import pathlib
 import pytest
 from unittest.mock import Mock
 
 import docker.models.images
+import nbformat
+import yaml
 
 import xcengine.core
 import xcengine.parameters
 
+EXAMPLES_DIR = pathlib.Path(__file__).parent.parent / "examples"
+
 
 def test_init_runner_invalid_image_type():
     with pytest.raises(ValueError, match='Invalid type "int"'):
@@ -35,3 +41,489 @@ def test_init_runner_with_image():
         image := Mock(docker.models.images.Image), pathlib.Path("/foo")
     )
     assert runner.image == image
+
+
+def test_run_copies_script_files(tmp_path):
+    import io
+    import tarfile
+
+    (tmp_path / "encoding.yaml").write_text("cube: {}\n")
+    client_mock = Mock(docker.client.DockerClient)
+    container = client_mock.containers.create.return_value
+    container.status = "exited"
+    archives = []
+    container.put_archive.side_effect = lambda path, data: archives.append(
+        (path, data.read())
+    )
+    runner = xcengine.core.ContainerRunner(
+        Mock(
+            docker.models.images.Image,
+            tags=[],
+            attrs={"Config": {"Cmd": ["python", "execute.pyc"]}},
+        ),
+        None,
+        client=client_mock,
+    )
+    runner.run(
+        True,
+        False,
+        False,
+        False,
+        ["--output-encoding", "/home/mambauser/output-encoding.yaml"],
+        {"output-encoding.yaml": tmp_path / "encoding.yaml"},
+    )
+    assert client_mock.containers.create.call_args.kwargs["command"] == [
+        "python",
+        "execute.pyc",
+        "--batch",
+        "--output-encoding",
+        "/home/mambauser/output-encoding.yaml",
+    ]
+    [(path, archive)] = archives
+    assert path == "/home/mambauser"
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar_fh:
+        assert tar_fh.getnames() == ["output-encoding.yaml"]
+        member = tar_fh.extractfile("output-encoding.yaml")
+        assert member.read() == b"cube: {}\n"
+    container.start.assert_called_once()
+    container.remove.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "config, expected",
+    [
+        ({"Cmd": ["/bin/sh", "-c", "python execute.pyc"]}, "execute.pyc"),
+        ({"Cmd": ["/bin/sh", "-c", "python execute.py"]}, "execute.py"),
+        ({"Cmd": None}, "execute.py"),
+        (None, "execute.py"),
+    ],
+)
+def test_script_name(config, expected):
+    runner = xcengine.core.ContainerRunner(
+        Mock(docker.models.images.Image, attrs={"Config": config}), None
+    )
+    assert runner.script_name() == expected
+
+
+def test_run_publishes_ports():
+    client_mock = Mock(docker.client.DockerClient)
+    client_mock.containers.create.return_value.status = "exited"
+    runner = xcengine.core.ContainerRunner(
+        Mock(docker.models.images.Image, tags=[], attrs={}),
+        None,
+        client=client_mock,
+    )
+    runner.run(False, False, False, False, ports={8787: 8788})
+    assert client_mock.containers.create.call_args.kwargs["ports"] == {
+        "8080": 8080,
+        "8787": 8788,
+    }
+
+
+def test_convert_notebook_to_script_uses_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XCENGINE_CACHE_DIR", str(tmp_path / "cache"))
+    notebook = EXAMPLES_DIR / "dynamic.ipynb"
+    xcengine.core.ScriptCreator(notebook).convert_notebook_to_script(
+        tmp_path / "first"
+    )
+    script_creator = xcengine.core.ScriptCreator(notebook)
+    script_creator.write_script_files = Mock()
+    script_creator.convert_notebook_to_script(tmp_path / "second")
+    script_creator.write_script_files.assert_not_called()
+    assert script_creator._notebook is None
+    for filename in "user_code.py", "execute.py", "parameters.yaml":
+        assert (tmp_path / "first" / filename).read_text() == (
+            tmp_path / "second" / filename
+        ).read_text()
+    assert (tmp_path / "second" / "user_code.pyc").is_file()
+
+
+def test_cached_conversion_repeats_reports(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv("XCENGINE_CACHE_DIR", str(tmp_path / "cache"))
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell("!ls"),
+                nbformat.v4.new_code_cell("x = 1"),
+                nbformat.v4.new_code_cell("x"),
+            ]
+        ),
+        notebook,
+    )
+    messages = []
+    for output in "first", "second":
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            xcengine.core.ScriptCreator(notebook).convert_notebook_to_script(
+                tmp_path / output
+            )
+        messages.append(
+            [
+                (r.levelno, r.getMessage())
+                for r in caplog.records
+                if r.name == "xcengine.core"
+            ]
+        )
+    assert (
+        logging.WARNING,
+        "Unsupported IPython syntax in cell 0 will probably fail when the "
+        "script is run: !ls",
+    ) in messages[0]
+    assert (logging.INFO, "Omitting display-only cell 2: x") in messages[0]
+    assert messages[1] == messages[0]
+    assert "Reused cached conversion" in caplog.text
+
+
+def test_cache_key_depends_on_conversion_sources(tmp_path, monkeypatch):
+    sources = []
+    for path in xcengine.core.CONVERSION_SOURCES:
+        sources.append(tmp_path / path.name)
+        sources[-1].write_bytes(path.read_bytes())
+    monkeypatch.setattr(xcengine.core, "CONVERSION_SOURCES", tuple(sources))
+    script_creator = xcengine.core.ScriptCreator(
+        EXAMPLES_DIR / "dynamic.ipynb"
+    )
+    key = script_creator.cache_key()
+    assert script_creator.cache_key() == key
+    for source in sources:
+        source.write_text(source.read_text() + "\n# edited\n")
+        assert script_creator.cache_key() != key
+        key = script_creator.cache_key()
+
+
+def test_update_script(tmp_path):
+    notebook = EXAMPLES_DIR / "dynamic.ipynb"
+    script_creator = xcengine.core.ScriptCreator(notebook)
+    script_creator.convert_notebook_to_script(tmp_path, use_cache=False)
+    (tmp_path / "user_code.py").write_text("outdated")
+    assert xcengine.core.ScriptCreator(notebook).update_script(
+        tmp_path, use_cache=False
+    ) == ["user_code.py"]
+    assert "new_cube" in (tmp_path / "user_code.py").read_text()
+
+
+@pytest.mark.parametrize("drop_display_cells", [False, True])
+def test_remove_display_cells(tmp_path, drop_display_cells):
+    script_creator = xcengine.core.ScriptCreator(
+        EXAMPLES_DIR / "dynamic.ipynb", drop_display_cells
+    )
+    script_creator.convert_notebook_to_script(tmp_path, use_cache=False)
+    user_code = (tmp_path / "user_code.py").read_text()
+    assert "cube2 = xcube.core.new.new_cube(" in user_code
+    assert ("plot.imshow()" in user_code) != drop_display_cells
+
+
+def test_remove_display_cells_keeps_saved_plots(tmp_path):
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell("cube.v.plot()"),
+                nbformat.v4.new_code_cell("(n := len(cube.time))"),
+                nbformat.v4.new_code_cell("display(cube)"),
+                nbformat.v4.new_code_cell('plt.savefig(f"plot{n}.png")'),
+            ]
+        ),
+        notebook,
+    )
+    script_creator = xcengine.core.ScriptCreator(notebook)
+    assert [c.source for c in script_creator.notebook.cells] == [
+        "cube.v.plot()",
+        "(n := len(cube.time))",
+        'plt.savefig(f"plot{n}.png")',
+    ]
+
+
+def test_remove_display_cells_original_indices(tmp_path, caplog):
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell(
+                    "x = 1", metadata={"tags": ["parameters"]}
+                ),
+                nbformat.v4.new_code_cell("cube = make_cube(x)"),
+                nbformat.v4.new_code_cell("cube.v.plot()"),
+            ]
+        ),
+        notebook,
+    )
+    script_creator = xcengine.core.ScriptCreator(notebook)
+    with caplog.at_level(logging.INFO):
+        _ = script_creator.notebook
+    assert "Omitting display-only cell 2: cube.v.plot()" in caplog.text
+
+
+def test_unsupported_magics_original_indices(tmp_path):
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell(
+                    "x = 1", metadata={"tags": ["parameters"]}
+                ),
+                nbformat.v4.new_code_cell("!ls"),
+            ]
+        ),
+        notebook,
+    )
+    script_creator = xcengine.core.ScriptCreator(notebook)
+    _ = script_creator.notebook
+    assert script_creator.magics.unsupported == [(1, "!ls")]
+
+
+def test_notebook_dependencies(tmp_path):
+    notebook = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell("!pip install foo\nimport foo"),
+                nbformat.v4.new_code_cell("%conda install xarray bar"),
+            ]
+        ),
+        notebook,
+    )
+    build_dir = tmp_path / "build"
+    xcengine.core.ScriptCreator(notebook).convert_notebook_to_script(
+        build_dir, use_cache=False
+    )
+    (build_dir / "environment.yml").write_text(
+        "dependencies:\n- python\n- xarray=2024.1\n"
+    )
+    image_builder = xcengine.core.ImageBuilder(
+        notebook, None, None, build_dir, None
+    )
+    image_builder.add_notebook_dependencies()
+    assert yaml.safe_load((build_dir / "environment.yml").read_text()) == {
+        "dependencies": [
+            "python",
+            "xarray=2024.1",
+            "bar",
+            {"pip": ["foo"]},
+            "pip",
+        ]
+    }
+
+
+@pytest.mark.parametrize("notebook", ["dynamic.ipynb", "cci.ipynb"])
+def test_script_exporter_matches_nbconvert(notebook):
+    import nbconvert
+
+    nb = nbformat.read(EXAMPLES_DIR / notebook, as_version=4)
+    expected, _ = nbconvert.PythonExporter().from_notebook_node(nb)
+    actual, _ = xcengine.core.ScriptExporter().from_notebook_node(nb)
+    assert actual.rstrip() == expected.rstrip()
+
+
+def test_script_exporter_transforms_ipython_syntax():
+    nb = nbformat.v4.new_notebook(
+        cells=[
+            nbformat.v4.new_code_cell("x = 100 % 7\ny = x != 2"),
+            nbformat.v4.new_code_cell("files = !ls\n%cd /tmp"),
+        ]
+    )
+    exporter = xcengine.core.ScriptExporter()
+    script, _ = exporter.from_notebook_node(nb)
+    assert "x = 100 % 7\ny = x != 2\n" in script
+    assert "files = get_ipython().getoutput('ls')\n" in script
+    assert "get_ipython().run_line_magic('cd', '/tmp')" in script
+
+
+def test_read_notebook(tmp_path):
+    notebook = nbformat.v4.new_notebook(
+        cells=[
+            nbformat.v4.new_markdown_cell(
+                "![plot](attachment:plot.png)",
+                attachments={"plot.png": {"image/png": "A" * 10000}},
+            ),
+            nbformat.v4.new_code_cell(
+                "x = 1\ny = 2\nx + y",
+                outputs=[
+                    nbformat.v4.new_output(
+                        "display_data", data={"image/png": "A" * 10000}
+                    ),
+                    nbformat.v4.new_output(
+                        "stream", text='"]}\\"\\\\"outputs": ['
+                    ),
+                ],
+            ),
+            nbformat.v4.new_code_cell('d = {"outputs": ["]}"]}'),
+        ]
+    )
+    path = tmp_path / "notebook.ipynb"
+    nbformat.write(notebook, path)
+    # nbformat writes multi-line sources as lists of lines.
+    assert isinstance(json.loads(path.read_text())["cells"][1]["source"], list)
+    result = xcengine.core.read_notebook(path)
+    assert [c.source for c in result.cells] == [
+        c.source for c in notebook.cells
+    ]
+    assert "attachments" not in result.cells[0]
+    assert result.cells[1].outputs == []
+    assert result.cells[1].metadata == {}
+    assert result.metadata == notebook.metadata
+
+
+def test_read_notebook_examples():
+    for path in EXAMPLES_DIR.glob("*.ipynb"):
+        expected = nbformat.read(path, as_version=4)
+        actual = xcengine.core.read_notebook(path)
+        assert [(c.cell_type, c.source, c.metadata) for c in actual.cells] == [
+            (c.cell_type, c.source, c.metadata) for c in expected.cells
+        ]
+
+
+def test_find_notebooks(tmp_path):
+    for name in "a.ipynb", "b.ipynb", "c.txt", "sub/d.ipynb":
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).touch()
+    find = xcengine.core.find_notebooks
+    assert find(tmp_path / "a.ipynb") == [tmp_path / "a.ipynb"]
+    assert find(tmp_path) == [tmp_path / "a.ipynb", tmp_path / "b.ipynb"]
+    assert find(tmp_path / "**" / "*.ipynb") == [
+        tmp_path / "a.ipynb",
+        tmp_path / "b.ipynb",
+        tmp_path / "sub" / "d.ipynb",
+    ]
+    assert find(tmp_path / "nonexistent*") == []
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_convert_notebooks(tmp_path, jobs):
+    broken = tmp_path / "dynamic.ipynb"
+    broken.write_text("not a notebook")
+    notebooks = [EXAMPLES_DIR / "dynamic.ipynb", broken]
+    results = xcengine.core.convert_notebooks(
+        notebooks, tmp_path / "out", jobs=jobs, use_cache=False
+    )
+    assert [r.notebook for r in results] == notebooks
+    assert [r.output.name for r in results] == ["dynamic", "dynamic_2"]
+    assert results[0].error is None
+    assert "JSONDecodeError" in results[1].error
+    assert (tmp_path / "out" / "dynamic" / "user_code.py").is_file()
+
+
+@pytest.mark.parametrize("zarr_format", [2, 3])
+def test_old_chunk_filter(tmp_path, zarr_format):
+    import io
+    import shutil
+    import tarfile
+
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    from xcengine import wrapper
+
+    def cube(start, days):
+        time = pd.date_range(start, periods=days)
+        values = time.dayofyear.to_numpy()[:, None] * np.ones((days, 2))
+        return xr.Dataset(
+            dict(v=(("time", "x"), values), mask=("x", [1, 0])),
+            coords=dict(time=time),
+        ).chunk(time=2)
+
+    output = tmp_path / "output"
+    output.mkdir()
+    cube("2024-01-01", 5).to_zarr(
+        output / "cube.zarr", zarr_format=zarr_format, consolidated=True
+    )
+    archive = io.BytesIO()
+    xcengine.core.ContainerRunner.make_archive(
+        {
+            "output": xcengine.core.ArchiveSource(
+                output, xcengine.core.old_chunk_filter(output, "time")
+            )
+        },
+        archive,
+    )
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar_fh:
+        names = tar_fh.getnames()
+        tar_fh.extractall(tmp_path / "container", filter="data")
+    # Only the last chunk along time is copied, except for the time
+    # coordinate itself.
+    assert {
+        n[len("output/cube.zarr/v/") :]
+        for n in names
+        if n.startswith("output/cube.zarr/v/")
+    } == (
+        {".zarray", ".zattrs", "2.0"}
+        if zarr_format == 2
+        else {"zarr.json", "c", "c/2", "c/2/0"}
+    )
+    assert "output/cube.zarr/time/c/0" in names or (
+        "output/cube.zarr/time/0" in names
+    )
+    # Append in the "container", then copy its output back.
+    copy = tmp_path / "container" / "output"
+    wrapper.write_datasets(
+        dict(cube=cube("2024-01-04", 4)),
+        copy,
+        chunk_bytes=None,
+        append_dim="time",
+    )
+    shutil.copytree(copy, output, dirs_exist_ok=True)
+    written = xr.open_zarr(output / "cube.zarr")
+    assert written.v.values[:, 0].tolist() == list(range(1, 8))
+    assert written.mask.values.tolist() == [1, 0]
+
+
+def test_resume_filter(tmp_path):
+    import io
+    import shutil
+    import tarfile
+
+    import dask.array
+    import xarray as xr
+
+    from xcengine import wrapper
+
+    fail_at = [3]
+
+    def check(block, block_info=None):
+        if block_info and block_info[0]["chunk-location"][0] == fail_at[0]:
+            raise RuntimeError("killed")
+        return block
+
+    data = dask.array.arange(24, chunks=4).reshape(6, 4).rechunk((1, 4))
+    datasets = dict(
+        cube=xr.Dataset(
+            dict(v=(("time", "x"), data.map_blocks(check, dtype=int)))
+        ),
+        static=xr.Dataset(dict(s=("x", dask.array.zeros(4)))),
+    )
+    options = dict(chunk_bytes=None, stream_dim="time", stream_memory=64)
+    output = tmp_path / "output"
+    with pytest.raises(RuntimeError, match="killed"):
+        wrapper.write_datasets(datasets, output, **options)
+    (output / "checkpoints").mkdir()
+    (output / "checkpoints" / "data").write_text("not needed")
+    archive = io.BytesIO()
+    xcengine.core.ContainerRunner.make_archive(
+        {
+            "output": xcengine.core.ArchiveSource(
+                output, xcengine.core.resume_filter(output)
+            )
+        },
+        archive,
+    )
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar_fh:
+        files = [m.name for m in tar_fh.getmembers() if m.isfile()]
+        tar_fh.extractall(tmp_path / "container", filter="data")
+    assert f"output/{wrapper.WriteJournal.FILENAME}" in files
+    assert all(
+        pathlib.PurePosixPath(f).name in xcengine.core.ZARR_METADATA_FILES
+        for f in files
+        if f.startswith("output/cube.zarr/")
+    )
+    assert not any(f.startswith("output/checkpoints") for f in files)
+    # Resume in the "container", then copy its output back.
+    copy = tmp_path / "container" / "output"
+    fail_at[0] = None
+    wrapper.write_datasets(datasets, copy, resume=True, **options)
+    shutil.copytree(copy, output, dirs_exist_ok=True)
+    assert (xr.open_zarr(output / "cube.zarr").v.values == data).all()
+    assert (xr.open_zarr(output / "static.zarr").s.values == 0).all()
@@ -0,0 +1,78 @@
+import pytest
+
+from xcengine.lint import Finding, lint_cells
+
+
+def codes(*sources: str) -> list[tuple[int, int, str]]:
+    return [(f.cell, f.line, f.code) for f in lint_cells(enumerate(sources))]
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("a = cube.v.values", [(0, 1, "XCE001")]),
+        ("cube.load()", [(0, 1, "XCE001")]),
+        ("x = cube['v'].compute()", [(0, 1, "XCE001")]),
+        ("x = cube.isel(time=0).v.values", []),
+        ("x = cube.v.mean().compute()", []),
+        ("x = cube.v[0, :10].values", []),
+        ("t = cube.time.values", []),
+        ("d = {}\nfor v in d.values(): pass", []),
+    ],
+)
+def test_load_whole_dataset(source, expected):
+    assert codes(source) == expected
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("for t in cube.time:\n    pass", [(0, 1, "XCE002")]),
+        ("for t in cube.time.values:\n    pass", [(0, 1, "XCE002")]),
+        ("for i in range(cube.sizes['x']):\n    pass", [(0, 1, "XCE002")]),
+        ("for i in range(len(cube.lat)):\n    pass", [(0, 1, "XCE002")]),
+        ("for i in range(10):\n    pass", []),
+        ("for name in cube.data_vars:\n    pass", []),
+    ],
+)
+def test_loop_over_dimension(source, expected):
+    assert codes(source) == expected
+
+
+def test_open_data_without_subset():
+    findings = lint_cells(
+        enumerate(
+            [
+                "a = store.open_data('a.zarr')",
+                "b = store.open_data('b', bbox=[0, 0, 1, 1])",
+                "c = store.open_data('c', bbox=bb, time_range=tr)",
+                "d = store.open_data('d', **kwargs)",
+            ]
+        )
+    )
+    assert [(f.cell, f.code) for f in findings] == [
+        (0, "XCE003"),
+        (1, "XCE003"),
+    ]
+    assert "bbox or time_range" in findings[0].message
+    assert "time_range" in findings[1].message
+
+
+def test_repeated_open():
+    assert codes(
+        "import xarray as xr\na = xr.open_zarr('a.zarr')",
+        "b = xr.open_zarr('b.zarr')\nc = xr.open_zarr('a.zarr')",
+    ) == [(1, 2, "XCE004")]
+
+
+def test_suppression_and_ipython_syntax():
+    assert codes("%time a = cube.values  # noqa\nb = cube.values") == [
+        (0, 2, "XCE001")
+    ]
+
+
+def test_finding_str():
+    assert (
+        str(Finding(2, 3, "XCE001", "message"))
+        == "cell 2, line 3: XCE001 message"
+    )
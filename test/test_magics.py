@@ -0,0 +1,69 @@
+import pytest
+
+from xcengine.magics import MagicsProcessor
+
+
+@pytest.fixture
+def processor():
+    return MagicsProcessor()
+
+
+def test_install_magics(processor):
+    source = """!pip install -q foo "bar>=1.0"
+%conda install -c conda-forge -y baz
+if True:
+    !mamba install qux
+x = 1"""
+    assert processor.process_cell(source, 0) == """\
+pass  # !pip install -q foo "bar>=1.0"
+pass  # %conda install -c conda-forge -y baz
+if True:
+    pass  # !mamba install qux
+x = 1"""
+    assert processor.pip_packages == ["foo", "bar>=1.0"]
+    assert processor.conda_packages == ["baz", "qux"]
+    assert processor.unsupported == []
+
+
+def test_install_from_requirements_unsupported(processor):
+    source = "%pip install -r requirements.txt"
+    assert processor.process_cell(source, 3) == source
+    assert processor.unsupported == [(3, source)]
+
+
+def test_timing_magics(processor):
+    assert (
+        processor.process_cell("%%timeit -n 10\nx = f()\ny = g(x)", 0)
+        == "x = f()\ny = g(x)"
+    )
+    assert processor.process_cell("%time x = f()", 0) == "x = f()"
+    assert (
+        processor.process_cell("for i in y:\n    %timeit -r 3 -q f(i)", 0)
+        == "for i in y:\n    f(i)"
+    )
+    assert processor.unsupported == []
+
+
+def test_ignored_and_display_magics(processor):
+    assert (
+        processor.process_cell("%matplotlib inline\nx = 1\nx?", 0)
+        == "pass  # %matplotlib inline\nx = 1\n"
+    )
+    assert processor.process_cell("%%html\n<b>foo</b>", 0) == ""
+    assert processor.unsupported == []
+
+
+def test_unsupported_magics(processor):
+    assert processor.process_cell("%%bash\nls", 1) == "%%bash\nls"
+    assert processor.process_cell("files = !ls\n%cd /tmp", 2) == (
+        "files = !ls\n%cd /tmp"
+    )
+    assert processor.unsupported == [
+        (1, "%%bash"),
+        (2, "files = !ls"),
+        (2, "%cd /tmp"),
+    ]
+    assert processor.process_cell("x = y % z\nx != y", 3) == (
+        "x = y % z\nx != y"
+    )
+    assert len(processor.unsupported) == 3
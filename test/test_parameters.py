@@ -153,3 +153,66 @@ def test_parameters_process_arguments(notebook_parameters):
         "some_string": "bar",
         "some_bool": True,
     }
+
+
+def test_parameters_from_code_static():
+    assert (
+        NotebookParameters.from_code("""
+import datetime
+'Parameters'
+width, height = 360, 180
+pixels = width * height
+factor: float = 2
+factor *= -1
+bbox = [-180, -90, 180, 90]
+name = label = "foo" + "bar"
+""").params
+        == {
+            "width": (int, 360),
+            "height": (int, 180),
+            "pixels": (int, 64800),
+            "factor": (float, -2.0),
+            "bbox": (list, [-180, -90, 180, 90]),
+            "name": (str, "foobar"),
+            "label": (str, "foobar"),
+        }
+    )
+
+
+def test_parameters_from_code_falls_back_to_execution():
+    parameters = NotebookParameters.from_code(
+        "import math\nradius = round(math.pi * 2, 2)\n", execute=True
+    )
+    assert parameters.params == {"radius": (float, 6.28)}
+
+
+def test_parameters_from_code_requires_execute():
+    with pytest.raises(ValueError) as excinfo:
+        NotebookParameters.from_code("""
+import math
+radius = round(math.pi * 2, 2)
+size = 3
+while True: pass
+""")
+    message = str(excinfo.value)
+    assert "line 3: radius = round(math.pi * 2, 2)" in message
+    assert "line 5: while True: pass" in message
+    assert "size" not in message
+    assert "--execute-parameters" in message
+
+
+def test_parameters_from_code_execution_timeout():
+    with pytest.raises(ValueError, match="did not finish"):
+        NotebookParameters.extract_variables(
+            "while True: pass", timeout=0.5, execute=True
+        )
+
+
+def test_parameters_from_code_execution_error():
+    with pytest.raises(ValueError, match="ZeroDivisionError"):
+        NotebookParameters.extract_variables("x = int('1') / 0", execute=True)
+
+
+def test_parameters_from_code_reserved_name():
+    with pytest.raises(ValueError, match="chunk_size, threads clash"):
+        NotebookParameters.from_code("threads = 4\nchunk_size = 10\n")
@@ -0,0 +1,141 @@
+import sys
+
+import nbformat
+import pytest
+import yaml
+
+from xcengine.core import make_script_creator
+from xcengine.pipeline import Pipeline, PipelineCreator
+
+
+def write_notebook(path, parameters: str, code: str) -> None:
+    parameters_cell = nbformat.v4.new_code_cell(parameters)
+    parameters_cell.metadata["tags"] = ["parameters"]
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[parameters_cell, nbformat.v4.new_code_cell(code)]
+        ),
+        path,
+    )
+
+
+@pytest.fixture
+def pipeline_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("XCENGINE_CACHE_DIR", str(tmp_path / "cache"))
+    write_notebook(
+        tmp_path / "ingest.ipynb",
+        "size = 2",
+        "import xarray as xr\n"
+        "raw = xr.Dataset({'v': ('x', list(range(size)))}).chunk()",
+    )
+    write_notebook(
+        tmp_path / "scale.ipynb",
+        "cube = None\nfactor = 1",
+        "scaled = cube * factor",
+    )
+    path = tmp_path / "pipeline.yaml"
+    path.write_text(
+        yaml.safe_dump(
+            {
+                "stages": [
+                    {
+                        "name": "ingest",
+                        "notebook": "ingest.ipynb",
+                        "parameters": {"size": 3},
+                    },
+                    {
+                        "name": "scale",
+                        "notebook": "scale.ipynb",
+                        "parameters": {"factor": 10},
+                        "inputs": {"cube": "ingest.raw"},
+                        "checkpoint": True,
+                    },
+                ],
+                "outputs": {"result": "scale.scaled"},
+            }
+        )
+    )
+    return path
+
+
+def run_user_code(output_dir, monkeypatch) -> dict:
+    monkeypatch.syspath_prepend(str(output_dir))
+    namespace = {}
+    try:
+        exec((output_dir / "user_code.py").read_text(), namespace)
+    finally:
+        for name in list(sys.modules):
+            if name.startswith("stage_"):
+                del sys.modules[name]
+    return namespace
+
+
+def test_pipeline(pipeline_path, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    output_dir = tmp_path / "output"
+    creator = make_script_creator(pipeline_path)
+    assert isinstance(creator, PipelineCreator)
+    creator.convert_notebook_to_script(output_dir)
+    for filename in "stage_ingest.py", "stage_scale.py", "execute.py":
+        assert (output_dir / filename).is_file()
+    namespace = run_user_code(output_dir, monkeypatch)
+    assert namespace["result"].v.values.tolist() == [0, 10, 20]
+    assert (
+        tmp_path / "home" / "output" / "checkpoints" / "scale" / "scaled.zarr"
+    ).is_dir()
+    assert [n for n in namespace if not n.startswith("_")] == ["result"]
+
+
+def test_pipeline_default_outputs(pipeline_path, tmp_path, monkeypatch):
+    definition = yaml.safe_load(pipeline_path.read_text())
+    del definition["outputs"]
+    definition["stages"][1]["checkpoint"] = False
+    pipeline_path.write_text(yaml.safe_dump(definition))
+    PipelineCreator(pipeline_path).convert_notebook_to_script(tmp_path / "o")
+    namespace = run_user_code(tmp_path / "o", monkeypatch)
+    # The dataset is passed between stages lazily.
+    assert namespace["scaled"].v.chunks is not None
+    # The input dataset of the last stage is not one of its outputs.
+    assert [n for n in namespace if not n.startswith("_")] == ["scaled"]
+
+
+def test_pipeline_stage_names_shadowing_helpers(
+    pipeline_path, tmp_path, monkeypatch
+):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    definition = yaml.safe_load(pipeline_path.read_text())
+    definition["stages"][0]["name"] = "input"
+    definition["stages"][1]["name"] = "xarray"
+    definition["stages"][1]["inputs"] = {"cube": "input.raw"}
+    definition["outputs"] = {"result": "xarray.scaled"}
+    pipeline_path.write_text(yaml.safe_dump(definition))
+    PipelineCreator(pipeline_path).convert_notebook_to_script(tmp_path / "o")
+    namespace = run_user_code(tmp_path / "o", monkeypatch)
+    assert namespace["result"].v.values.tolist() == [0, 10, 20]
+
+
+@pytest.mark.parametrize(
+    "stages, message",
+    [
+        ([], "does not define any pipeline stages"),
+        ([{"name": "a b", "notebook": "a.ipynb"}], "Invalid pipeline stage"),
+        ([{"name": "a"}], "has no notebook"),
+        (
+            [{"name": "a", "notebook": "a.ipynb", "inputs": {"x": "b.y"}}],
+            "Invalid dataset reference",
+        ),
+    ],
+)
+def test_invalid_pipeline(tmp_path, stages, message):
+    path = tmp_path / "pipeline.yaml"
+    path.write_text(yaml.safe_dump({"stages": stages}))
+    with pytest.raises(ValueError, match=message):
+        Pipeline.from_yaml(path)
+
+
+def test_unknown_stage_parameter(pipeline_path, tmp_path):
+    definition = yaml.safe_load(pipeline_path.read_text())
+    definition["stages"][0]["parameters"] = {"length": 3}
+    pipeline_path.write_text(yaml.safe_dump(definition))
+    with pytest.raises(ValueError, match="has no parameter"):
+        PipelineCreator(pipeline_path).convert_notebook_to_script(tmp_path)
@@ -0,0 +1,100 @@
+import pathlib
+
+import nbformat
+import pytest
+
+import xcengine
+import xcengine.core
+from xcengine import runner
+
+EXAMPLES_DIR = pathlib.Path(__file__).parent.parent / "examples"
+
+
+@pytest.fixture
+def notebook(tmp_path, monkeypatch):
+    monkeypatch.setenv("XCENGINE_CACHE_DIR", str(tmp_path / "cache"))
+    parameters_cell = nbformat.v4.new_code_cell("size = 3\nscale = 2.0")
+    parameters_cell.metadata["tags"] = ["parameters"]
+    path = tmp_path / "notebook.ipynb"
+    nbformat.write(
+        nbformat.v4.new_notebook(
+            cells=[
+                nbformat.v4.new_code_cell("import numpy as np"),
+                parameters_cell,
+                nbformat.v4.new_code_cell(
+                    "import xarray as xr\n"
+                    "def make(factor):\n"
+                    "    return xr.Dataset({'v': ('x', np.arange(size))})"
+                    " * factor\n"
+                    "scaled = make(scale)\n"
+                    "_hidden = make(1)\n"
+                    "values = scaled.v.values.tolist()"
+                ),
+            ]
+        ),
+        path,
+    )
+    return path
+
+
+def test_make_run_module():
+    source = runner.make_run_module(
+        "a = 1\n__xce_set_params()\nb = a + 1\n", {"a": (int, 1)}
+    )
+    namespace = {}
+    exec(source, namespace)
+    run = namespace["run"]
+    assert run() == {}
+    assert "def run(*, a=1)" in source
+    assert "a = _xce_args['a']" in source
+
+
+def test_make_run_module_excludes_unchanged_parameters():
+    import xarray as xr
+
+    source = runner.make_run_module(
+        "cube = None\nother = None\n__xce_set_params()\n"
+        "other = other * 2\nresult = cube + other\n",
+        {"cube": (object, None), "other": (object, None)},
+    )
+    namespace = {}
+    exec(source, namespace)
+    cube = xr.Dataset({"v": ("x", [1, 2])})
+    results = namespace["run"](cube=cube, other=cube)
+    assert sorted(results) == ["other", "result"]
+
+
+def test_make_run_module_without_parameters():
+    assert "def run()" in runner.make_run_module("a = 1\n", {})
+
+
+def test_make_run_module_wildcard_import():
+    with pytest.raises(SyntaxError):
+        runner.make_run_module("from os import *\n", {})
+
+
+def test_run_notebook(notebook):
+    results = xcengine.run_notebook(notebook)
+    assert list(results) == ["scaled"]
+    assert results["scaled"].v.values.tolist() == [0.0, 2.0, 4.0]
+    results = xcengine.run_notebook(notebook, size=2, scale=-1.0)
+    assert results["scaled"].v.values.tolist() == [0, -1]
+
+
+def test_run_notebook_unknown_parameter(notebook):
+    with pytest.raises(TypeError):
+        xcengine.run_notebook(notebook, shape=2)
+
+
+def test_run_notebook_caches_module(notebook):
+    module = runner.load_notebook_module(notebook)
+    assert runner.load_notebook_module(str(notebook)) is module
+    notebook.write_text(notebook.read_text().replace("size = 3", "size = 4"))
+    assert runner.load_notebook_module(notebook) is not module
+
+
+def test_user_module_written(tmp_path):
+    xcengine.core.ScriptCreator(
+        EXAMPLES_DIR / "dynamic.ipynb"
+    ).convert_notebook_to_script(tmp_path, use_cache=False)
+    assert "def run(" in (tmp_path / "user_module.py").read_text()
@@ -0,0 +1,37 @@
+import os
+
+from xcengine import util
+
+
+def test_clear_directory(tmp_path):
+    (tmp_path / "subdir").mkdir()
+    (tmp_path / "subdir" / "file").touch()
+    (tmp_path / "file").touch()
+    util.clear_directory(tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sync_files(tmp_path):
+    source, target = tmp_path / "source", tmp_path / "target"
+    source.mkdir()
+    target.mkdir()
+    for name, content in ("a", "same"), ("b", "new"), ("c", "added"):
+        (source / name).write_text(content)
+    (target / "a").write_text("same")
+    (target / "b").write_text("old")
+    os.utime(target / "a", ns=(0, 0))
+    assert util.sync_files(source, target) == ["b", "c"]
+    assert (target / "b").read_text() == "new"
+    assert (target / "c").read_text() == "added"
+    assert (target / "a").stat().st_mtime_ns == 0
+
+
+def test_file_watcher(tmp_path):
+    path1, path2 = tmp_path / "file1", tmp_path / "file2"
+    path1.write_text("foo")
+    path2.write_text("bar")
+    watcher = util.FileWatcher([path1, path2], interval=0.01)
+    path2.write_text("barbaz")
+    assert watcher.wait() == {path2}
+    os.utime(path1, ns=(0, 0))
+    assert watcher.wait() == {path1}
@@ -0,0 +1,760 @@
+import ast
+import pathlib
+import shutil
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from xcengine import wrapper
+from xcengine.parameters import RESERVED_NAMES
+
+USER_CODE = """
+periods = 10
+__xce_set_params()
+import xcube.core.new
+import numpy as np
+cube1 = xcube.core.new.new_cube(time_periods=periods)
+cube2 = xcube.core.new.new_cube(time_periods=periods)
+cube2.attrs.update(title="cube2")
+unused = np.arange(periods)
+def make_cube3():
+    return cube1 + cube2
+cube3 = make_cube3()
+"""
+
+
+def sliced_lines(code: str, targets: set[str]) -> list[str]:
+    statements = wrapper._slice_statements(ast.parse(code).body, targets)
+    return [ast.unparse(s).splitlines()[0] for s in statements]
+
+
+def test_slice_statements_single_target():
+    assert sliced_lines(USER_CODE, {"cube2"}) == [
+        "periods = 10",
+        "__xce_set_params()",
+        "import xcube.core.new",
+        "cube2 = xcube.core.new.new_cube(time_periods=periods)",
+        "cube2.attrs.update(title='cube2')",
+    ]
+
+
+def test_slice_statements_transitive():
+    lines = sliced_lines(USER_CODE, {"cube3"})
+    assert "def make_cube3():" in lines
+    assert "cube1 = xcube.core.new.new_cube(time_periods=periods)" in lines
+    assert "import numpy as np" not in lines
+
+
+@pytest.mark.parametrize(
+    "statement, expected",
+    [
+        ("a = b + c", ({"b", "c"}, {"a"}, set())),
+        ("a, (b, *c) = d", ({"d"}, {"a", "b", "c"}, set())),
+        ("a.b = c", ({"a", "c"}, set(), {"a"})),
+        ("a[0] += 1", ({"a"}, set(), {"a"})),
+        ("import a.b, c as d", (set(), {"d"}, {"a"})),
+        ("from a import *", (set(), set(), {"*"})),
+        ("exec(s)", ({"exec", "s"}, set(), {"*"})),
+        ("for i in x: y = i", ({"i", "x"}, set(), {"i", "y"})),
+        ("def f(x): y = x + z", ({"x", "z"}, {"f"}, set())),
+    ],
+)
+def test_analyse_statement(statement, expected):
+    assert (
+        wrapper._analyse_statement(ast.parse(statement).body[0]) == expected
+    )
+
+
+def test_load_code_precompiled(tmp_path):
+    source_path = tmp_path / "user_code.py"
+    source_path.write_text("x = 42\n")
+    assert wrapper.load_code(source_path).co_filename == str(source_path)
+    wrapper.precompile(source_path)
+    code = wrapper.load_code(source_path)
+    assert code.co_filename == "user_code.py"
+    namespace = {}
+    exec(code, namespace)
+    assert namespace["x"] == 42
+
+
+def test_load_code_stale_pyc(tmp_path):
+    source_path = tmp_path / "user_code.py"
+    source_path.write_text("x = 42\n")
+    wrapper.precompile(source_path)
+    source_path.write_text("x = 43\n")
+    code = wrapper.load_code(source_path)
+    assert code.co_filename == str(source_path)
+    namespace = {}
+    exec(code, namespace)
+    assert namespace["x"] == 43
+
+
+@pytest.mark.parametrize(
+    "type_name, value, expected",
+    [
+        ("int", "3", 3),
+        ("float", "2.5", 2.5),
+        ("str", "abc", "abc"),
+        ("bool", "False", False),
+        ("bool", "yes", True),
+        ("list", "[1, 2]", [1, 2]),
+        ("tuple", "(1, 'a')", (1, "a")),
+    ],
+)
+def test_parameter_converter(type_name, value, expected):
+    assert wrapper.parameter_converter(type_name)(value) == expected
+
+
+@pytest.mark.parametrize(
+    "type_name, value",
+    [("int", "x"), ("bool", "maybe"), ("list", "(1,)"), ("list", "[1,")],
+)
+def test_parameter_converter_invalid(type_name, value):
+    with pytest.raises(ValueError):
+        wrapper.parameter_converter(type_name)(value)
+
+
+@pytest.fixture
+def script_dir(tmp_path):
+    shutil.copy2(pathlib.Path(wrapper.__file__), tmp_path / "execute.py")
+    (tmp_path / "parameters.yaml").write_text(
+        "periods:\n  type: int\n  default: 10\n"
+        "verbose_output:\n  type: bool\n  default: true\n"
+    )
+    # Any attempt to execute the user code fails.
+    (tmp_path / "user_code.py").write_text("raise RuntimeError('executed')\n")
+    return tmp_path
+
+
+def run_script(script_dir, *args) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, str(script_dir / "execute.py"), *args],
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_list_params_does_not_run_user_code(script_dir):
+    process = run_script(script_dir, "--list-params")
+    assert process.returncode == 0
+    assert process.stdout.splitlines() == [
+        "periods (int): 10",
+        "verbose_output (bool): True",
+    ]
+
+
+def test_help_lists_parameters(script_dir):
+    process = run_script(script_dir, "--help")
+    assert process.returncode == 0
+    assert "--periods INT" in process.stdout
+    assert "--verbose-output BOOL" in process.stdout
+
+
+@pytest.mark.parametrize(
+    "args", [["--periods", "ten"], ["--no-such-option"], ["--periods"]]
+)
+def test_invalid_arguments_do_not_run_user_code(script_dir, args):
+    process = run_script(script_dir, *args)
+    assert process.returncode == 2
+    assert "executed" not in process.stderr
+
+
+def test_reserved_parameter_names():
+    options = {
+        option[2:].replace("-", "_")
+        for action in wrapper.make_parser({})._actions
+        for option in action.option_strings
+        if option.startswith("--")
+    }
+    assert options == RESERVED_NAMES
+
+
+def test_clashing_parameter_name(script_dir):
+    (script_dir / "parameters.yaml").write_text(
+        "threads:\n  type: int\n  default: 4\n"
+    )
+    process = run_script(script_dir, "--help")
+    assert process.returncode == 2
+    assert "Notebook parameter threads clashes" in process.stderr
+
+
+def test_set_params_from_arguments(monkeypatch):
+    monkeypatch.setenv("xce_periods", "5")
+    monkeypatch.setenv("xce_title", "'from environment'")
+    monkeypatch.setattr(wrapper, "_parameter_values", {"periods": 3})
+    monkeypatch.setattr(wrapper, "_applied_parameters", {})
+    getattr(wrapper, "__xce_set_params")()
+    assert (wrapper.periods, wrapper.title) == (3, "from environment")
+    assert wrapper._applied_parameters == {
+        "periods": 3,
+        "title": "from environment",
+    }
+
+
+def test_fingerprint_covers_environment_parameters(monkeypatch):
+    import xarray as xr
+
+    dataset = xr.Dataset(dict(v=("x", [1, 2])))
+    monkeypatch.setattr(wrapper, "_applied_parameters", {})
+    keys = set()
+    for value in "1", "2":
+        monkeypatch.setenv("xce_periods", value)
+        getattr(wrapper, "__xce_set_params")()
+        keys.add(wrapper.fingerprint(dataset, {}))
+    assert len(keys) == 2
+
+
+CELLS_CODE = """
+# In[1]:
+
+
+import threading
+periods = 10
+
+
+# In[2]:
+
+
+__xce_set_params()
+
+
+# In[ ]:
+
+
+def combine():
+    return cube_a + cube_b
+
+
+# In[3]:
+
+
+cube_a = [periods] * 2
+
+
+# In[4]:
+
+
+cube_b = [periods] * 3
+cube_b.append(0)
+
+
+# In[5]:
+
+
+cube_c = combine()
+"""
+
+
+def cells_of(code: str) -> list[list]:
+    return wrapper._split_cells(code, ast.parse(code).body)
+
+
+def test_split_cells():
+    cells = cells_of(CELLS_CODE)
+    assert [len(c) for c in cells] == [2, 1, 1, 1, 2, 1]
+    assert ast.unparse(cells[4][1]) == "cube_b.append(0)"
+
+
+def test_cell_dependencies():
+    assert wrapper._cell_dependencies(cells_of(CELLS_CODE)) == [
+        set(),
+        {0},  # __xce_set_params() may define anything.
+        {1},
+        {0, 1, 2},  # Redefining cube_a would affect combine().
+        {0, 1, 2},
+        {1, 2, 3, 4},  # combine() uses cube_a and cube_b when called.
+    ]
+
+
+def test_run_cells_parallel():
+    # Each cell waits for the other, so they must run concurrently.
+    namespace = dict(barrier=threading.Barrier(2, timeout=10))
+    code = (
+        "first = barrier.wait() * 0 + 1\n"
+        "# In[ ]:\n"
+        "second = barrier.wait() * 0 + 2"
+    )
+    wrapper.run_cells_parallel(
+        cells_of(code), "user_code.py", namespace=namespace
+    )
+    assert (namespace["first"], namespace["second"]) == (1, 2)
+
+
+def test_run_cells_parallel_error():
+    namespace = {}
+    with pytest.raises(ZeroDivisionError):
+        wrapper.run_cells_parallel(
+            cells_of("x = 1 / 0\n# In[ ]:\ny = x"),
+            "user_code.py",
+            namespace=namespace,
+        )
+    assert "y" not in namespace
+
+
+def test_write_datasets_shares_computation(tmp_path):
+    import dask.array
+    import xarray as xr
+
+    calls = []
+
+    def expensive(block):
+        # Dask also calls this with tiny blocks to infer metadata.
+        if block.size == 4:
+            calls.append(1)
+        return block * 3
+
+    shared = dask.array.ones(4, chunks=4).map_blocks(expensive)
+    datasets = {
+        "first": xr.Dataset({"a": ("x", shared + 1)}),
+        "second": xr.Dataset({"b": ("x", shared * 2)}),
+        "third": xr.Dataset({"c": ("x", [1, 2])}),
+    }
+    paths = wrapper.write_datasets(datasets, tmp_path)
+    assert len(calls) == 1
+    assert paths == {
+        "first": tmp_path / "first.zarr",
+        "second": tmp_path / "second.zarr",
+        "third": tmp_path / "third.zarr",
+    }
+    assert xr.open_zarr(paths["first"]).a.values.tolist() == [4.0] * 4
+    assert xr.open_zarr(paths["second"]).b.values.tolist() == [6.0] * 4
+    assert xr.open_zarr(paths["third"]).c.values.tolist() == [1, 2]
+
+
+def test_write_datasets_with_encoding(tmp_path):
+    import numpy as np
+    import xarray as xr
+    import zarr
+
+    (tmp_path / "encoding.yaml").write_text(
+        '"*":\n'
+        "  compressor: {id: blosc, cname: lz4, clevel: 3, shuffle: 2}\n"
+        "cube:\n"
+        "  chunks: {x: 5}\n"
+        "  variables:\n"
+        "    a:\n"
+        "      fill_value: -1\n"
+        "      compressor: {id: zstd, level: 9}\n"
+        "    b:\n"
+        "      compressor: null\n"
+    )
+    encoding = wrapper.load_output_encoding(tmp_path / "encoding.yaml")
+    data = ("x", np.arange(10.0))
+    dataset = xr.Dataset({"a": data, "b": data, "c": data}).chunk(x=10)
+    paths = wrapper.write_datasets({"cube": dataset}, tmp_path, encoding)
+    group = zarr.open_group(paths["cube"], mode="r")
+    assert all(group[name].chunks == (5,) for name in "abc")
+    assert "zstd" in str(group["a"].compressors).lower()
+    assert not group["b"].compressors
+    assert "lz4" in str(group["c"].compressors)
+    assert xr.open_zarr(paths["cube"]).a.encoding["_FillValue"] == -1
+    # The dataset passed in is left unchanged.
+    assert dataset.a.chunks == ((10,),)
+
+
+@pytest.mark.parametrize(
+    "content, message",
+    [
+        ("- cube", "expected a mapping"),
+        ("cube: {level: 5}", "unknown encoding setting"),
+        ("cube: {compressor: {id: nosuchcodec}}", "invalid codec"),
+    ],
+)
+def test_load_output_encoding_invalid(tmp_path, content, message):
+    (tmp_path / "encoding.yaml").write_text(content)
+    with pytest.raises(ValueError, match=message):
+        wrapper.load_output_encoding(tmp_path / "encoding.yaml")
+
+
+def test_invalid_output_encoding_does_not_run_user_code(script_dir):
+    (script_dir / "encoding.yaml").write_text("cube: {level: 5}\n")
+    process = run_script(
+        script_dir, "--output-encoding", str(script_dir / "encoding.yaml")
+    )
+    assert process.returncode == 2
+    assert "unknown encoding setting" in process.stderr
+    assert "executed" not in process.stderr
+
+
+@pytest.mark.parametrize(
+    "sizes, access, expected",
+    [
+        (
+            dict(time=365, y=4000, x=4000),
+            "map",
+            dict(time=1, y=2896, x=2896),
+        ),
+        (
+            dict(time=365, y=4000, x=4000),
+            "timeseries",
+            dict(time=365, y=151, x=152),
+        ),
+        (
+            dict(band=3, y=5000, x=5000),
+            "map",
+            dict(band=3, y=1672, x=1672),
+        ),
+        (dict(y=10, x=10), "map", dict(y=10, x=10)),
+    ],
+)
+def test_advise_chunks(sizes, access, expected):
+    assert wrapper.advise_chunks(sizes, 4, 2**25, access) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("0", 0), ("1000", 1000), ("64MiB", 2**26), ("1.5 GB", 1.5e9)],
+)
+def test_parse_size(value, expected):
+    assert wrapper.parse_size(value) == expected
+
+
+def test_rechunk_dataset():
+    import dask.array
+    import numpy as np
+    import xarray as xr
+
+    def variable(chunks):
+        return ("t", "y", "x"), dask.array.zeros(
+            (8, 64, 64), chunks=chunks, dtype=np.float32
+        )
+
+    dataset = xr.Dataset(
+        dict(
+            tiny=variable((1, 8, 8)),
+            large=variable((8, 64, 64)),
+            right=variable((1, 32, 64)),
+            explicit=variable((1, 8, 8)),
+            small=(("x",), np.zeros(64)),
+        ),
+        coords=dict(t=np.arange(8).astype("datetime64[D]")),
+    )
+    encoding = dict(explicit=dict(chunks=(1, 8, 8)))
+    rechunked = wrapper.rechunk_dataset("cube", dataset, encoding, 2**13)
+    assert rechunked.tiny.chunks == ((1,) * 8, (45, 19), (45, 19))
+    assert rechunked.large.chunks == ((1,) * 8, (45, 19), (45, 19))
+    assert rechunked.right.chunks == dataset.right.chunks
+    assert rechunked.explicit.chunks == dataset.explicit.chunks
+    assert rechunked.small.chunks is None
+    assert encoding == dict(
+        explicit=dict(chunks=(1, 8, 8)),
+        tiny=dict(chunks=(1, 45, 45)),
+        large=dict(chunks=(1, 45, 45)),
+    )
+
+
+def test_write_datasets_sharded(tmp_path):
+    import dask.array
+    import xarray as xr
+    import zarr
+
+    data = dask.array.random.random((4, 64, 64), chunks=(1, 8, 8))
+    dataset = xr.Dataset(dict(v=(("t", "y", "x"), data)))
+    paths = wrapper.write_datasets(
+        dict(cube=dataset), tmp_path, chunk_bytes=2**11, shard_bytes=2**15
+    )
+    group = zarr.open_group(paths["cube"], mode="r")
+    assert group.metadata.zarr_format == 3
+    assert group.metadata.consolidated_metadata is not None
+    assert group["v"].chunks == (1, 16, 16)
+    assert group["v"].shards == (1, 64, 64)
+    assert len(list((paths["cube"] / "v").rglob("c/*/*/*"))) == 4
+    written = xr.open_zarr(paths["cube"], consolidated=True)
+    assert (written.v == dataset.v).all()
+
+
+def test_shard_dataset_uses_encoded_chunks():
+    import dask.array
+    import xarray as xr
+
+    data = dask.array.zeros((100, 100), chunks=(100, 100), dtype="u1")
+    dataset = xr.Dataset(dict(v=(("y", "x"), data)))
+    encoding = dict(v=dict(chunks=(30, 30)))
+    sharded = wrapper.shard_dataset("cube", dataset, encoding, 3600, 100)
+    assert encoding == dict(v=dict(chunks=(30, 30), shards=(60, 60)))
+    assert sharded.v.chunks == ((60, 40), (60, 40))
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--shard-size", "1MiB", "--chunk-size", "0"],
+        ["--shard-size", "1MiB", "--chunk-size", "2MiB"],
+    ],
+)
+def test_invalid_shard_size_does_not_run_user_code(script_dir, args):
+    process = run_script(script_dir, *args)
+    assert process.returncode == 2
+    assert "--chunk-size must be" in process.stderr
+    assert "executed" not in process.stderr
+
+
+def test_write_datasets_streaming(tmp_path, caplog):
+    import dask.array
+    import numpy as np
+    import xarray as xr
+
+    computed = []
+
+    def record(block):
+        if block.size > 1:
+            computed.append(block.shape[0])
+        return block
+
+    data = dask.array.random.random((10, 4, 4), chunks=(1, 4, 4))
+    dataset = xr.Dataset(
+        dict(
+            v=(("time", "y", "x"), data.map_blocks(record)),
+            mask=(("y", "x"), dask.array.ones((4, 4))),
+            series=(("time",), np.arange(10)),
+        )
+    )
+    datasets = dict(cube=dataset, static=dataset[["mask"]])
+    with caplog.at_level("INFO"):
+        paths = wrapper.write_datasets(
+            datasets,
+            tmp_path,
+            chunk_bytes=None,
+            stream_dim="time",
+            stream_memory=4 * 128 * 3,
+        )
+    assert "Writing cube in 4 slab(s) of 3 step(s) along time" in caplog.text
+    assert len(computed) == 10
+    written = xr.open_zarr(paths["cube"], consolidated=True)
+    assert set(written.data_vars) == {"v", "mask", "series"}
+    assert (written.v == dataset.v).all()
+    assert (written.series == dataset.series).all()
+    assert (xr.open_zarr(paths["static"]).mask == 1).all()
+
+
+def test_write_datasets_resume(tmp_path):
+    import dask.array
+    import xarray as xr
+
+    computed = []
+    fail_at = [5]
+
+    def record(block, block_info=None):
+        if block_info:
+            index = block_info[0]["chunk-location"][0]
+            if index == fail_at[0]:
+                raise RuntimeError("killed")
+            computed.append(index)
+        return block
+
+    data = dask.array.ones((10, 4), chunks=(1, 4)).map_blocks(
+        record, dtype=float
+    )
+    datasets = dict(
+        cube=xr.Dataset(dict(v=(("time", "x"), data))),
+        static=xr.Dataset(dict(s=("x", dask.array.zeros(4)))),
+    )
+    options = dict(chunk_bytes=None, stream_dim="time", stream_memory=128)
+    with pytest.raises(RuntimeError, match="killed"):
+        wrapper.write_datasets(datasets, tmp_path, **options)
+    assert computed == [0, 1, 2, 3, 4]
+    assert (tmp_path / wrapper.WriteJournal.FILENAME).is_file()
+
+    # Without --resume, existing outputs are not overwritten.
+    with pytest.raises(Exception):
+        wrapper.write_datasets(datasets, tmp_path, **options)
+
+    computed.clear()
+    fail_at[0] = None
+    paths = wrapper.write_datasets(datasets, tmp_path, resume=True, **options)
+    assert computed == [5, 6, 7, 8, 9]
+    assert (xr.open_zarr(paths["cube"]).v == 1).all()
+    assert (xr.open_zarr(paths["static"]).s == 0).all()
+
+    computed.clear()
+    wrapper.write_datasets(datasets, tmp_path, resume=True, **options)
+    assert computed == []
+
+
+def test_write_journal_tolerates_truncated_entry(tmp_path):
+    journal = wrapper.WriteJournal(tmp_path)
+    journal.record("cube", "abc", "slab", (0, 3))
+    with open(journal.path, "a") as fh:
+        fh.write('{"dataset": "cu')
+    journal = wrapper.WriteJournal(tmp_path, resume=True)
+    assert journal.written_steps("cube", "abc") == {0, 1, 2}
+    assert journal.written_steps("cube", "other") == set()
+    journal = wrapper.WriteJournal(tmp_path)
+    assert journal.entries == []
+    journal.record("cube", "def", "complete")
+    assert len(journal.path.read_text().splitlines()) == 1
+
+
+def make_daily_cube(start: str, days: int, fail: bool = False):
+    import dask.array
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    def check(block):
+        if fail:
+            raise RuntimeError("killed")
+        return block
+
+    time = pd.date_range(start, periods=days)
+    values = dask.array.from_array(
+        (time.dayofyear.to_numpy()[:, None] * np.ones((days, 3))),
+        chunks=(1, 3),
+    )
+    return xr.Dataset(
+        dict(
+            v=(("time", "x"), values.map_blocks(check, dtype=float)),
+            mask=("x", dask.array.ones(3)),
+        ),
+        coords=dict(time=time),
+    )
+
+
+@pytest.mark.parametrize("align_chunks", [True, False])
+def test_write_datasets_append(tmp_path, caplog, monkeypatch, align_chunks):
+    import xarray as xr
+
+    if not align_chunks:
+        # As with versions of xarray without to_zarr(align_chunks=...)
+        monkeypatch.setattr(wrapper, "_can_align_chunks", lambda: False)
+
+    options = dict(chunk_bytes=None, append_dim="time")
+    encoding = {"cube": {"variables": {"v": {"chunks": [2, 3]}}}}
+    wrapper.write_datasets(
+        dict(cube=make_daily_cube("2024-01-01", 5)),
+        tmp_path,
+        encoding=encoding,
+        **options,
+    )
+    with pytest.raises(RuntimeError, match="killed"):
+        wrapper.write_datasets(
+            dict(cube=make_daily_cube("2024-01-03", 6, fail=True)),
+            tmp_path,
+            **options,
+        )
+    with caplog.at_level("INFO"):
+        paths = wrapper.write_datasets(
+            dict(cube=make_daily_cube("2024-01-04", 6)), tmp_path, **options
+        )
+    assert "interrupted append" in caplog.text
+    assert "Appending 4 time step(s) to cube" in caplog.text
+    written = xr.open_zarr(paths["cube"], consolidated=True)
+    assert written.v.encoding["chunks"] == (2, 3)
+    assert written.time.dt.dayofyear.values.tolist() == list(range(1, 10))
+    assert written.v.values[:, 0].tolist() == list(range(1, 10))
+    assert written.mask.values.tolist() == [1, 1, 1]
+
+    caplog.clear()
+    with caplog.at_level("INFO"):
+        wrapper.write_datasets(
+            dict(cube=make_daily_cube("2024-01-08", 2)), tmp_path, **options
+        )
+    assert "Skipping cube: no new time steps" in caplog.text
+
+
+@pytest.mark.parametrize("stream_dim", [None, "x"])
+def test_write_datasets_append_rewrites_static(tmp_path, caplog, stream_dim):
+    import dask.array
+    import xarray as xr
+
+    options = dict(chunk_bytes=None, append_dim="time", stream_dim=stream_dim)
+    for run, start in enumerate(["2024-01-01", "2024-01-04", "2024-01-06"]):
+        summary = xr.Dataset(
+            dict(total=("x", dask.array.full(3, run, chunks=1)))
+        )
+        caplog.clear()
+        with caplog.at_level("INFO"):
+            paths = wrapper.write_datasets(
+                dict(cube=make_daily_cube(start, 3), summary=summary),
+                tmp_path,
+                **options,
+            )
+        message = "Rewriting summary: it has no time dimension"
+        assert (message in caplog.text) == (run > 0)
+        written = xr.open_zarr(paths["summary"], consolidated=True)
+        assert written.total.values.tolist() == [run] * 3
+    written = xr.open_zarr(paths["cube"], consolidated=True)
+    assert written.time.dt.dayofyear.values.tolist() == list(range(1, 9))
+
+
+def test_start_cluster(tmp_path):
+    pytest.importorskip("distributed")
+    import dask.array
+    import dask.base
+    import xarray as xr
+
+    client = wrapper.start_cluster(1, 2, "512MiB", tmp_path / "spill")
+    try:
+        [worker] = client.scheduler_info()["workers"].values()
+        assert worker["memory_limit"] == 512 * 2**20
+        assert worker["nthreads"] == 2
+        assert (tmp_path / "spill").is_dir()
+        assert dask.base.get_scheduler() == client.get
+        dataset = xr.Dataset(dict(v=("x", dask.array.arange(8, chunks=2))))
+        paths = wrapper.write_datasets(dict(cube=dataset), tmp_path)
+        assert xr.open_zarr(paths["cube"]).v.values.tolist() == list(range(8))
+    finally:
+        client.close()
+        client.cluster.close()
+
+
+@pytest.mark.parametrize(
+    "files, expected",
+    [
+        (
+            {"cpu.max": "250000 100000\n", "memory.max": "2147483648\n"},
+            (2.5, 2**31),
+        ),
+        ({"cpu.max": "max 100000\n", "memory.max": "max\n"}, (None, None)),
+        (
+            {
+                "cpu/cpu.cfs_quota_us": "50000\n",
+                "cpu/cpu.cfs_period_us": "100000\n",
+                "memory/memory.limit_in_bytes": "1073741824\n",
+            },
+            (0.5, 2**30),
+        ),
+        (
+            {
+                "cpu,cpuacct/cpu.cfs_quota_us": "-1\n",
+                "cpu,cpuacct/cpu.cfs_period_us": "100000\n",
+                "memory/memory.limit_in_bytes": "9223372036854771712\n",
+            },
+            (None, None),
+        ),
+        ({}, (None, None)),
+    ],
+)
+def test_cgroup_limits(tmp_path, files, expected):
+    for name, content in files.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(content)
+    assert wrapper.cgroup_limits(tmp_path) == expected
+
+
+def test_available_resources(tmp_path):
+    (tmp_path / "cpu.max").write_text("150000 100000\n")
+    (tmp_path / "memory.max").write_text("1073741824\n")
+    cpus, memory = wrapper.available_resources(tmp_path)
+    assert cpus == min(2, wrapper.available_resources(tmp_path / "no")[0])
+    assert memory == 2**30
+
+
+@pytest.mark.parametrize(
+    "memory, expected",
+    [
+        (None, (wrapper.DEFAULT_CHUNK_BYTES, wrapper.DEFAULT_STREAM_MEMORY)),
+        (2**30, (32 * 2**20, 2**29)),
+        (2**20, (2**20, 2**19)),
+    ],
+)
+def test_configure_resources(memory, expected):
+    environ = {"MKL_NUM_THREADS": "1"}
+    assert wrapper.configure_resources(4, memory, environ) == expected
+    assert environ["OMP_NUM_THREADS"] == environ["DASK_NUM_WORKERS"] == "4"
+    assert environ["MKL_NUM_THREADS"] == "1"
+    assert environ.get("DASK_ARRAY__CHUNK_SIZE") == (
+        None if memory is None else str(expected[0])
+    )
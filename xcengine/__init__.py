@@ -1 +1,11 @@
 __version__ = "0.0.1.dev0"
+
+
+def __getattr__(name: str):
+    # The runner pulls in the converter, so it is only imported when used,
+    # keeping "import xcengine" (and so xcetool startup) fast.
+    if name == "run_notebook":
+        from .runner import run_notebook
+
+        return run_notebook
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
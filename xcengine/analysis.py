@@ -0,0 +1,137 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""Static analysis of notebook code cells"""
+
+import ast
+
+# Functions and methods which are assumed to exist only to produce visual
+# output, as in display(cube), IPython.display.display(cube), or plt.show().
+DISPLAY_FUNCTIONS = {"display", "show"}
+
+# Attributes which mark a call as plotting, as in cube.v.plot(),
+# cube.v.plot.imshow(), plt.plot(x, y), or cube.hvplot.image().
+PLOT_ATTRIBUTES = {
+    "contour",
+    "contourf",
+    "hist",
+    "hvplot",
+    "imshow",
+    "pcolormesh",
+    "plot",
+    "scatter",
+}
+
+# Methods which write a figure to a file, so that calls of them, and
+# usually the plotting calls before them, have effects beyond display
+SAVE_FUNCTIONS = {"savefig"}
+
+
+def parse_cell(source: str) -> ast.Module | None:
+    """Parse the source of a code cell
+
+    If the source is not valid Python, it is first transformed with
+    IPython's input transformer, which turns magics and shell escapes into
+    Python calls.
+
+    :param source: the source code of a notebook code cell
+    :return: the parsed module, or None if the source cannot be parsed
+    """
+    try:
+        return ast.parse(source)
+    except SyntaxError:
+        pass
+    from IPython.core.inputtransformer2 import TransformerManager
+
+    try:
+        return ast.parse(TransformerManager().transform_cell(source))
+    except SyntaxError:
+        return None
+
+
+def attribute_chain(node: ast.expr) -> list[str]:
+    """Return the names in an attribute/call/subscript chain, root first
+
+    For example, the chain for ``cube.isel(time=0).v.plot.imshow`` is
+    ``["cube", "isel", "v", "plot", "imshow"]``.
+    """
+    names = []
+    while True:
+        match node:
+            case ast.Attribute(value=value, attr=attr):
+                names.append(attr)
+                node = value
+            case ast.Call(func=func):
+                node = func
+            case ast.Subscript(value=value):
+                node = value
+            case ast.Name(id=name):
+                names.append(name)
+                break
+            case _:
+                break
+    return names[::-1]
+
+
+def is_display_statement(statement: ast.stmt, plots: bool = True) -> bool:
+    """Determine whether a statement only serves to display something
+
+    This is true for bare expression statements without calls or
+    assignment expressions (whose value a notebook would display), for
+    calls of display functions, and for calls of plotting methods.
+    Calls which save a figure are never display statements.
+
+    :param statement: an AST node for a statement
+    :param plots: whether calls of plotting methods count as display
+        statements; this should be False if the plots may be saved later
+    :return: True iff the statement only serves to display something
+    """
+    if not isinstance(statement, ast.Expr):
+        return False
+    expression = statement.value
+    nodes = list(ast.walk(expression))
+    if any(isinstance(n, ast.NamedExpr) for n in nodes):
+        return False
+    if not any(isinstance(n, ast.Call) for n in nodes):
+        return True
+    if not isinstance(expression, ast.Call):
+        return False
+    chain = attribute_chain(expression)
+    if not chain or SAVE_FUNCTIONS & set(chain):
+        return False
+    return chain[-1] in DISPLAY_FUNCTIONS or (
+        plots and bool(PLOT_ATTRIBUTES & set(chain[1:]))
+    )
+
+
+def is_display_only(source: str, plots: bool = True) -> bool:
+    """Determine whether a code cell has no effect other than display
+
+    Cells which are empty or cannot be parsed are never considered
+    display-only.
+
+    :param source: the source code of a notebook code cell
+    :param plots: whether calls of plotting methods count as display
+    :return: True iff every statement in the cell is a display statement
+    """
+    module = parse_cell(source)
+    return (
+        module is not None
+        and len(module.body) > 0
+        and all(is_display_statement(s, plots) for s in module.body)
+    )
+
+
+def saves_figures(source: str) -> bool:
+    """Determine whether a code cell may save a figure to a file
+
+    :param source: the source code of a notebook code cell
+    :return: True iff the cell calls a method like savefig
+    """
+    module = parse_cell(source)
+    return module is not None and any(
+        isinstance(node, ast.Call)
+        and bool(SAVE_FUNCTIONS & set(attribute_chain(node)))
+        for node in ast.walk(module)
+    )
@@ -0,0 +1,132 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+from collections.abc import Sequence
+
+LOGGER = logging.getLogger(__name__)
+
+# Name of the file in a cache entry which holds the messages logged by the
+# conversion; it is not copied to the output directory.
+REPORTS_FILENAME = "xcengine-reports.json"
+
+
+class ConversionCache:
+    """A content-addressed store of notebook conversion outputs
+
+    Each entry is a directory named after a hash of everything which
+    determines the conversion output (typically the notebook, the wrapper
+    script, and the xcengine version). Entries are written atomically, so
+    concurrent conversions of the same notebook can safely share a cache.
+    Along with the output files, an entry stores the messages logged by
+    the conversion, so that they can be repeated when it is reused.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path | None = None):
+        self.cache_dir = cache_dir or self.default_dir()
+
+    @staticmethod
+    def default_dir() -> pathlib.Path:
+        if cache_dir := os.environ.get("XCENGINE_CACHE_DIR"):
+            return pathlib.Path(cache_dir)
+        cache_home = os.environ.get("XDG_CACHE_HOME")
+        return (
+            pathlib.Path(cache_home)
+            if cache_home
+            else pathlib.Path.home() / ".cache"
+        ) / "xcengine"
+
+    @staticmethod
+    def key(*parts: bytes | str | pathlib.Path) -> str:
+        """Compute a cache key from a sequence of inputs
+
+        :param parts: the inputs which determine the conversion output.
+            Paths are read and hashed by content; strings and bytes are
+            hashed directly.
+        :return: a hex digest identifying the inputs
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, pathlib.Path):
+                with open(part, "rb") as fh:
+                    while chunk := fh.read(1 << 20):
+                        digest.update(chunk)
+            else:
+                digest.update(part.encode() if isinstance(part, str) else part)
+            # Separate the parts so that e.g. ("ab", "c") != ("a", "bc").
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str, output_dir: pathlib.Path) -> bool:
+        """Copy a cached conversion to an output directory, if it exists
+
+        :param key: cache key of the conversion
+        :param output_dir: directory to copy the cached files into
+        :return: True iff the cache contained an entry for the key
+        """
+        entry = self.cache_dir / key
+        if not entry.is_dir():
+            return False
+        for path in entry.iterdir():
+            if path.name != REPORTS_FILENAME:
+                shutil.copy2(path, output_dir / path.name)
+        LOGGER.info(f"Reused cached conversion {key[:12]}")
+        return True
+
+    def reports(self, key: str) -> list[tuple[int, str]]:
+        """Get the messages logged by a cached conversion
+
+        :param key: cache key of the conversion
+        :return: the logging level and text of each message, in the order
+            they were logged; empty if the entry doesn't exist or has no
+            stored messages
+        """
+        try:
+            with open(self.cache_dir / key / REPORTS_FILENAME) as fh:
+                return [(level, message) for level, message in json.load(fh)]
+        except (OSError, ValueError):
+            return []
+
+    def put(
+        self,
+        key: str,
+        output_dir: pathlib.Path,
+        filenames: list[str],
+        reports: Sequence[tuple[int, str]] = (),
+    ) -> None:
+        """Store the specified files from an output directory in the cache
+
+        :param key: cache key of the conversion
+        :param output_dir: directory containing the conversion output
+        :param filenames: names of the files in output_dir to store
+        :param reports: the logging level and text of each message logged
+            by the conversion
+        """
+        entry = self.cache_dir / key
+        if entry.is_dir():
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            temp_dir = pathlib.Path(tempfile.mkdtemp(dir=self.cache_dir))
+        except OSError as error:
+            LOGGER.debug(f"Not caching conversion {key[:12]}: {error}")
+            return
+        try:
+            for filename in filenames:
+                shutil.copy2(output_dir / filename, temp_dir / filename)
+            with open(temp_dir / REPORTS_FILENAME, "w") as fh:
+                json.dump(list(reports), fh)
+            temp_dir.rename(entry)
+        except OSError as error:
+            # Another process may have stored the same entry in the
+            # meantime, or the cache may be unwritable; neither should
+            # cause the conversion itself to fail.
+            LOGGER.debug(f"Not caching conversion {key[:12]}: {error}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
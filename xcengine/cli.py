@@ -4,15 +4,24 @@
 # Permissions are hereby granted under the terms of the MIT License:
 # https://opensource.org/licenses/MIT.
 
+import contextlib
 import logging
 import os
 import pathlib
 import subprocess
 import tempfile
+from typing import TYPE_CHECKING
 
 import click
 
-from .core import ScriptCreator, ImageBuilder, ContainerRunner
+from . import util
+
+# xcengine.core and its dependencies are only imported by the subcommands
+# which need them, to keep the start-up time of xcetool low.
+if TYPE_CHECKING:
+    from .core import ConversionResult
+
+LOGGER = logging.getLogger(__name__)
 
 
 @click.group(
@@ -21,6 +30,7 @@ from .core import ScriptCreator, ImageBuilder, ContainerRunner
 )
 @click.option("-v", "--verbose", count=True)
 def cli(verbose):
+    logging.basicConfig(level=logging.INFO)
     if verbose > 0:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -57,6 +67,286 @@ keep_option = click.option(
     help="Keep container after it has finished running.",
 )
 
+script_options = [
+    click.option(
+        "--only",
+        multiple=True,
+        metavar="DATASET",
+        help="Only compute and output the specified dataset, executing "
+        "just the notebook code needed for it. May be repeated.",
+    ),
+    click.option(
+        "--parallel",
+        is_flag=True,
+        help="Execute notebook cells which don't depend on each other "
+        "concurrently, in a thread pool.",
+    ),
+    click.option(
+        "--output-encoding",
+        type=click.Path(
+            path_type=pathlib.Path, dir_okay=False, file_okay=True, exists=True
+        ),
+        metavar="FILE",
+        help="YAML file specifying the Zarr chunking, compression, filters "
+        "and fill values of the batch output datasets.",
+    ),
+    click.option(
+        "--chunk-size",
+        metavar="SIZE",
+        help="Target size of the chunks of batch output variables, e.g. "
+        "64MiB. By default, this is 64MiB, or less if the container's "
+        "memory limit is too low to hold several such chunks per CPU. "
+        "Variables whose chunks are much smaller or larger are rechunked. "
+        "0 keeps the datasets' chunks.",
+    ),
+    click.option(
+        "--access-pattern",
+        type=click.Choice(["map", "timeseries"]),
+        help="Whether batch outputs will mostly be read as maps (the "
+        "default) or as time series. Determines how rechunked outputs "
+        "are chunked along their time dimension.",
+    ),
+    click.option(
+        "--shard-size",
+        metavar="SIZE",
+        help="Write batch outputs in Zarr format 3 with sharding, in "
+        "shards of about SIZE (e.g. 1GiB), each holding chunks of about "
+        "--chunk-size. This reduces the number of files for outputs with "
+        "many chunks.",
+    ),
+    click.option(
+        "--stream-dim",
+        metavar="DIM",
+        help="Compute and write batch outputs with dimension DIM (usually "
+        "time) one slab along it at a time, so that they need not fit "
+        "into memory.",
+    ),
+    click.option(
+        "--stream-memory",
+        metavar="SIZE",
+        help="Approximate memory limit for writing a slab with "
+        "--stream-dim (default: 2GiB, or half the container's memory "
+        "limit if that is lower).",
+    ),
+    click.option(
+        "--resume",
+        is_flag=True,
+        help="Resume an interrupted batch run whose partial output is in "
+        "the output directory, writing only the datasets (or, with "
+        "--stream-dim, the slabs) which are not yet complete.",
+    ),
+    click.option(
+        "--append-dim",
+        metavar="DIM",
+        help="Append only the new steps along DIM (usually time) to the "
+        "batch outputs already in the output directory, instead of "
+        "rewriting them.",
+    ),
+    click.option(
+        "--dask-cluster",
+        is_flag=True,
+        help="Run Dask computations on a local cluster of worker "
+        "processes, which spill data to disk when their memory runs low "
+        "instead of crashing. Implied by the other --dask-* options.",
+    ),
+    click.option(
+        "--dask-workers",
+        type=click.IntRange(min=1),
+        metavar="N",
+        help="Number of Dask workers (default: depends on the CPUs).",
+    ),
+    click.option(
+        "--dask-threads-per-worker",
+        type=click.IntRange(min=1),
+        metavar="N",
+        help="Number of threads per Dask worker.",
+    ),
+    click.option(
+        "--dask-memory-limit",
+        metavar="SIZE",
+        help="Memory limit per Dask worker, e.g. 4GiB (default: an equal "
+        "share of the memory).",
+    ),
+    click.option(
+        "--dask-spill-dir",
+        metavar="DIR",
+        help="Directory for data spilled by Dask workers. For images, "
+        "this is a path in the container.",
+    ),
+    click.option(
+        "--dask-dashboard-port",
+        type=click.IntRange(min=1, max=65535),
+        metavar="PORT",
+        help="Serve the Dask dashboard on this port. For images, the "
+        "port is published on the host.",
+    ),
+]
+
+
+def script_options_decorator(func):
+    """Add the options which are passed through to execute.py"""
+    for option in reversed(script_options):
+        func = option(func)
+    return func
+
+
+def make_script_args(
+    only: tuple[str, ...] = (),
+    parallel: bool = False,
+    output_encoding: pathlib.PurePath | None = None,
+    chunk_size: str | None = None,
+    access_pattern: str | None = None,
+    shard_size: str | None = None,
+    stream_dim: str | None = None,
+    stream_memory: str | None = None,
+    resume: bool = False,
+    append_dim: str | None = None,
+    **dask_options,
+) -> list[str]:
+    """Translate options for execute.py into its command-line arguments"""
+    return (
+        [arg for dataset in only for arg in ("--only", dataset)]
+        + (["--parallel"] if parallel else [])
+        + (
+            ["--output-encoding", str(output_encoding)]
+            if output_encoding
+            else []
+        )
+        + (["--chunk-size", chunk_size] if chunk_size is not None else [])
+        + (["--access-pattern", access_pattern] if access_pattern else [])
+        + (["--shard-size", shard_size] if shard_size else [])
+        + (["--stream-dim", stream_dim] if stream_dim else [])
+        + (["--stream-memory", stream_memory] if stream_memory else [])
+        + (["--resume"] if resume else [])
+        + (["--append-dim", append_dim] if append_dim else [])
+        + [
+            arg
+            for name, value in dask_options.items()
+            if value not in (None, False)
+            for arg in (
+                ["--" + name.replace("_", "-")]
+                + ([] if value is True else [str(value)])
+            )
+        ]
+    )
+
+
+def make_container_script_args(
+    output_dir: pathlib.Path | None = None,
+    from_saved: bool = False,
+    **script_opts,
+) -> tuple[list[str], dict]:
+    """Translate options for execute.py for running it in a container
+
+    Files given as options are copied into the container, so their paths
+    are replaced with the paths of the copies. When resuming or
+    appending, the parts of the existing output needed to do so are
+    copied; when resuming and serving the saved outputs, all of the
+    existing output is copied, since the server needs it.
+
+    :param output_dir: the host directory which the container's output
+        is copied to
+    :param from_saved: whether the saved outputs will be served
+    :return: the command-line arguments, and the files to copy, mapping
+        paths relative to the container's home directory to host paths
+    """
+    from .core import (
+        CONTAINER_HOME,
+        ArchiveSource,
+        old_chunk_filter,
+        resume_filter,
+    )
+
+    files = {}
+    if output_dir and output_dir.is_dir():
+        if script_opts.get("resume"):
+            files["output"] = (
+                output_dir
+                if from_saved
+                else ArchiveSource(output_dir, resume_filter(output_dir))
+            )
+        elif append_dim := script_opts.get("append_dim"):
+            files["output"] = ArchiveSource(
+                output_dir, old_chunk_filter(output_dir, append_dim)
+            )
+    if output_encoding := script_opts.get("output_encoding"):
+        files["output-encoding.yaml"] = output_encoding
+        script_opts["output_encoding"] = pathlib.PurePosixPath(
+            CONTAINER_HOME, "output-encoding.yaml"
+        )
+    return make_script_args(**script_opts), files
+
+
+def container_ports(
+    dask_dashboard_port: int | None = None, **script_opts
+) -> dict[int, int]:
+    """Determine the container ports to publish for execute.py options"""
+    return (
+        {dask_dashboard_port: dask_dashboard_port}
+        if dask_dashboard_port
+        else {}
+    )
+
+
+no_cache_option = click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Always convert the notebook, even if a cached conversion exists",
+)
+
+keep_display_cells_option = click.option(
+    "--keep-display-cells",
+    is_flag=True,
+    help="Keep code cells whose only effect is to display output "
+    "(e.g. plots). By default, such cells are omitted from the script.",
+)
+
+nbconvert_option = click.option(
+    "--nbconvert",
+    is_flag=True,
+    help="Use nbconvert to convert the notebook to Python, instead of the "
+    "faster built-in converter.",
+)
+
+lint_option = click.option(
+    "--lint",
+    is_flag=True,
+    help="Check the notebook for performance problems before converting "
+    "it, and log a warning for each one found (see 'xcetool lint').",
+)
+
+execute_parameters_option = click.option(
+    "--execute-parameters",
+    is_flag=True,
+    help="If the parameters can't be determined from the parameters cell "
+    "without running it, run the cell on this machine to determine them. "
+    "The cell is not sandboxed, so only use this for trusted notebooks. "
+    "By default, conversion fails in this case.",
+)
+
+jobs_option = click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of notebooks to convert in parallel when converting "
+    "several. Defaults to the number of CPUs.",
+)
+
+notebooks_argument = click.argument(
+    "notebook",
+    type=click.Path(path_type=pathlib.Path),
+    metavar="NOTEBOOK",
+)
+
+watch_option = click.option(
+    "-w",
+    "--watch",
+    is_flag=True,
+    help="Keep watching the notebook and regenerate the output whenever it "
+    "changes. Cannot be combined with --server.",
+)
+
 notebook_argument = click.argument(
     "notebook",
     type=click.Path(
@@ -65,7 +355,13 @@ notebook_argument = click.argument(
 )
 
 
-@cli.command(help="Create a compute engine script on the host system")
+@cli.command(
+    help="Create a compute engine script on the host system. NOTEBOOK may "
+    "also be a directory or a glob pattern, in which case a script "
+    "is created in a subdirectory of OUTPUT_DIR for each notebook, or a "
+    "pipeline definition file (.yaml), in which case a single script "
+    "running all the pipeline's notebooks is created."
+)
 @batch_option
 @server_option
 @from_saved_option
@@ -75,7 +371,15 @@ notebook_argument = click.argument(
     is_flag=True,
     help="Clear output directory before writing to it",
 )
-@notebook_argument
+@script_options_decorator
+@no_cache_option
+@keep_display_cells_option
+@nbconvert_option
+@lint_option
+@execute_parameters_option
+@watch_option
+@jobs_option
+@notebooks_argument
 @click.argument(
     "output_dir",
     type=click.Path(path_type=pathlib.Path, dir_okay=True, file_okay=False),
@@ -85,22 +389,120 @@ def make_script(
     server: bool,
     from_saved: bool,
     clear: bool,
+    no_cache: bool,
+    keep_display_cells: bool,
+    nbconvert: bool,
+    lint: bool,
+    execute_parameters: bool,
+    watch: bool,
+    jobs: int | None,
     notebook: pathlib.Path,
     output_dir: pathlib.Path,
+    **script_opts,
 ) -> None:
-    script_creator = ScriptCreator(notebook)
+    from .core import convert_notebooks, make_script_creator
+
+    if watch and server:
+        raise click.UsageError("--watch cannot be used with --server.")
+    notebooks = _find_notebooks(notebook)
+    # For a directory or glob pattern, each notebook gets its own
+    # subdirectory, however many there are.
+    if not notebook.is_file():
+        if batch or server or watch:
+            raise click.UsageError(
+                "--batch, --server, and --watch can only be used "
+                "with a single notebook file."
+            )
+        _report_conversions(
+            convert_notebooks(
+                notebooks,
+                output_dir,
+                jobs,
+                clear_output=clear,
+                use_cache=not no_cache,
+                drop_display_cells=not keep_display_cells,
+                use_nbconvert=nbconvert,
+                lint=lint,
+                execute_parameters=execute_parameters,
+            )
+        )
+        return
+    notebook = notebooks[0]
+    script_creator = make_script_creator(
+        notebook, not keep_display_cells, nbconvert, lint, execute_parameters
+    )
     script_creator.convert_notebook_to_script(
-        output_dir=output_dir, clear_output=clear
+        output_dir=output_dir, clear_output=clear, use_cache=not no_cache
     )
+    args = ["python3", output_dir / "execute.py"]
+    if batch:
+        args.append("--batch")
+    if server:
+        args.append("--server")
+    if from_saved:
+        args.append("--from-saved")
+    args += make_script_args(**script_opts)
     if batch or server:
-        args = ["python3", output_dir / "execute.py"]
-        if batch:
-            args.append("--batch")
-        if server:
-            args.append("--server")
-        if from_saved:
-            args.append("--from-saved")
         subprocess.run(args)
+    if watch:
+        watcher = util.FileWatcher(script_creator.input_paths())
+        LOGGER.info(f"Watching {notebook} for changes...")
+        with _exit_on_interrupt():
+            while True:
+                watcher.wait()
+                try:
+                    changed = make_script_creator(
+                        notebook,
+                        not keep_display_cells,
+                        nbconvert,
+                        lint,
+                        execute_parameters,
+                    ).update_script(output_dir, use_cache=not no_cache)
+                except Exception as error:
+                    LOGGER.error(f"Conversion failed: {error}")
+                    continue
+                LOGGER.info(
+                    f"Updated: {', '.join(changed)}"
+                    if changed
+                    else "Generated files unchanged."
+                )
+                if changed and batch:
+                    subprocess.run(args)
+
+
+def _find_notebooks(spec: pathlib.Path) -> list[pathlib.Path]:
+    from .core import find_notebooks
+
+    if not (notebooks := find_notebooks(spec)):
+        raise click.BadParameter(
+            f"No notebooks found at {spec}", param_hint="NOTEBOOK"
+        )
+    return notebooks
+
+
+def _report_conversions(results: list["ConversionResult"]) -> None:
+    for result in results:
+        status = "FAILED" if result.error else "ok"
+        click.echo(
+            f"{status:<6} {result.seconds:8.2f} s  {result.notebook}"
+            + (f": {result.error}" if result.error else "")
+        )
+    failures = sum(1 for r in results if r.error)
+    total = sum(r.seconds for r in results)
+    click.echo(
+        f"Converted {len(results) - failures} of {len(results)} notebooks "
+        f"({total:.2f} s total conversion time)."
+    )
+    if failures:
+        raise click.exceptions.Exit(1)
+
+
+@contextlib.contextmanager
+def _exit_on_interrupt():
+    try:
+        yield
+    except KeyboardInterrupt:
+        LOGGER.info("Stopped watching.")
 
 
 @cli.group(name="image", help="Build and run compute engine container images")
@@ -109,7 +511,9 @@ def image_cli():
 
 
 @image_cli.command(
-    help="Build, and optionally run, a compute engine as a Docker image"
+    help="Build, and optionally run, a compute engine as a Docker image. "
+    "NOTEBOOK may also be a pipeline definition file (.yaml), in which "
+    "case all the pipeline's notebooks are built into one image."
 )
 @batch_option
 @server_option
@@ -138,6 +542,13 @@ def image_cli():
     help="Tag to apply to the Docker image. "
     "If not specified, a timestamp-based tag will be generated automatically",
 )
+@script_options_decorator
+@no_cache_option
+@keep_display_cells_option
+@nbconvert_option
+@lint_option
+@execute_parameters_option
+@watch_option
 @notebook_argument
 def build(
     batch: bool,
@@ -149,23 +560,60 @@ def build(
     output: pathlib.Path,
     environment: pathlib.Path,
     tag: str,
+    no_cache: bool,
+    keep_display_cells: bool,
+    nbconvert: bool,
+    lint: bool,
+    execute_parameters: bool,
+    watch: bool,
+    **script_opts,
 ) -> None:
+    from .core import ImageBuilder
+
+    if watch and server:
+        raise click.UsageError("--watch cannot be used with --server.")
     init_args = dict(
-        notebook=notebook, output_dir=output, environment=environment, tag=tag
+        notebook=notebook,
+        output_dir=output,
+        environment=environment,
+        tag=tag,
+        use_cache=not no_cache,
+        drop_display_cells=not keep_display_cells,
+        use_nbconvert=nbconvert,
+        lint=lint,
+        execute_parameters=execute_parameters,
+    )
+    script_args, script_files = make_container_script_args(
+        output, from_saved and server, **script_opts
     )
     build_args = dict(
-        run_batch=batch, run_server=server, from_saved=from_saved, keep=keep
+        run_batch=batch,
+        run_server=server,
+        from_saved=from_saved,
+        keep=keep,
+        script_args=script_args,
+        script_files=script_files,
+        ports=container_ports(**script_opts),
     )
+
+    def build_or_watch(image_builder: "ImageBuilder"):
+        if watch:
+            with _exit_on_interrupt():
+                del build_args["run_server"]
+                image_builder.watch(**build_args)
+        else:
+            image_builder.build(**build_args)
+
     if build_dir:
         image_builder = ImageBuilder(build_dir=build_dir, **init_args)
         os.makedirs(build_dir, exist_ok=True)
-        image_builder.build(**build_args)
+        build_or_watch(image_builder)
     else:
         with tempfile.TemporaryDirectory() as temp_dir:
             image_builder = ImageBuilder(
                 build_dir=pathlib.Path(temp_dir), **init_args
             )
-            image_builder.build(**build_args)
+            build_or_watch(image_builder)
 
 
 @image_cli.command(help="Run a compute engine image as a Docker container")
@@ -174,6 +622,7 @@ def build(
 @from_saved_option
 @output_option
 @keep_option
+@script_options_decorator
 @click.argument("image", type=str)
 def run(
     batch: bool,
@@ -182,18 +631,87 @@ def run(
     keep: bool,
     image: str,
     output: pathlib.Path,
+    **script_opts,
 ) -> None:
+    from .core import ContainerRunner
+
     runner = ContainerRunner(image=image, output_dir=output)
+    script_args, script_files = make_container_script_args(
+        output, from_saved and server, **script_opts
+    )
     runner.run(
-        run_batch=batch, run_server=server, from_saved=from_saved, keep=keep
+        run_batch=batch,
+        run_server=server,
+        from_saved=from_saved,
+        keep=keep,
+        script_args=script_args,
+        script_files=script_files,
+        ports=container_ports(**script_opts),
     )
 
 
-@cli.command(help="Create an Earth Observation Application Package")
-@notebook_argument
-def eoap(notebook: pathlib.Path) -> None:
-    script_creator = ScriptCreator(notebook)
-    script_creator.write_cwl()
+@cli.command(
+    help="Create an Earth Observation Application Package. NOTEBOOK may "
+    "also be a directory or a glob pattern, in which case --output-dir "
+    "is required and a CWL file is written to it for each notebook."
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    type=click.Path(path_type=pathlib.Path, dir_okay=True, file_okay=False),
+    help="Write CWL files to this directory instead of standard output.",
+)
+@execute_parameters_option
+@jobs_option
+@notebooks_argument
+def eoap(
+    output_dir: pathlib.Path | None,
+    execute_parameters: bool,
+    jobs: int | None,
+    notebook: pathlib.Path,
+) -> None:
+    from .core import ScriptCreator, convert_notebooks
+
+    notebooks = _find_notebooks(notebook)
+    if output_dir is None:
+        if not notebook.is_file():
+            raise click.UsageError(
+                "--output-dir is required for a directory or glob pattern."
+            )
+        ScriptCreator(
+            notebooks[0], execute_parameters=execute_parameters
+        ).write_cwl()
+    else:
+        _report_conversions(
+            convert_notebooks(
+                notebooks,
+                output_dir,
+                jobs,
+                cwl=True,
+                execute_parameters=execute_parameters,
+            )
+        )
+
+
+@cli.command(
+    help="Check notebooks for code patterns which are likely to make them "
+    "slow or memory-hungry when run headlessly, such as loading whole "
+    "datasets into memory, Python loops over dimensions, or opening data "
+    "without restricting it to a region of interest. NOTEBOOK may also be "
+    "a directory or a glob pattern. Append '# noqa' to a line to suppress "
+    "warnings about it. Exits with status 1 if any problems were found."
+)
+@notebooks_argument
+def lint(notebook: pathlib.Path) -> None:
+    from .core import ScriptCreator
+
+    problems = 0
+    for path in _find_notebooks(notebook):
+        for finding in ScriptCreator(path).lint_notebook():
+            click.echo(f"{path}: {finding}")
+            problems += 1
+    if problems:
+        raise click.exceptions.Exit(1)
 
 
 if __name__ == "__main__":
@@ -2,54 +2,324 @@
 # Permissions are hereby granted under the terms of the MIT License:
 # https://opensource.org/licenses/MIT.
 
+import collections
+import concurrent.futures
+import glob
 import io
 import json
+import mmap
+import py_compile
+import re
 import shutil
 import sys
 import tarfile
 import subprocess
+import tempfile
 import logging
 import pathlib
 import textwrap
 import time
 import uuid
 from datetime import datetime
-from collections.abc import Mapping, Generator
-
-import docker
-from docker.errors import BuildError
-from docker.models.containers import Container
-from docker.models.images import Image
-import nbconvert
-import nbformat
+from collections.abc import Callable, Mapping, Generator, Sequence
+from typing import BinaryIO, NamedTuple, TYPE_CHECKING
+
 import yaml
 
-from xcengine import util
+import xcengine
+from xcengine import analysis, util
+from xcengine.cache import ConversionCache
+from xcengine.lint import Finding, lint_cells
+from xcengine.magics import MagicsProcessor
 from xcengine.parameters import NotebookParameters
+from xcengine.runner import make_run_module
+
+# The Docker SDK and nbformat are slow to import and only needed for some
+# operations, so they are imported where they are used.
+if TYPE_CHECKING:
+    import docker
+    from docker.models.containers import Container
+    from docker.models.images import Image
+
+    # xcengine.pipeline imports this module, so it can't be imported here.
+    from xcengine.pipeline import PipelineCreator
 
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+# Home directory of the user running the compute engine script in a
+# container; the script and its outputs are stored here.
+CONTAINER_HOME = "/home/mambauser"
+
+# Name of the journal which execute.py writes in its output directory
+JOURNAL_FILENAME = "xcengine-journal.jsonl"
+
+# Names of the files holding the metadata of Zarr groups and arrays
+ZARR_METADATA_FILES = {
+    ".zarray",
+    ".zattrs",
+    ".zgroup",
+    ".zmetadata",
+    "zarr.json",
+}
+
+# Sources of the xcengine modules which produce the conversion output. They
+# are part of the conversion cache key, so that editing them in a
+# development checkout doesn't serve stale cached scripts.
+CONVERSION_SOURCES = tuple(
+    pathlib.Path(__file__).parent / name
+    for name in (
+        "analysis.py",
+        "core.py",
+        "magics.py",
+        "parameters.py",
+        "runner.py",
+        "wrapper.py",
+    )
+)
+
+
+class NotebookNode(dict):
+    """A dictionary whose items can also be accessed as attributes
+
+    This mirrors nbformat.NotebookNode, so that notebooks can be read
+    and processed without importing nbformat.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def read_notebook(nb_path: pathlib.Path) -> NotebookNode:
+    """Read the parts of a notebook needed for conversion
+
+    Cell outputs and attachments, which can make up almost all of a
+    notebook's size, are skipped over in a memory-mapped view of the
+    file before it is parsed, so they are never decoded or held in memory.
+    The notebook is not validated against the nbformat schema. Notebooks
+    in formats older than version 4 are read and converted by nbformat.
+
+    :param nb_path: path to a notebook file
+    :return: the notebook, with empty outputs and no attachments
+    """
+
+    def strip(obj: dict) -> dict:
+        if "cell_type" in obj:
+            if not obj.get("attachments", True):
+                del obj["attachments"]
+            if isinstance(source := obj.get("source"), list):
+                obj["source"] = "".join(source)
+        return obj
+
+    with (
+        open(nb_path, "rb") as fh,
+        mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        notebook = json.loads(
+            _skip_json_values(data),
+            object_hook=lambda obj: NotebookNode(strip(obj)),
+        )
+    if notebook.get("nbformat", 4) < 4:
+        import nbformat
+
+        with open(nb_path) as fh:
+            notebook = nbformat.read(fh, as_version=4)
+    return notebook
+
+
+_SKIPPED_KEY = re.compile(rb'"(outputs|attachments)"\s*:\s*[\[{]')
+_STRUCTURAL = re.compile(rb'[\[\]{}"]')
+
+
+def _skip_json_values(data: bytes | mmap.mmap) -> bytes:
+    """Replace all "outputs" and "attachments" values with empty ones"""
+    parts = []
+    position = 0
+    while match := _SKIPPED_KEY.search(data, position):
+        parts.append(data[position : match.end()])
+        closing = b"]" if data[match.end() - 1] == ord("[") else b"}"
+        position, depth = match.end(), 1
+        while depth > 0:
+            if not (token := _STRUCTURAL.search(data, position)):
+                raise ValueError("Unterminated JSON array or object")
+            position = token.end()
+            if token.group() == b'"':
+                position = _string_end(data, position)
+            else:
+                depth += 1 if token.group() in (b"[", b"{") else -1
+        parts.append(closing)
+    parts.append(data[position:])
+    return b"".join(parts)
+
+
+def _string_end(data: bytes | mmap.mmap, position: int) -> int:
+    """Return the position after the end of a JSON string's content"""
+    # Searching for the closing quote with find() rather than a regular
+    # expression makes skipping long strings (e.g. base64 images) fast.
+    while True:
+        end = data.find(b'"', position)
+        if end < 0:
+            raise ValueError("Unterminated JSON string")
+        backslashes = 0
+        while data[end - 1 - backslashes] == ord("\\"):
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+        position = end + 1
 
 
 class ScriptCreator:
     """Turn a Jupyter notebook into a set of scripts"""
 
-    notebook: nbformat.NotebookNode
-    nb_params: NotebookParameters
+    nb_path: pathlib.Path
+    _notebook: NotebookNode | None
+    _nb_params: NotebookParameters | None
+    magics: MagicsProcessor
+    reports: list[tuple[int, str]]
 
-    def __init__(self, nb_path: pathlib.Path):
-        with open(nb_path) as fh:
-            self.notebook = nbformat.read(fh, as_version=4)
-        self.process_params_cell()
+    def __init__(
+        self,
+        nb_path: pathlib.Path,
+        drop_display_cells: bool = True,
+        use_nbconvert: bool = False,
+        lint: bool = False,
+        execute_parameters: bool = False,
+    ):
+        """Create a script creator for a notebook
+
+        :param nb_path: path of the notebook to convert
+        :param drop_display_cells: if True, omit code cells from the
+            generated script if their only effect is to display something
+            (e.g. plots or bare expressions), since their output would be
+            discarded in a headless run anyway
+        :param use_nbconvert: if True, use nbconvert's PythonExporter
+            instead of the built-in ScriptExporter
+        :param lint: if True, check the notebook for performance problems
+            before converting it, and log a warning for each one found
+        :param execute_parameters: if True, execute the parameters cell
+            (without a sandbox) if its parameters can't be determined
+            statically; otherwise, fail in that case
+        """
+        self.nb_path = nb_path
+        self.drop_display_cells = drop_display_cells
+        self.use_nbconvert = use_nbconvert
+        self.lint = lint
+        self.execute_parameters = execute_parameters
+        self._notebook = None
+        self._nb_params = None
+        self._set_params_index = None
+        # Messages logged during conversion, as (level, text) tuples. They
+        # are stored with cached conversions and repeated when those are
+        # reused, since the notebook isn't processed then.
+        self.reports = []
+
+    @property
+    def notebook(self) -> NotebookNode:
+        # The notebook is only read when first needed, so that conversions
+        # satisfied from the cache don't have to parse it at all.
+        if self._notebook is None:
+            self._notebook = read_notebook(self.nb_path)
+            self.process_params_cell()
+            self.process_magics()
+            if self.drop_display_cells:
+                self.remove_display_cells()
+        return self._notebook
+
+    @property
+    def nb_params(self) -> NotebookParameters:
+        _ = self.notebook  # Reading the notebook also sets the parameters.
+        return self._nb_params
+
+    def input_paths(self) -> list[pathlib.Path]:
+        return [self.nb_path]
+
+    def cache_key(self) -> str:
+        return ConversionCache.key(
+            self.nb_path,
+            *CONVERSION_SOURCES,
+            xcengine.__version__,
+            repr(
+                dict(
+                    drop_display_cells=self.drop_display_cells,
+                    use_nbconvert=self.use_nbconvert,
+                    execute_parameters=self.execute_parameters,
+                )
+            ),
+        )
 
     def convert_notebook_to_script(
-        self, output_dir: pathlib.Path, clear_output=False
+        self,
+        output_dir: pathlib.Path,
+        clear_output: bool = False,
+        use_cache: bool = True,
     ) -> None:
         output_dir.mkdir(parents=True, exist_ok=True)
         if clear_output:
             util.clear_directory(output_dir)
-        exporter = nbconvert.PythonExporter()
-        (body, resources) = exporter.from_notebook_node(self.notebook)
+        if self.lint:
+            for finding in self.lint_notebook():
+                LOGGER.warning(f"{self.nb_path}: {finding}")
+        if not use_cache:
+            self.write_script_files(output_dir)
+            return
+        cache = ConversionCache()
+        if cache.get(key := self.cache_key(), output_dir):
+            for level, message in cache.reports(key):
+                LOGGER.log(level, message)
+        else:
+            filenames = self.write_script_files(output_dir)
+            cache.put(key, output_dir, filenames, self.reports)
+
+    def _report(self, level: int, message: str) -> None:
+        LOGGER.log(level, message)
+        self.reports.append((level, message))
+
+    def lint_notebook(self) -> list[Finding]:
+        """Check the notebook's code cells for performance problems
+
+        :return: the problems found, with cell indices and line numbers
+            referring to the notebook as saved
+        """
+        # The notebook is read again, since the copy in self.notebook has
+        # been modified for conversion.
+        return lint_cells(
+            (i, cell.source)
+            for i, cell in enumerate(read_notebook(self.nb_path).cells)
+            if cell.cell_type == "code"
+        )
+
+    def update_script(
+        self, output_dir: pathlib.Path, use_cache: bool = True
+    ) -> list[str]:
+        """Regenerate the script files, replacing only those which changed
+
+        :param output_dir: directory containing a previous conversion
+        :param use_cache: whether to use the conversion cache
+        :return: the names of the files which were replaced
+        """
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.convert_notebook_to_script(
+                pathlib.Path(temp_dir), use_cache=use_cache
+            )
+            return util.sync_files(pathlib.Path(temp_dir), output_dir)
+
+    def write_script_files(self, output_dir: pathlib.Path) -> list[str]:
+        if self.use_nbconvert:
+            import nbconvert
+            import nbformat
+
+            exporter = nbconvert.PythonExporter()
+            notebook = nbformat.from_dict(self.notebook)
+        else:
+            exporter = ScriptExporter()
+            notebook = self.notebook
+        body, resources = exporter.from_notebook_node(notebook)
         with open(output_dir / "user_code.py", "w") as fh:
             fh.write(body)
         with open(pathlib.Path(__file__).parent / "wrapper.py", "r") as fh:
@@ -57,38 +327,153 @@ class ScriptCreator:
         with open(output_dir / "execute.py", "w") as fh:
             fh.write(wrapper)
         with open(output_dir / "parameters.yaml", "w") as fh:
-            print(self.nb_params.params)
-            yaml.safe_dump(self.nb_params.params, fh)
+            fh.write(self.nb_params.to_yaml())
+        module_files = []
+        try:
+            module = make_run_module(body, self.nb_params.params)
+        except SyntaxError as error:
+            self._report(
+                logging.WARNING,
+                f"Not writing user_module.py, since the notebook code can't "
+                f"be run as a function: {error}",
+            )
+        else:
+            with open(output_dir / "user_module.py", "w") as fh:
+                fh.write(module)
+            module_files.append("user_module.py")
+        with open(output_dir / "dependencies.yaml", "w") as fh:
+            yaml.safe_dump(
+                {
+                    "conda": self.magics.conda_packages,
+                    "pip": self.magics.pip_packages,
+                },
+                fh,
+            )
+        # Precompile the user code so that the script doesn't have to parse
+        # and compile it on every run. If the script is run with a different
+        # Python version, it ignores the .pyc and compiles the source.
+        py_compile.compile(
+            str(output_dir / "user_code.py"),
+            cfile=str(output_dir / "user_code.pyc"),
+            dfile="user_code.py",
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        )
+        return [
+            "user_code.py",
+            "user_code.pyc",
+            "execute.py",
+            "parameters.yaml",
+            "dependencies.yaml",
+        ] + module_files
 
     def process_params_cell(self) -> None:
         params_cell_index = None
-        for i, cell in enumerate(self.notebook.cells):
+        for i, cell in enumerate(self._notebook.cells):
             if (
                 hasattr(md := cell.metadata, "tags")
                 and "parameters" in md.tags
             ):
                 params_cell_index = i
                 break
+        self._nb_params = NotebookParameters({})
         if params_cell_index is not None:
-            self.nb_params = NotebookParameters(
-                self.notebook.cells[params_cell_index].source
+            self._nb_params = NotebookParameters.from_code(
+                self._notebook.cells[params_cell_index].source,
+                self.execute_parameters,
             )
-            self.nb_params = NotebookParameters.from_code(
-                self.notebook.cells[params_cell_index].source
+            self._set_params_index = params_cell_index + 1
+            self._notebook.cells.insert(
+                self._set_params_index,
+                NotebookNode(
+                    {
+                        "cell_type": "code",
+                        "execution_count": 0,
+                        "id": str(uuid.uuid4()),
+                        "metadata": {},
+                        "outputs": [],
+                        "source": "__xce_set_params()",
+                    }
+                ),
             )
-            self.notebook.cells.insert(
-                params_cell_index + 1,
-                {
-                    "cell_type": "code",
-                    "execution_count": 0,
-                    "id": str(uuid.uuid4()),
-                    "metadata": {},
-                    "outputs": [],
-                    "source": "__xce_set_params()",
-                },
+
+    def original_index(self, index: int) -> int:
+        """Map the index of a cell to its index in the notebook as saved
+
+        The indices differ after the cell which process_params_cell
+        inserts after the parameters cell.
+
+        :param index: index of a cell in self.notebook, before any cells
+            were removed
+        :return: index of the cell in the notebook file
+        """
+        if self._set_params_index is not None and index > (
+            self._set_params_index
+        ):
+            return index - 1
+        return index
+
+    def process_magics(self) -> None:
+        """Rewrite IPython magics and shell escapes in the code cells
+
+        Packages installed by magics are recorded in self.magics, from
+        which write_script_files saves them to dependencies.yaml.
+        """
+        self.magics = MagicsProcessor()
+        for i, cell in enumerate(self._notebook.cells):
+            if cell.cell_type == "code":
+                cell.source = self.magics.process_cell(
+                    cell.source, self.original_index(i)
+                )
+        for index, line in self.magics.unsupported:
+            self._report(
+                logging.WARNING,
+                f"Unsupported IPython syntax in cell {index} "
+                f"will probably fail when the script is run: {line}",
+            )
+        if self.magics.conda_packages or self.magics.pip_packages:
+            self._report(
+                logging.INFO,
+                "Packages installed in notebook will be added to the "
+                "image environment: "
+                + " ".join(
+                    self.magics.conda_packages + self.magics.pip_packages
+                ),
             )
 
-    def write_cwl(self):
+    def remove_display_cells(self) -> list[int]:
+        """Remove code cells whose only effect is display
+
+        :return: the (zero-based) indices in the original notebook of the
+            cells which were removed
+        """
+        removed = []
+        kept = []
+        # If figures are saved, plotting cells contribute to the output.
+        plots = not any(
+            analysis.saves_figures(cell.source)
+            for cell in self._notebook.cells
+            if cell.cell_type == "code"
+        )
+        for i, cell in enumerate(self._notebook.cells):
+            if (
+                cell.cell_type == "code"
+                and "parameters" not in cell.metadata.get("tags", [])
+                and analysis.is_display_only(cell.source, plots)
+            ):
+                first_line = cell.source.strip().splitlines()[0]
+                index = self.original_index(i)
+                self._report(
+                    logging.INFO,
+                    f"Omitting display-only cell {index}: {first_line}",
+                )
+                removed.append(index)
+            else:
+                kept.append(cell)
+        self._notebook.cells = kept
+        return removed
+
+    def write_cwl(self, output_path: pathlib.Path | None = None) -> None:
         # TODO flesh out this skeleton
         cwl = {
             "cwlVersion": "v1.0",
@@ -132,7 +517,179 @@ class ScriptCreator:
                 },
             ],
         }
-        print(yaml.safe_dump(cwl))
+        if output_path is None:
+            print(yaml.safe_dump(cwl))
+        else:
+            with open(output_path, "w") as fh:
+                yaml.safe_dump(cwl, fh)
+
+
+class ConversionResult(NamedTuple):
+    notebook: pathlib.Path
+    output: pathlib.Path
+    seconds: float
+    error: str | None
+
+
+def make_script_creator(
+    path: pathlib.Path, *args, **kwargs
+) -> "ScriptCreator | PipelineCreator":
+    """Create a converter for a notebook or a notebook pipeline
+
+    :param path: path to a notebook, or to a pipeline definition file
+    :param args: further positional arguments for the converter
+    :param kwargs: further keyword arguments for the converter
+    :return: a PipelineCreator if the path has the suffix of a pipeline
+        definition, otherwise a ScriptCreator
+    """
+    from xcengine.pipeline import PipelineCreator, is_pipeline
+
+    if is_pipeline(path):
+        return PipelineCreator(path, *args, **kwargs)
+    return ScriptCreator(path, *args, **kwargs)
+
+
+def find_notebooks(spec: str | pathlib.Path) -> list[pathlib.Path]:
+    """Find the notebooks specified by a path or glob pattern
+
+    :param spec: a notebook file, a directory (all of whose notebooks are
+        selected), or a glob pattern (which may use ** to match
+        subdirectories recursively)
+    :return: the selected notebook paths, sorted
+    """
+    path = pathlib.Path(spec)
+    if path.is_file():
+        return [path]
+    if path.is_dir():
+        return sorted(path.glob("*.ipynb"))
+    return sorted(
+        pathlib.Path(p)
+        for p in glob.glob(str(spec), recursive=True)
+        if p.endswith(".ipynb")
+    )
+
+
+def convert_notebooks(
+    notebooks: Sequence[pathlib.Path],
+    output_dir: pathlib.Path,
+    jobs: int | None = None,
+    cwl: bool = False,
+    clear_output: bool = False,
+    use_cache: bool = True,
+    **options,
+) -> list[ConversionResult]:
+    """Convert several notebooks, in parallel if requested
+
+    Each notebook is converted into its own subdirectory of output_dir
+    (or, for CWL, its own file), named after the notebook. Failures are
+    recorded in the results rather than raised, so that one broken
+    notebook doesn't prevent the others from being converted.
+
+    :param notebooks: the notebooks to convert
+    :param output_dir: parent directory for the conversion outputs
+    :param jobs: maximum number of worker processes; if None, use the
+        number of CPUs
+    :param cwl: if True, write a CWL file for each notebook instead of
+        a script directory
+    :param clear_output: clear each script directory before writing to it
+    :param use_cache: whether to use the conversion cache
+    :param options: further keyword arguments for ScriptCreator
+    :return: a result for each notebook, in the order given
+    """
+    names = collections.Counter()
+    outputs = []
+    for notebook in notebooks:
+        names[notebook.stem] += 1
+        count = names[notebook.stem]
+        name = notebook.stem + (f"_{count}" if count > 1 else "")
+        outputs.append(output_dir / (name + (".cwl" if cwl else "")))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    convert_options = dict(clear_output=clear_output, use_cache=use_cache)
+    tasks = [
+        (n, o, cwl, options, convert_options)
+        for n, o in zip(notebooks, outputs)
+    ]
+    if jobs == 1 or len(tasks) == 1:
+        return [_convert_one(*task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(_convert_one, *zip(*tasks)))
+
+
+def _convert_one(
+    notebook: pathlib.Path,
+    output: pathlib.Path,
+    cwl: bool,
+    options: dict,
+    convert_options: dict,
+) -> ConversionResult:
+    start = time.perf_counter()
+    try:
+        script_creator = ScriptCreator(notebook, **options)
+        if cwl:
+            script_creator.write_cwl(output)
+        else:
+            script_creator.convert_notebook_to_script(
+                output, **convert_options
+            )
+        error = None
+    except Exception as e:
+        LOGGER.error(f"Converting {notebook} failed: {e}")
+        error = f"{type(e).__name__}: {e}"
+    return ConversionResult(
+        notebook, output, time.perf_counter() - start, error
+    )
+
+
+class ScriptExporter:
+    """Converts a notebook to a Python script
+
+    This is a lightweight alternative to nbconvert's PythonExporter,
+    producing similar output. Code cells are copied verbatim, except for
+    cells containing IPython-specific syntax, which are translated by
+    IPython's input transformer. Markdown cells become comments.
+    """
+
+    # Matches lines which may contain magics, shell escapes, or help
+    # syntax. False positives are harmless, since they only cause a cell
+    # to be passed through the transformer unnecessarily.
+    ipython_syntax = re.compile(r"^\s*[%!?]|=\s*[%!]|\?\s*$", re.MULTILINE)
+
+    def __init__(self):
+        self._transformer = None
+
+    def from_notebook_node(self, notebook: NotebookNode) -> tuple[str, dict]:
+        """Convert a notebook to a Python script
+
+        :param notebook: the notebook to convert
+        :return: a tuple of the script and an (empty) resources dictionary,
+            for compatibility with nbconvert exporters
+        """
+        parts = ["#!/usr/bin/env python\n# coding: utf-8\n\n"]
+        for cell in notebook.cells:
+            match cell.cell_type:
+                case "code":
+                    count = cell.get("execution_count") or " "
+                    parts.append(
+                        f"# In[{count}]:\n\n\n"
+                        f"{self.transform(cell.source)}\n\n\n"
+                    )
+                case "markdown":
+                    parts.append(
+                        "".join(
+                            f"# {line}\n" for line in cell.source.split("\n")
+                        )
+                        + "\n"
+                    )
+        return "".join(parts).rstrip() + "\n", {}
+
+    def transform(self, source: str) -> str:
+        if not self.ipython_syntax.search(source):
+            return source.rstrip()
+        if self._transformer is None:
+            from IPython.core.inputtransformer2 import TransformerManager
+
+            self._transformer = TransformerManager()
+        return self._transformer.transform_cell(source).rstrip()
 
 
 class ImageBuilder:
@@ -149,12 +706,31 @@ class ImageBuilder:
         environment: pathlib.Path,
         build_dir: pathlib.Path,
         tag: str,
+        use_cache: bool = True,
+        drop_display_cells: bool = True,
+        use_nbconvert: bool = False,
+        lint: bool = False,
+        execute_parameters: bool = False,
     ):
         self.notebook = notebook
         self.output_dir = output_dir
         self.environment = environment
         self.build_dir = build_dir
         self.tag = tag
+        self.use_cache = use_cache
+        self.drop_display_cells = drop_display_cells
+        self.use_nbconvert = use_nbconvert
+        self.lint = lint
+        self.execute_parameters = execute_parameters
+
+    def script_creator(self) -> "ScriptCreator | PipelineCreator":
+        return make_script_creator(
+            self.notebook,
+            self.drop_display_cells,
+            self.use_nbconvert,
+            self.lint,
+            self.execute_parameters,
+        )
 
     def build(
         self,
@@ -162,9 +738,29 @@ class ImageBuilder:
         run_server: bool,
         from_saved: bool,
         keep: bool,
-    ) -> None:
-        script_creator = ScriptCreator(self.notebook)
-        script_creator.convert_notebook_to_script(self.build_dir)
+        **run_options,
+    ) -> "Image":
+        """Build an image, and optionally run it
+
+        :param run_batch: whether to run the image in batch mode
+        :param run_server: whether to run the image in server mode
+        :param from_saved: whether to serve the saved datasets
+        :param keep: whether to keep the container after it has finished
+        :param run_options: further keyword arguments for
+            ContainerRunner.run
+        :return: the image
+        """
+        self.script_creator().convert_notebook_to_script(
+            self.build_dir, use_cache=self.use_cache
+        )
+        self.write_environment()
+        image = self.build_image()
+        if run_batch or run_server:
+            runner = ContainerRunner(image, self.output_dir)
+            runner.run(run_batch, run_server, from_saved, keep, **run_options)
+        return image
+
+    def write_environment(self) -> None:
         if self.environment:
             shutil.copy2(self.environment, self.build_dir / "environment.yml")
         else:
@@ -173,10 +769,100 @@ class ImageBuilder:
                 f"trying to reproduce current environment in Docker image"
             )
             self.export_conda_env()
-        image: Image = self.build_image()
-        if run_batch or run_server:
-            runner = ContainerRunner(image, self.output_dir)
-            runner.run(run_batch, run_server, from_saved, keep)
+        self.add_notebook_dependencies()
+
+    def add_notebook_dependencies(self) -> None:
+        """Add packages installed by the notebook to environment.yml"""
+        deps_path = self.build_dir / "dependencies.yaml"
+        if not deps_path.is_file():
+            return
+        with open(deps_path) as fh:
+            nb_deps = yaml.safe_load(fh)
+        if not (nb_deps["conda"] or nb_deps["pip"]):
+            return
+        with open(self.build_dir / "environment.yml") as fh:
+            env_def = yaml.safe_load(fh)
+        deps: list = env_def.setdefault("dependencies", [])
+
+        def name(spec: str) -> str:
+            return re.split(r"[=<>!~ \[]", spec, maxsplit=1)[0].lower()
+
+        conda_names = {name(d) for d in deps if isinstance(d, str)}
+        deps.extend(p for p in nb_deps["conda"] if name(p) not in conda_names)
+        if nb_deps["pip"]:
+            pip_map = next(
+                (d for d in deps if isinstance(d, Mapping) and "pip" in d),
+                None,
+            )
+            if pip_map is None:
+                deps.append(pip_map := {"pip": []})
+            if "pip" not in conda_names:
+                deps.append("pip")
+            pip_names = {name(p) for p in pip_map["pip"]}
+            pip_map["pip"].extend(
+                p for p in nb_deps["pip"] if name(p) not in pip_names
+            )
+        with open(self.build_dir / "environment.yml", "w") as fh:
+            fh.write(yaml.safe_dump(env_def))
+
+    def watch(
+        self,
+        run_batch: bool,
+        from_saved: bool,
+        keep: bool,
+        interval: float = 1.0,
+        **run_options,
+    ) -> None:
+        """Build an image, then rebuild it whenever the notebook changes
+
+        The conda environment is only re-created if an explicitly
+        specified environment file changes. Otherwise, only the files
+        generated from the notebook are updated, so Docker reuses the
+        cached environment layer and only rebuilds the layers containing
+        the user code. If none of the generated files has changed (e.g.
+        because only cell outputs were modified), no rebuild is done.
+
+        This method only returns when interrupted.
+
+        :param run_batch: whether to run each image in batch mode
+        :param from_saved: whether to serve the saved datasets
+        :param keep: whether to keep the containers after they have
+            finished
+        :param interval: the interval between checks for changes, in
+            seconds
+        :param run_options: further keyword arguments for
+            ContainerRunner.run
+        """
+        self.build(run_batch, False, from_saved, keep, **run_options)
+        watched = self.script_creator().input_paths() + (
+            [self.environment] if self.environment else []
+        )
+        watcher = util.FileWatcher(watched, interval)
+        LOGGER.info(f"Watching {self.notebook} for changes...")
+        while True:
+            changed_paths = watcher.wait()
+            try:
+                changed = self.script_creator().update_script(
+                    self.build_dir, use_cache=self.use_cache
+                )
+                if (
+                    self.environment in changed_paths
+                    or "dependencies.yaml" in changed
+                ):
+                    self.write_environment()
+                    changed.append("environment.yml")
+            except Exception as error:
+                LOGGER.error(f"Conversion failed: {error}")
+                continue
+            if not changed:
+                LOGGER.info("Generated files unchanged; not rebuilding.")
+                continue
+            LOGGER.info(f"Changed: {', '.join(changed)}; rebuilding image.")
+            image = self.build_image()
+            if run_batch:
+                ContainerRunner(image, self.output_dir).run(
+                    run_batch, False, from_saved, keep, **run_options
+                )
 
     def export_conda_env(self) -> None:
         conda_process = subprocess.run(
@@ -220,19 +906,21 @@ class ImageBuilder:
         with open(self.build_dir / "environment.yml", "w") as fh:
             fh.write(yaml.safe_dump(env_def))
 
-    def build_image(self) -> docker.models.images.Image:
+    def build_image(self) -> "Image":
+        import docker
+        from docker.errors import BuildError
+
         client = docker.from_env()
-        dockerfile = textwrap.dedent(
-            """
+        dockerfile = textwrap.dedent("""
         FROM mambaorg/micromamba:1.5.10-noble-cuda-12.6.0
         COPY environment.yml environment.yml
         RUN micromamba install -y -n base -f environment.yml && \
         micromamba clean --all --yes
-        COPY user_code.py user_code.py
-        COPY execute.py execute.py
-        CMD python execute.py
-        """
-        )
+        COPY parameters.yaml parameters.yaml
+        COPY *.py ./
+        RUN python execute.py --precompile
+        CMD python execute.pyc
+        """)
         with open(self.build_dir / "Dockerfile", "w") as fh:
             fh.write(dockerfile)
         if self.tag:
@@ -259,10 +947,12 @@ class ContainerRunner:
 
     def __init__(
         self,
-        image: Image | str,
+        image: "Image | str",
         output_dir: pathlib.Path,
-        client: docker.DockerClient = None,
+        client: "docker.DockerClient" = None,
     ):
+        from docker.models.images import Image
+
         self._client = client
         match image:
             case Image():
@@ -278,27 +968,60 @@ class ContainerRunner:
     @property
     def client(self):
         if self._client is None:
+            import docker
+
             self._client = docker.from_env()
         return self._client
 
     def run(
-        self, run_batch: bool, run_server: bool, from_saved: bool, keep: bool
+        self,
+        run_batch: bool,
+        run_server: bool,
+        from_saved: bool,
+        keep: bool,
+        script_args: Sequence[str] = (),
+        script_files: (
+            Mapping[str, "pathlib.Path | ArchiveSource"] | None
+        ) = None,
+        ports: Mapping[int, int] | None = None,
     ):
+        """Run the image in a container
+
+        :param run_batch: whether to compute and save the output datasets
+        :param run_server: whether to serve the output datasets
+        :param from_saved: whether to serve the saved datasets
+        :param keep: whether to keep the container after it has finished
+        :param script_args: additional arguments for execute.py
+        :param script_files: files to copy into the container before it
+            starts, mapping paths relative to the container's home
+            directory to host paths or ArchiveSources
+        :param ports: container ports to publish in addition to the
+            server port, mapped to host ports
+        """
         LOGGER.info(f"Running container from image {self.image.short_id}")
         LOGGER.info(f"Image tags: {' '.join(self.image.tags)}")
         command = (
-            ["python", "execute.py"]
+            ["python", self.script_name()]
             + (["--batch"] if run_batch else [])
             + (["--server"] if run_server else [])
             + (["--from-saved"] if from_saved else [])
+            + list(script_args)
         )
-        container: Container = self.client.containers.run(
+        container = self.client.containers.create(
             image=self.image,
             command=command,
-            ports={"8080": 8080},
-            remove=False,
-            detach=True,
+            ports={"8080": 8080}
+            | {str(c): h for c, h in (ports or {}).items()},
         )
+        if script_files:
+            # The files may include a large output to resume, so the
+            # archive is streamed from disk rather than built in memory.
+            with tempfile.TemporaryFile() as archive:
+                self.make_archive(script_files, archive)
+                archive.seek(0)
+                container.put_archive(CONTAINER_HOME, archive)
+        container.start()
+        container.reload()
         LOGGER.info(f"Waiting for container {container.short_id} to complete.")
         while container.status in {"created", "running"}:
             LOGGER.debug(
@@ -319,6 +1042,53 @@ class ContainerRunner:
             container.remove(force=True)
             LOGGER.info(f"Container {container.short_id} removed.")
 
+    def script_name(self) -> str:
+        """Determine the file name of the script to run in the image
+
+        Images built by earlier versions of xcengine contain no
+        precompiled execute.pyc, so the script is taken from the image's
+        default command, falling back to execute.py, which every image
+        contains.
+
+        :return: the name of the script, relative to the working directory
+        """
+        config = self.image.attrs.get("Config") or {}
+        default_command = " ".join(config.get("Cmd") or [])
+        if "execute.pyc" in default_command:
+            return "execute.pyc"
+        return "execute.py"
+
+    @staticmethod
+    def make_archive(
+        files: Mapping[str, "pathlib.Path | ArchiveSource"], fileobj: BinaryIO
+    ) -> None:
+        """Pack host files into a tar archive for copying to a container
+
+        :param files: mapping from paths in the archive to host paths of
+            files or directories, or to ArchiveSources
+        :param fileobj: the file to write the archive to
+        """
+        with tarfile.open(fileobj=fileobj, mode="w") as tar_fh:
+            for name, source in files.items():
+                if not isinstance(source, ArchiveSource):
+                    source = ArchiveSource(source)
+
+                def add_member(
+                    info: tarfile.TarInfo,
+                ) -> tarfile.TarInfo | None:
+                    relative_path = pathlib.PurePosixPath(
+                        info.name
+                    ).relative_to(name)
+                    if source.exclude(source.path / relative_path):
+                        return None
+                    # The default user in micromamba images
+                    info.uid = info.gid = 57439
+                    info.uname = info.gname = "mambauser"
+                    info.mode = 0o755 if info.isdir() else 0o644
+                    return info
+
+                tar_fh.add(source.path, arcname=name, filter=add_member)
+
     @staticmethod
     def _tar_strip(member, path):
         member_1 = tarfile.data_filter(member, path)
@@ -327,13 +1097,119 @@ class ContainerRunner:
         )
         return member_2
 
-    def extract_output_from_container(self, container: Container) -> None:
-        bits, stat = container.get_archive("/home/mambauser/output")
+    def extract_output_from_container(self, container: "Container") -> None:
+        bits, stat = container.get_archive(f"{CONTAINER_HOME}/output")
         reader = io.BufferedReader(ChunkStream(bits))
         with tarfile.open(name=None, mode="r|", fileobj=reader) as tar_fh:
             tar_fh.extractall(self.output_dir, filter=self._tar_strip)
 
 
+class ArchiveSource(NamedTuple):
+    """A host file or directory to copy into a container
+
+    Files and directories for which exclude returns True are not copied.
+    """
+
+    path: pathlib.Path
+    exclude: Callable[[pathlib.Path], bool] = lambda path: False
+
+
+def old_chunk_filter(
+    output_dir: pathlib.Path, dim: str
+) -> Callable[[pathlib.Path], bool]:
+    """Make a filter for the Zarr chunks not needed to append to outputs
+
+    Appending along a dimension only needs the metadata of the output
+    Zarr stores, the coordinate of the dimension, and each array's last
+    chunk along the dimension, which may be partly filled. Leaving out the
+    other chunks makes copying the outputs into a container scale with the
+    size of a chunk rather than the size of the outputs.
+
+    :param output_dir: a directory of Zarr stores (format 2 or 3)
+    :param dim: the dimension to append along
+    :return: a function which returns True for the paths of chunks (or
+        directories of chunks) which are not needed
+    """
+    # Maps array directories to the axis of the dimension, the index of
+    # the last chunk along it, and the chunk key separator and prefix
+    arrays: dict[pathlib.Path, tuple[int, int, str, str | None]] = {}
+    for store in output_dir.glob("*.zarr"):
+        for meta_path in [*store.rglob("zarr.json"), *store.rglob(".zarray")]:
+            meta = json.loads(meta_path.read_text())
+            if meta_path.name == "zarr.json":
+                if meta.get("node_type") != "array":
+                    continue
+                dims = meta.get("dimension_names") or []
+                chunks = meta["chunk_grid"]["configuration"]["chunk_shape"]
+                key_encoding = meta.get("chunk_key_encoding", {})
+                default_keys = key_encoding.get("name", "default") == "default"
+                separator = key_encoding.get("configuration", {}).get(
+                    "separator", "/" if default_keys else "."
+                )
+                prefix = "c" if default_keys else None
+            else:
+                attrs_path = meta_path.with_name(".zattrs")
+                attrs = (
+                    json.loads(attrs_path.read_text())
+                    if attrs_path.exists()
+                    else {}
+                )
+                dims = attrs.get("_ARRAY_DIMENSIONS", [])
+                chunks = meta["chunks"]
+                separator = meta.get("dimension_separator") or "."
+                prefix = None
+            if dim not in dims or meta_path.parent.name == dim:
+                continue
+            axis = dims.index(dim)
+            last = max(0, (meta["shape"][axis] - 1) // chunks[axis])
+            arrays[meta_path.parent] = axis, last, separator, prefix
+
+    def exclude(path: pathlib.Path) -> bool:
+        array_dir = next((p for p in path.parents if p in arrays), None)
+        if array_dir is None:
+            return False
+        axis, last, separator, prefix = arrays[array_dir]
+        parts = path.relative_to(array_dir).as_posix().split(separator)
+        if prefix is not None:
+            if parts[0] != prefix:
+                return False
+            parts = parts[1:]
+        if not all(part.isdigit() for part in parts):
+            return False
+        # Directories of nested chunk keys may not reach the axis yet.
+        return len(parts) > axis and int(parts[axis]) != last
+
+    return exclude
+
+
+def resume_filter(output_dir: pathlib.Path) -> Callable[[pathlib.Path], bool]:
+    """Make a filter for the output files not needed to resume writing
+
+    Resuming an interrupted batch run only needs the journal and the
+    metadata of the output Zarr stores: incomplete outputs are rewritten,
+    and the missing slabs of streamed outputs are written to regions
+    aligned with their chunks, so the chunks already written are never
+    read. Leaving them out makes copying the outputs into a container
+    scale with the number of arrays rather than the size of the outputs.
+    The chunks written by the resumed run are then copied out on top of
+    the existing ones.
+
+    :param output_dir: the output directory of the interrupted run
+    :return: a function which returns True for the paths of files (or
+        directories) which are not needed
+    """
+
+    def exclude(path: pathlib.Path) -> bool:
+        parts = path.relative_to(output_dir).parts
+        if not parts:
+            return False
+        if parts[0].endswith(".zarr"):
+            return path.is_file() and path.name not in ZARR_METADATA_FILES
+        return parts != (JOURNAL_FILENAME,)
+
+    return exclude
+
+
 class ChunkStream(io.RawIOBase):
     """A binary stream backed by a generator of bytes objects"""
 
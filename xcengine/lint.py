@@ -0,0 +1,273 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""Static detection of performance problems in notebook code"""
+
+import ast
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from xcengine.analysis import attribute_chain, parse_cell
+
+# Methods which select part of a dataset or reduce it, so that loading
+# their result into memory is not necessarily a problem
+SUBSET_METHODS = {
+    "any",
+    "all",
+    "argmax",
+    "argmin",
+    "coarsen",
+    "count",
+    "groupby",
+    "head",
+    "interp",
+    "isel",
+    "max",
+    "mean",
+    "median",
+    "min",
+    "prod",
+    "quantile",
+    "resample",
+    "sel",
+    "std",
+    "sum",
+    "tail",
+    "thin",
+    "var",
+}
+
+# Methods and attributes which load a dataset or array into memory
+LOAD_METHODS = {"compute", "load", "to_numpy"}
+LOAD_ATTRIBUTES = {"values"}
+
+# Names of dimensions and coordinates which are typically iterated over
+# element by element in slow notebook code
+DIMENSION_NAMES = {
+    "band",
+    "lat",
+    "latitude",
+    "lon",
+    "longitude",
+    "time",
+    "x",
+    "y",
+}
+
+# Attributes giving the sizes of an array's or dataset's dimensions
+SIZE_ATTRIBUTES = {"dims", "shape", "sizes"}
+
+OPEN_FUNCTIONS = {
+    "open_data",
+    "open_dataset",
+    "open_datatree",
+    "open_mfdataset",
+    "open_zarr",
+}
+
+# Keyword arguments which restrict the data opened by a store's open_data
+# method to a region of interest
+OPEN_DATA_SUBSET_ARGUMENTS = ("bbox", "time_range")
+
+# Adding this comment to a line suppresses any findings on it.
+SUPPRESSION_COMMENT = "# noqa"
+
+
+class Finding(NamedTuple):
+    """A potential performance problem found in a notebook
+
+    Cell indices are zero-based, as in the rest of xcengine's conversion
+    messages; line numbers are one-based and relative to the cell.
+    """
+
+    cell: int
+    line: int
+    code: str
+    message: str
+
+    def __str__(self) -> str:
+        return (
+            f"cell {self.cell}, line {self.line}: {self.code} {self.message}"
+        )
+
+
+def lint_cells(cells: Iterable[tuple[int, str]]) -> list[Finding]:
+    """Check notebook code cells for known performance anti-patterns
+
+    The checks are heuristic, and only consider the syntax of the code,
+    so they may report false positives.
+
+    :param cells: a (cell index, source code) tuple for each code cell,
+        in notebook order
+    :return: the findings, ordered by cell and line
+    """
+    linter = _Linter()
+    for cell_index, source in cells:
+        if (module := parse_cell(source)) is None:
+            continue
+        lines = source.splitlines()
+        linter.cell_index = cell_index
+        linter.findings_in_cell = []
+        linter.visit(module)
+        linter.findings.extend(
+            finding
+            for finding in linter.findings_in_cell
+            if not (
+                finding.line <= len(lines)
+                and SUPPRESSION_COMMENT in lines[finding.line - 1]
+            )
+        )
+    return sorted(set(linter.findings))
+
+
+class _Linter(ast.NodeVisitor):
+    def __init__(self):
+        self.cell_index = 0
+        self.findings: list[Finding] = []
+        self.findings_in_cell: list[Finding] = []
+        # Locations of the first call to open each data source
+        self.opened: dict[tuple[str, str], tuple[int, int]] = {}
+
+    def report(self, node: ast.AST, code: str, message: str) -> None:
+        self.findings_in_cell.append(
+            Finding(self.cell_index, node.lineno, code, message)
+        )
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if (
+            node.attr in LOAD_ATTRIBUTES
+            and isinstance(node.ctx, ast.Load)
+            and self.is_whole_dataset(node.value)
+        ):
+            self.report(
+                node,
+                "XCE001",
+                f".{node.attr} loads a whole array into memory; "
+                f"select or reduce the data first",
+            )
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call) -> None:
+        match node.func:
+            case ast.Attribute(attr=attr, value=value):
+                if attr in LOAD_METHODS and self.is_whole_dataset(value):
+                    self.report(
+                        node,
+                        "XCE001",
+                        f".{attr}() loads a whole dataset into memory; "
+                        f"select or reduce the data first",
+                    )
+                # Don't treat method calls like dict.values() as attribute
+                # accesses.
+                self.visit(value)
+            case func:
+                self.visit(func)
+        chain = attribute_chain(node.func)
+        if chain and chain[-1] in OPEN_FUNCTIONS:
+            self.check_open(node, chain)
+        for argument in node.args + node.keywords:
+            self.visit(argument)
+
+    def visit_For(self, node: ast.For | ast.AsyncFor) -> None:
+        if self.iterates_over_dimension(node.iter):
+            self.report(
+                node,
+                "XCE002",
+                "Python loop over the elements of a dimension; use "
+                "vectorised xarray operations (or apply_ufunc / "
+                "map_blocks) instead",
+            )
+        self.generic_visit(node)
+
+    visit_AsyncFor = visit_For
+
+    def check_open(self, node: ast.Call, chain: list[str]) -> None:
+        name = chain[-1]
+        keywords = {k.arg for k in node.keywords}
+        if name == "open_data" and None not in keywords:
+            missing = [
+                k for k in OPEN_DATA_SUBSET_ARGUMENTS if k not in keywords
+            ]
+            if missing:
+                self.report(
+                    node,
+                    "XCE003",
+                    f"open_data without {' or '.join(missing)} may open "
+                    f"much more data than needed",
+                )
+        source = node.args[0] if node.args else None
+        if isinstance(source, ast.Constant):
+            key = (".".join(chain), repr(source.value))
+            if key in self.opened:
+                cell, line = self.opened[key]
+                self.report(
+                    node,
+                    "XCE004",
+                    f"{source.value!r} is also opened in cell {cell}, "
+                    f"line {line}; open it once and reuse the dataset",
+                )
+            else:
+                self.opened[key] = (self.cell_index, node.lineno)
+
+    @staticmethod
+    def is_whole_dataset(node: ast.expr) -> bool:
+        """Guess whether an expression refers to a whole dataset or array
+
+        This is assumed unless the expression selects or reduces data, or
+        refers to a coordinate, which is usually small.
+        """
+        if isinstance(node, ast.Attribute) and node.attr in DIMENSION_NAMES:
+            return False
+        while True:
+            match node:
+                case ast.Call(func=ast.Attribute(attr=attr)) if (
+                    attr in SUBSET_METHODS
+                ):
+                    return False
+                case ast.Subscript(slice=index) if not (
+                    isinstance(index, ast.Constant)
+                    and isinstance(index.value, str)
+                ):
+                    # Indexing by position or slice selects a subset;
+                    # indexing by a string selects a whole variable.
+                    return False
+                case (
+                    ast.Call(func=node)
+                    | ast.Subscript(value=node)
+                    | ast.Attribute(value=node)
+                ):
+                    pass
+                case ast.Name():
+                    return True
+                case _:
+                    return False
+
+    @staticmethod
+    def iterates_over_dimension(node: ast.expr) -> bool:
+        """Guess whether a loop iterates over a dimension of a dataset
+
+        This is assumed for loops over coordinates with typical dimension
+        names (e.g. ``for t in cube.time``) and for loops over ranges
+        computed from dimension sizes (e.g. ``range(cube.sizes["x"])``
+        or ``range(len(cube.time))``).
+        """
+        chain = attribute_chain(node)
+        if len(chain) > 1 and DIMENSION_NAMES & set(chain[1:]):
+            return True
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in {"range", "enumerate"}
+        ):
+            return False
+        for argument in ast.walk(node):
+            match argument:
+                case ast.Attribute(attr=attr) if attr in SIZE_ATTRIBUTES:
+                    return True
+                case ast.Call(func=ast.Name(id="len"), args=[array]) if (
+                    len(chain := attribute_chain(array)) > 1
+                    and chain[-1] in DIMENSION_NAMES
+                ):
+                    return True
+        return False
@@ -0,0 +1,147 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""Conversion-time handling of IPython magics and shell escapes"""
+
+import re
+import shlex
+
+# Cell magics which only measure or capture the execution of their body
+UNWRAPPED_CELL_MAGICS = {"time", "timeit", "capture", "prun"}
+
+# Cell magics which only render their content
+DISPLAY_CELL_MAGICS = {"html", "javascript", "js", "latex", "markdown", "svg"}
+
+# Line magics which only measure the execution of the rest of the line
+UNWRAPPED_LINE_MAGICS = {"time", "timeit", "prun"}
+
+# Line magics which configure the interactive session and are irrelevant
+# in a headless run
+IGNORED_LINE_MAGICS = {
+    "autoreload",
+    "config",
+    "load_ext",
+    "matplotlib",
+    "precision",
+    "reload_ext",
+}
+
+INSTALLERS = {"pip": "pip", "conda": "conda", "mamba": "conda"}
+
+# Options of timing magics which take a value
+_TIMING_OPTIONS_WITH_VALUE = {"-n", "-r", "-p", "-T", "-l", "-s"}
+
+# Options of installers which take a value
+_INSTALLER_OPTIONS_WITH_VALUE = {
+    "-c",
+    "--channel",
+    "-n",
+    "--name",
+    "-p",
+    "--prefix",
+    "-i",
+    "--index-url",
+    "--extra-index-url",
+}
+
+_LINE_MAGIC = re.compile(r"^(\s*)(%|!)(.*)$")
+_ASSIGNED_MAGIC = re.compile(r"^\s*[\w.]+(\s*,\s*[\w.]+)*\s*=\s*[%!]")
+_HELP = re.compile(r"^\s*(\?\??[\w.]+|[\w.]+\?\??)\s*$")
+
+
+class MagicsProcessor:
+    """Rewrites IPython-specific syntax in notebook code cells
+
+    Package installations are removed and their packages recorded, so
+    that they can be added to the environment of the generated image
+    instead. Timing magics are unwrapped so that their code runs once.
+    Magics which only affect the interactive session are removed. Any
+    other magics and shell escapes are left unchanged and recorded as
+    unsupported, since they will fail or misbehave in a headless run.
+    """
+
+    def __init__(self):
+        self.conda_packages: list[str] = []
+        self.pip_packages: list[str] = []
+        self.unsupported: list[tuple[int, str]] = []
+
+    def process_cell(self, source: str, cell_index: int) -> str:
+        """Rewrite the magics in a code cell
+
+        :param source: the source code of the cell
+        :param cell_index: index of the cell in the notebook, recorded
+            with any unsupported constructs
+        :return: the rewritten source code
+        """
+        lines = source.splitlines()
+        first = next((i for i, line in enumerate(lines) if line.strip()), 0)
+        if lines and lines[first].lstrip().startswith("%%"):
+            magic = lines[first].lstrip()[2:].split(maxsplit=1)
+            name = magic[0] if magic else ""
+            if name in UNWRAPPED_CELL_MAGICS:
+                lines = lines[first + 1 :]
+            elif name in DISPLAY_CELL_MAGICS:
+                return ""
+            else:
+                self._report(cell_index, lines[first])
+                return source
+        return "\n".join(self.process_line(line, cell_index) for line in lines)
+
+    def process_line(self, line: str, cell_index: int) -> str:
+        if _HELP.match(line):
+            return ""
+        if _ASSIGNED_MAGIC.match(line):
+            self._report(cell_index, line)
+            return line
+        if not (match := _LINE_MAGIC.match(line)):
+            return line
+        indent, prefix, command = match.groups()
+        words = command.split(maxsplit=1)
+        name = words[0] if words else ""
+        rest = words[1] if len(words) > 1 else ""
+        if name in INSTALLERS and rest.startswith("install"):
+            if self._record_install(INSTALLERS[name], rest[len("install") :]):
+                return f"{indent}pass  # {prefix}{command}"
+        elif prefix == "%" and name in UNWRAPPED_LINE_MAGICS:
+            return indent + self._strip_timing_options(rest)
+        elif prefix == "%" and name in IGNORED_LINE_MAGICS:
+            return f"{indent}pass  # {prefix}{command}"
+        self._report(cell_index, line)
+        return line
+
+    def _record_install(self, installer: str, arguments: str) -> bool:
+        try:
+            words = shlex.split(arguments)
+        except ValueError:
+            return False
+        packages = []
+        skip_next = False
+        for word in words:
+            if skip_next:
+                skip_next = False
+            elif word in _INSTALLER_OPTIONS_WITH_VALUE:
+                skip_next = True
+            elif word in {"-r", "--requirement", "-e", "--editable"}:
+                # Installing from files or local sources can't be
+                # reproduced in an environment file.
+                return False
+            elif not word.startswith("-"):
+                packages.append(word)
+        target = (
+            self.pip_packages if installer == "pip" else self.conda_packages
+        )
+        target.extend(p for p in packages if p not in target)
+        return True
+
+    @staticmethod
+    def _strip_timing_options(command: str) -> str:
+        words = command.split(" ")
+        while words and words[0].startswith("-"):
+            option = words.pop(0)
+            if option in _TIMING_OPTIONS_WITH_VALUE and words:
+                words.pop(0)
+        return " ".join(words)
+
+    def _report(self, cell_index: int, line: str) -> None:
+        self.unsupported.append((cell_index, line.strip()))
@@ -1,8 +1,48 @@
+import ast
 import builtins
+import logging
+import operator
+import subprocess
+import sys
+import textwrap
 from typing import Any
 
 import yaml
 
+LOGGER = logging.getLogger(__name__)
+
+# Names of the options of the wrapper script (execute.py), with hyphens
+# replaced by underscores. Each parameter becomes an option --NAME of the
+# script, so parameters can't have these names.
+RESERVED_NAMES = frozenset(
+    {
+        "access_pattern",
+        "append_dim",
+        "batch",
+        "chunk_size",
+        "dask_cluster",
+        "dask_dashboard_port",
+        "dask_memory_limit",
+        "dask_spill_dir",
+        "dask_threads_per_worker",
+        "dask_workers",
+        "from_saved",
+        "help",
+        "list_params",
+        "only",
+        "output_encoding",
+        "parallel",
+        "precompile",
+        "resume",
+        "server",
+        "shard_size",
+        "stream_dim",
+        "stream_memory",
+        "threads",
+        "verbose",
+    }
+)
+
 
 class NotebookParameters:
 
@@ -12,8 +52,16 @@ class NotebookParameters:
         self.params = params
 
     @classmethod
-    def from_code(cls, code: str) -> "NotebookParameters":
-        return cls(cls.extract_variables(code))
+    def from_code(
+        cls, code: str, execute: bool = False
+    ) -> "NotebookParameters":
+        params = cls.extract_variables(code, execute=execute)
+        if reserved := sorted(RESERVED_NAMES & params.keys()):
+            raise ValueError(
+                f"Parameter name(s) {', '.join(reserved)} clash with "
+                f"options of the generated script; please rename them"
+            )
+        return cls(params)
 
     @classmethod
     def from_yaml(cls, yaml_string: str) -> "NotebookParameters":
@@ -23,11 +71,85 @@ class NotebookParameters:
         )
 
     @staticmethod
-    def extract_variables(code: str) -> dict[str, tuple[type, Any]]:
-        _old_locals = set(locals().keys())
-        exec(code)
-        newvars = locals().keys() - _old_locals - {"_old_locals"}
-        return {k: (type(v := locals()[k]), v) for k in newvars}
+    def extract_variables(
+        code: str, timeout: float = 10.0, execute: bool = False
+    ) -> dict[str, tuple[type, Any]]:
+        """Determine the variables set by a parameters cell
+
+        The code is analysed statically, which handles assignments of
+        literals, tuples, lists, and arithmetic on them. If this fails,
+        the code is executed only if explicitly allowed, in a separate
+        interpreter process which is killed after a timeout. This process
+        is not sandboxed: the code runs with the permissions of the
+        current user and full access to the file system and network, so
+        execution should only be allowed for trusted notebooks. Imports
+        are ignored during static analysis, and variables not holding
+        literal values are omitted.
+
+        :param code: the source code of the parameters cell
+        :param timeout: maximum time in seconds to allow for execution
+        :param execute: whether to execute the code if it can't be
+            analysed statically
+        :return: a dictionary mapping each variable name to a tuple of its
+            type and its value
+        :raises ValueError: if the code can't be analysed statically and
+            execution is not allowed, or if its execution fails
+        """
+        try:
+            return _StaticExtractor().extract(code)
+        except _UnresolvableError as error:
+            if not execute:
+                raise ValueError(
+                    f"Can't determine the parameters statically; "
+                    f"{error}. Simplify these statements, or allow the "
+                    f"parameters cell to be executed (the "
+                    f"--execute-parameters option of xcetool), which is "
+                    f"not sandboxed."
+                )
+            LOGGER.info(
+                f"Can't resolve parameters statically ({error}); "
+                f"executing parameters cell"
+            )
+            return NotebookParameters._execute_variables(code, timeout)
+
+    @staticmethod
+    def _execute_variables(
+        code: str, timeout: float
+    ) -> dict[str, tuple[type, Any]]:
+        # -I only keeps the user's site packages and environment variables
+        # from affecting the child interpreter; it is not a security
+        # boundary.
+        runner = textwrap.dedent("""
+            import ast, sys
+            namespace = {}
+            exec(sys.stdin.read(), namespace)
+            values = {}
+            for name, value in namespace.items():
+                try:
+                    if ast.literal_eval(repr(value)) == value:
+                        values[name] = value
+                except (ValueError, SyntaxError, TypeError, MemoryError):
+                    pass
+            print(repr(values))
+            """)
+        try:
+            process = subprocess.run(
+                [sys.executable, "-I", "-c", runner],
+                input=code,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            raise ValueError(
+                f"Parameters cell did not finish within {timeout} seconds"
+            )
+        if process.returncode != 0:
+            raise ValueError(
+                f"Parameters cell failed to execute:\n{process.stderr}"
+            )
+        values = ast.literal_eval(process.stdout.strip().splitlines()[-1])
+        return {k: (type(v), v) for k, v in values.items()}
 
     def get_cwl_workflow_inputs(self) -> dict[str, dict[str, Any]]:
         return {
@@ -84,3 +206,157 @@ class NotebookParameters:
                 return "boolean"
             case _:
                 raise ValueError(f"Unhandled type {type_}")
+
+
+class _UnresolvableError(Exception):
+    pass
+
+
+class _StaticExtractor:
+    """Evaluates simple parameter assignments without executing any code"""
+
+    _binary_operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+    }
+
+    _unary_operators = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+        ast.Not: operator.not_,
+    }
+
+    _annotation_types = {
+        t.__name__: t for t in (int, float, str, bool, list, tuple)
+    }
+
+    def __init__(self):
+        self.values: dict[str, Any] = {}
+        self.types: dict[str, type] = {}
+
+    def extract(self, code: str) -> dict[str, tuple[type, Any]]:
+        try:
+            module = ast.parse(code)
+        except SyntaxError as error:
+            raise _UnresolvableError(f"syntax error: {error}")
+        failures = []
+        for statement in module.body:
+            try:
+                self.process_statement(statement)
+            except _UnresolvableError as error:
+                source = ast.get_source_segment(code, statement)
+                failures.append(
+                    f"line {statement.lineno}: {source.splitlines()[0]} "
+                    f"({error})"
+                )
+        if failures:
+            raise _UnresolvableError(
+                f"these statements can't be evaluated: {'; '.join(failures)}"
+            )
+        return {
+            name: (self.types.get(name, type(value)), value)
+            for name, value in self.values.items()
+        }
+
+    def process_statement(self, statement: ast.stmt) -> None:
+        match statement:
+            case ast.Import() | ast.ImportFrom() | ast.Pass():
+                pass
+            case ast.Expr(value=ast.Constant()):
+                pass  # docstring or other bare literal
+            case ast.Assign(targets=targets, value=value):
+                value = self.evaluate(value)
+                for target in targets:
+                    self.assign(target, value)
+            case ast.AnnAssign(
+                target=ast.Name(id=name), annotation=annotation, value=value
+            ) if (value is not None):
+                self.assign(statement.target, self.evaluate(value))
+                if (
+                    isinstance(annotation, ast.Name)
+                    and annotation.id in self._annotation_types
+                ):
+                    type_ = self._annotation_types[annotation.id]
+                    try:
+                        self.values[name] = type_(self.values[name])
+                    except (TypeError, ValueError):
+                        raise _UnresolvableError(
+                            f"value of {name} is not a valid {type_.__name__}"
+                        )
+                    self.types[name] = type_
+            case ast.AugAssign(
+                target=ast.Name(id=name), op=op, value=value
+            ) if (name in self.values):
+                self.assign(
+                    statement.target,
+                    self.apply_binary(op, self.values[name], value),
+                )
+            case _:
+                raise _UnresolvableError("unsupported statement")
+
+    def assign(self, target: ast.expr, value: Any) -> None:
+        match target:
+            case ast.Name(id=name):
+                self.values[name] = value
+                self.types.pop(name, None)
+            case ast.Tuple(elts=elts) | ast.List(elts=elts):
+                try:
+                    values = list(value)
+                except TypeError:
+                    raise _UnresolvableError("cannot unpack non-sequence")
+                if len(values) != len(elts) or any(
+                    isinstance(e, ast.Starred) for e in elts
+                ):
+                    raise _UnresolvableError("unsupported unpacking")
+                for element, element_value in zip(elts, values):
+                    self.assign(element, element_value)
+            case _:
+                raise _UnresolvableError("unsupported assignment target")
+
+    def evaluate(self, node: ast.expr) -> Any:
+        match node:
+            case ast.Constant(value=value):
+                return value
+            case ast.Name(id=name) if name in self.values:
+                return self.values[name]
+            case ast.Tuple(elts=elts):
+                return tuple(self.evaluate(e) for e in elts)
+            case ast.List(elts=elts):
+                return [self.evaluate(e) for e in elts]
+            case ast.UnaryOp(op=op, operand=operand) if (
+                type(op) in self._unary_operators
+            ):
+                return self._unary_operators[type(op)](self.evaluate(operand))
+            case ast.BinOp(left=left, op=op, right=right):
+                return self.apply_binary(op, self.evaluate(left), right)
+            case _:
+                raise _UnresolvableError("unsupported expression")
+
+    def apply_binary(
+        self, op: ast.operator, left: Any, right: ast.expr
+    ) -> Any:
+        if type(op) not in self._binary_operators:
+            raise _UnresolvableError("unsupported operator")
+        right = self.evaluate(right)
+        # Avoid spending unbounded time or memory on e.g. 10 ** 10 ** 10
+        # or "x" * 10 ** 10.
+        if (
+            isinstance(op, ast.Pow)
+            and isinstance(right, (int, float))
+            and abs(right) > 1000
+        ):
+            raise _UnresolvableError("exponent too large")
+        if isinstance(op, ast.Mult) and any(
+            isinstance(x, (str, list, tuple)) for x in (left, right)
+        ):
+            if any(isinstance(x, int) and x > 10000 for x in (left, right)):
+                raise _UnresolvableError("sequence repetition too large")
+        try:
+            return self._binary_operators[type(op)](left, right)
+        except Exception as error:
+            raise _UnresolvableError(str(error))
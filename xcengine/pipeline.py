@@ -0,0 +1,327 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""Pipelines of notebooks which run in a single process"""
+
+import logging
+import pathlib
+import py_compile
+import tempfile
+from typing import Any, NamedTuple
+
+import yaml
+
+from xcengine import util
+from xcengine.core import ScriptCreator
+from xcengine.parameters import NotebookParameters
+
+LOGGER = logging.getLogger(__name__)
+
+PIPELINE_SUFFIXES = {".yaml", ".yml"}
+
+# Code at the start of the generated user code for a pipeline. Names start
+# with an underscore so that they are not treated as output datasets.
+# Stage modules and results are bound to names with the prefixes
+# _xce_stage_ and _xce_result_, so they can't shadow these helpers.
+_PRELUDE = """\
+import pathlib as _xce_pathlib
+
+import xarray as _xce_xarray
+
+
+def _xce_input(results, stage, name):
+    try:
+        return results[name]
+    except KeyError:
+        raise KeyError(
+            f"Pipeline stage {stage} has no output dataset {name}; "
+            f"its outputs are: {', '.join(results) or 'none'}"
+        ) from None
+
+
+def _xce_checkpoint(stage, results):
+    directory = _xce_pathlib.Path.home() / "output" / "checkpoints" / stage
+    directory.mkdir(parents=True, exist_ok=True)
+    reopened = {}
+    for name, dataset in results.items():
+        path = directory / (name + ".zarr")
+        dataset.to_zarr(path, mode="w")
+        reopened[name] = _xce_xarray.open_zarr(path)
+    return reopened
+"""
+
+
+class Stage(NamedTuple):
+    name: str
+    notebook: pathlib.Path
+    parameters: dict[str, Any]
+    # Maps parameter names to (stage name, dataset name) tuples
+    inputs: dict[str, tuple[str, str]]
+    checkpoint: bool
+
+
+class Pipeline:
+    """A sequence of notebooks, whose output datasets feed later notebooks
+
+    A pipeline is defined by a YAML file like this::
+
+        stages:
+          - name: ingest
+            notebook: ingest.ipynb
+            parameters:
+              year: 2020
+          - name: preprocess
+            notebook: preprocess.ipynb
+            inputs:
+              cube: ingest.raw_cube
+            checkpoint: true
+          - name: index
+            notebook: index.ipynb
+            inputs:
+              cube: preprocess.clean_cube
+        outputs:
+          ndvi: index.ndvi
+
+    Each stage's parameters set notebook parameters to literal values,
+    and its inputs set notebook parameters to output datasets of earlier
+    stages. A checkpointed stage's datasets are written to Zarr and
+    reopened before being passed on. The outputs map the names of the
+    pipeline's output datasets to stage datasets; by default, all the
+    datasets of the last stage are output. Notebook paths are relative
+    to the pipeline file.
+    """
+
+    def __init__(
+        self, stages: list[Stage], outputs: dict[str, tuple[str, str]] | None
+    ):
+        self.stages = stages
+        self.outputs = outputs
+
+    @classmethod
+    def from_yaml(cls, path: pathlib.Path) -> "Pipeline":
+        with open(path) as fh:
+            definition = yaml.safe_load(fh)
+        if not isinstance(definition, dict) or not definition.get("stages"):
+            raise ValueError(f"{path} does not define any pipeline stages")
+        stages = []
+        for stage_def in definition["stages"]:
+            name = str(stage_def.get("name", ""))
+            if not name.isidentifier():
+                raise ValueError(f"Invalid pipeline stage name {name!r}")
+            if name in (s.name for s in stages):
+                raise ValueError(f"Duplicate pipeline stage name {name}")
+            if "notebook" not in stage_def:
+                raise ValueError(f"Pipeline stage {name} has no notebook")
+            stages.append(
+                Stage(
+                    name=name,
+                    notebook=path.parent / stage_def["notebook"],
+                    parameters=stage_def.get("parameters") or {},
+                    inputs={
+                        parameter: cls._reference(source, stages, name)
+                        for parameter, source in (
+                            stage_def.get("inputs") or {}
+                        ).items()
+                    },
+                    checkpoint=bool(stage_def.get("checkpoint", False)),
+                )
+            )
+        outputs = definition.get("outputs")
+        if outputs is not None:
+            outputs = {
+                output: cls._reference(source, stages, "outputs")
+                for output, source in outputs.items()
+            }
+            if invalid := [o for o in outputs if not o.isidentifier()]:
+                raise ValueError(
+                    f"Invalid pipeline output name(s): {', '.join(invalid)}"
+                )
+        return cls(stages, outputs)
+
+    @staticmethod
+    def _reference(
+        source: str, stages: list[Stage], context: str
+    ) -> tuple[str, str]:
+        stage, _, dataset = str(source).partition(".")
+        if stage not in (s.name for s in stages) or not dataset:
+            raise ValueError(
+                f"Invalid dataset reference {source!r} in {context}: "
+                f"expected STAGE.DATASET, with STAGE an earlier stage"
+            )
+        return stage, dataset
+
+
+class PipelineCreator:
+    """Converts a notebook pipeline into a single script
+
+    Each stage notebook is converted to a module with a run function (see
+    xcengine.runner.make_run_module), and the pipeline itself becomes the
+    user code executed by the usual wrapper script. Datasets, including
+    lazy Dask-backed ones, are passed between stages as Python objects,
+    so the pipeline can be run, served, and built into an image just like
+    a single notebook. This class provides the same conversion methods as
+    ScriptCreator, so it can be used in place of one.
+    """
+
+    def __init__(
+        self,
+        pipeline_path: pathlib.Path,
+        drop_display_cells: bool = True,
+        use_nbconvert: bool = False,
+        lint: bool = False,
+        execute_parameters: bool = False,
+    ):
+        self.pipeline_path = pipeline_path
+        self.drop_display_cells = drop_display_cells
+        self.use_nbconvert = use_nbconvert
+        self.lint = lint
+        self.execute_parameters = execute_parameters
+        self.pipeline = Pipeline.from_yaml(pipeline_path)
+
+    def input_paths(self) -> list[pathlib.Path]:
+        return [self.pipeline_path] + [
+            s.notebook for s in self.pipeline.stages
+        ]
+
+    def convert_notebook_to_script(
+        self,
+        output_dir: pathlib.Path,
+        clear_output: bool = False,
+        use_cache: bool = True,
+    ) -> None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if clear_output:
+            util.clear_directory(output_dir)
+        self.write_script_files(output_dir, use_cache)
+
+    def update_script(
+        self, output_dir: pathlib.Path, use_cache: bool = True
+    ) -> list[str]:
+        """Regenerate the script files, replacing only those which changed
+
+        :param output_dir: directory containing a previous conversion
+        :param use_cache: whether to use the conversion cache for the
+            stage notebooks
+        :return: the names of the files which were replaced
+        """
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.write_script_files(pathlib.Path(temp_dir), use_cache)
+            return util.sync_files(pathlib.Path(temp_dir), output_dir)
+
+    def write_script_files(
+        self, output_dir: pathlib.Path, use_cache: bool = True
+    ) -> list[str]:
+        dependencies = {"conda": [], "pip": []}
+        filenames = []
+        for stage in self.pipeline.stages:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                stage_dir = pathlib.Path(temp_dir)
+                script_creator = ScriptCreator(
+                    stage.notebook,
+                    self.drop_display_cells,
+                    self.use_nbconvert,
+                    self.lint,
+                    self.execute_parameters,
+                )
+                script_creator.convert_notebook_to_script(
+                    stage_dir, use_cache=use_cache
+                )
+                module_path = stage_dir / "user_module.py"
+                if not module_path.exists():
+                    raise ValueError(
+                        f"Notebook {stage.notebook} of pipeline stage "
+                        f"{stage.name} can't be run as a function"
+                    )
+                with open(stage_dir / "parameters.yaml") as fh:
+                    params = yaml.safe_load(fh) or {}
+                if (
+                    unknown := (stage.parameters.keys() | stage.inputs.keys())
+                    - params.keys()
+                ):
+                    raise ValueError(
+                        f"Notebook {stage.notebook} of pipeline stage "
+                        f"{stage.name} has no parameter(s) "
+                        f"{', '.join(sorted(unknown))}"
+                    )
+                filename = f"stage_{stage.name}.py"
+                (output_dir / filename).write_text(module_path.read_text())
+                filenames.append(filename)
+                with open(stage_dir / "dependencies.yaml") as fh:
+                    for installer, packages in yaml.safe_load(fh).items():
+                        dependencies[installer] += [
+                            p
+                            for p in packages
+                            if p not in dependencies[installer]
+                        ]
+        (output_dir / "user_code.py").write_text(self.make_user_code())
+        with open(pathlib.Path(__file__).parent / "wrapper.py") as fh:
+            (output_dir / "execute.py").write_text(fh.read())
+        with open(output_dir / "parameters.yaml", "w") as fh:
+            fh.write(NotebookParameters({}).to_yaml())
+        with open(output_dir / "dependencies.yaml", "w") as fh:
+            yaml.safe_dump(dependencies, fh)
+        py_compile.compile(
+            str(output_dir / "user_code.py"),
+            cfile=str(output_dir / "user_code.pyc"),
+            dfile="user_code.py",
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        )
+        return filenames + [
+            "user_code.py",
+            "user_code.pyc",
+            "execute.py",
+            "parameters.yaml",
+            "dependencies.yaml",
+        ]
+
+    def make_user_code(self) -> str:
+        """Generate the code which runs the pipeline stages in turn
+
+        Each stage is written as a separate cell, so that execute.py's
+        --parallel mode can run independent stages concurrently.
+
+        :return: the Python source code of the pipeline
+        """
+        parts = [
+            "#!/usr/bin/env python\n# coding: utf-8\n\n",
+            f"# Pipeline generated by xcengine from "
+            f"{self.pipeline_path.name}; do not edit\n\n",
+            _PRELUDE,
+        ]
+        for stage in self.pipeline.stages:
+            arguments = [
+                f"{name}={value!r}" for name, value in stage.parameters.items()
+            ] + [
+                f"{name}=_xce_input(_xce_result_{source}, {source!r}, "
+                f"{dataset!r})"
+                for name, (source, dataset) in stage.inputs.items()
+            ]
+            code = (
+                f"import stage_{stage.name} as _xce_stage_{stage.name}\n"
+                f"_xce_result_{stage.name} = _xce_stage_{stage.name}.run("
+                f"{', '.join(arguments)})\n"
+            )
+            if stage.checkpoint:
+                code += (
+                    f"_xce_result_{stage.name} = _xce_checkpoint("
+                    f"{stage.name!r}, _xce_result_{stage.name})\n"
+                )
+            parts.append(f"\n\n# In[ ]:\n\n\n{code}")
+        if self.pipeline.outputs is None:
+            last = self.pipeline.stages[-1].name
+            code = f"globals().update(_xce_result_{last})\n"
+        else:
+            code = "".join(
+                f"{output} = _xce_input(_xce_result_{stage}, {stage!r}, "
+                f"{dataset!r})\n"
+                for output, (stage, dataset) in self.pipeline.outputs.items()
+            )
+        parts.append(f"\n\n# In[ ]:\n\n\n{code}")
+        return "".join(parts)
+
+
+def is_pipeline(path: pathlib.Path) -> bool:
+    return path.suffix.lower() in PIPELINE_SUFFIXES
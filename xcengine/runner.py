@@ -0,0 +1,168 @@
+# Copyright (c) 2024 by Brockmann Consult GmbH
+# Permissions are hereby granted under the terms of the MIT License:
+# https://opensource.org/licenses/MIT.
+
+"""In-process execution of converted notebooks"""
+
+import ast
+import linecache
+import logging
+import pathlib
+import tempfile
+import threading
+import types
+from typing import Any
+
+LOGGER = logging.getLogger(__name__)
+
+# Name of the statement which the converter inserts after the parameters
+# cell, and which the wrapper script replaces with the configured values
+SET_PARAMS_CALL = "__xce_set_params"
+
+# Prefix for names which the generated module uses internally. Results are
+# taken from the local variables of run(), and names starting with an
+# underscore are never results, so these can't be mistaken for outputs.
+_PREFIX = "_xce_"
+
+_modules: dict[str, types.ModuleType] = {}
+_modules_lock = threading.Lock()
+
+
+def make_run_module(
+    user_code: str, params: dict[str, tuple[type, Any]]
+) -> str:
+    """Turn a converted notebook into a module with a run function
+
+    The statements of the notebook become the body of a function
+    ``run``, which takes the notebook parameters as keyword-only
+    arguments and returns the datasets assigned to variables in the
+    notebook, keyed by variable name. Parameters which still hold the
+    values passed in are not returned, so that a dataset passed to a
+    notebook isn't returned as one of its results unless the notebook
+    assigns to it. The parameters cell itself is kept, so that any
+    imports in it still take effect, and the parameters are set to the
+    arguments immediately after it.
+
+    :param user_code: the Python code converted from the notebook
+    :param params: the notebook parameters, mapping each name to a tuple
+        of its type and its default value
+    :return: the source code of the module
+    :raises SyntaxError: if the notebook code can't be executed as the
+        body of a function, e.g. because it contains a wildcard import
+    """
+    module = ast.parse(user_code)
+    body = []
+    for statement in module.body:
+        match statement:
+            case ast.Expr(
+                value=ast.Call(func=ast.Name(id=name), args=[], keywords=[])
+            ) if (name == SET_PARAMS_CALL):
+                body.extend(
+                    ast.parse(f"{param} = {_PREFIX}args[{param!r}]").body[0]
+                    for param in params
+                )
+            case ast.ImportFrom(names=aliases) if any(
+                a.name == "*" for a in aliases
+            ):
+                raise SyntaxError(
+                    f"wildcard import on line {statement.lineno} is not "
+                    f"allowed in a function"
+                )
+            case _:
+                body.append(statement)
+    arguments = ast.parse(
+        f"{_PREFIX}args = dict({', '.join(f'{p}={p}' for p in params)})"
+    ).body[0]
+    result = ast.parse(
+        f"return {{name: value for name, value in locals().items() "
+        f"if isinstance(value, {_PREFIX}xarray.Dataset) "
+        f"and not name.startswith('_') "
+        f"and value is not {_PREFIX}args.get(name)}}"
+    ).body[0]
+    signature = ", ".join(
+        ["*"]
+        + [f"{name}={default!r}" for name, (_, default) in params.items()]
+        if params
+        else []
+    )
+    function = ast.parse(
+        f"def run({signature}) -> dict[str, {_PREFIX}xarray.Dataset]:\n"
+        f'    """Run the notebook and return its datasets"""\n'
+    ).body[0]
+    function.body.extend([arguments, *body, result])
+    module = ast.Module(
+        body=[
+            ast.parse(f"import xarray as {_PREFIX}xarray").body[0],
+            function,
+        ],
+        type_ignores=[],
+    )
+    source = ast.unparse(ast.fix_missing_locations(module)) + "\n"
+    # Check for statements which are valid at module level only, such as
+    # "global" declarations of names which are also function arguments.
+    compile(source, "user_module.py", "exec")
+    return "# Generated by xcengine; do not edit\n" + source
+
+
+def load_notebook_module(
+    notebook: pathlib.Path | str, **options
+) -> types.ModuleType:
+    """Convert a notebook and import its run module
+
+    Modules are cached in memory by the conversion cache key, so a
+    notebook is only converted and compiled again if it, the xcengine
+    version, or the conversion options have changed.
+
+    :param notebook: path to the notebook
+    :param options: keyword arguments for ScriptCreator
+    :return: a module with a run function, as created by make_run_module
+    """
+    from .core import ScriptCreator
+
+    script_creator = ScriptCreator(pathlib.Path(notebook), **options)
+    key = script_creator.cache_key()
+    with _modules_lock:
+        if (module := _modules.get(key)) is not None:
+            return module
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_dir = pathlib.Path(temp_dir)
+            script_creator.convert_notebook_to_script(output_dir)
+            module_path = output_dir / "user_module.py"
+            if not module_path.exists():
+                raise ValueError(
+                    f"Notebook {notebook} can't be run as a function; "
+                    f"see the conversion log for details"
+                )
+            source = module_path.read_text()
+        filename = f"<xcengine module for {notebook}>"
+        # Register the source so that tracebacks can show its lines.
+        linecache.cache[filename] = (
+            len(source),
+            None,
+            source.splitlines(keepends=True),
+            filename,
+        )
+        module = types.ModuleType(f"{_PREFIX}notebook_{key[:12]}")
+        exec(compile(source, filename, "exec"), module.__dict__)
+        _modules[key] = module
+        return module
+
+
+def run_notebook(notebook: pathlib.Path | str, **params) -> dict[str, Any]:
+    """Run a notebook in this interpreter and return its datasets
+
+    The notebook is converted as for a script, but is run as a function
+    in the current process rather than in a container or subprocess. Its
+    compiled form is cached, so calling this repeatedly for the same
+    notebook (e.g. with different parameters) only pays for the notebook
+    code itself, not for conversion, interpreter startup or imports.
+    Datasets are returned as the notebook computed them, so if they are
+    backed by Dask they have not been computed yet.
+
+    :param notebook: path to the notebook
+    :param params: values for the notebook parameters
+    :return: a dictionary mapping the names of the notebook's dataset
+        variables to the datasets
+    :raises TypeError: if a parameter is not defined by the notebook
+    """
+    return load_notebook_module(notebook).run(**params)
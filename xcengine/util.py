@@ -2,8 +2,11 @@
 # Permissions are hereby granted under the terms of the MIT License:
 # https://opensource.org/licenses/MIT.
 
+import filecmp
 import pathlib
 import shutil
+import time
+from collections.abc import Iterable
 
 
 def clear_directory(directory: pathlib.Path) -> None:
@@ -12,3 +15,74 @@ def clear_directory(directory: pathlib.Path) -> None:
             shutil.rmtree(path)
         else:
             path.unlink()
+
+
+def sync_files(
+    source_dir: pathlib.Path, target_dir: pathlib.Path
+) -> list[str]:
+    """Copy files whose content differs from one directory to another
+
+    Unchanged files in the target directory are left untouched, so their
+    modification times (and any Docker build cache entries depending on
+    them) are preserved.
+
+    :param source_dir: directory containing the new versions of the files
+    :param target_dir: directory to update
+    :return: the names of the files which were copied
+    """
+    changed = []
+    for source in sorted(source_dir.iterdir()):
+        if not source.is_file():
+            continue
+        target = target_dir / source.name
+        if not target.is_file() or not filecmp.cmp(
+            source, target, shallow=False
+        ):
+            shutil.copy2(source, target)
+            changed.append(source.name)
+    return changed
+
+
+class FileWatcher:
+    """Polls a set of files for modifications"""
+
+    def __init__(self, paths: Iterable[pathlib.Path], interval: float = 1.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self.state = self._stat_all()
+
+    def _stat_all(self) -> dict[pathlib.Path, tuple[int, int] | None]:
+        state = {}
+        for path in self.paths:
+            try:
+                stat = path.stat()
+                state[path] = stat.st_mtime_ns, stat.st_size
+            except FileNotFoundError:
+                # Some editors briefly remove a file while saving it.
+                state[path] = None
+        return state
+
+    def wait(self) -> set[pathlib.Path]:
+        """Block until at least one watched file has changed
+
+        A file only counts as changed once its modification time and size
+        have been stable for one polling interval, so that files are not
+        read while they are still being written.
+
+        :return: the set of paths which have changed
+        """
+        while True:
+            time.sleep(self.interval)
+            current = self._stat_all()
+            if current == self.state:
+                continue
+            while True:
+                time.sleep(self.interval)
+                latest = self._stat_all()
+                if latest == current and None not in latest.values():
+                    break
+                current = latest
+            changed = {p for p in self.paths if latest[p] != self.state[p]}
+            self.state = latest
+            if changed:
+                return changed
@@ -5,58 +5,1839 @@
 # https://opensource.org/licenses/MIT.
 
 
+import ast
+import bisect
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
 import logging
+import marshal
+import math
+import os
 import pathlib
+import py_compile
+import re
+import types
+import warnings
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Parameter values given on the command line, which take precedence over
+# values from xce_* environment variables
+_parameter_values: dict = {}
+
+# Parameter values set by __xce_set_params, from the command line or from
+# xce_* environment variables
+_applied_parameters: dict = {}
+
 
 def __xce_set_params():
     import os
 
     code = ""
+    varnames = []
     for key, value in os.environ.items():
         if key.startswith("xce_"):
             varname = key[4:]
+            varnames.append(varname)
             code += f"global {varname}\n{varname} = {value}\n"
             LOGGER.info(f"Configuring parameter: {varname} = {value}")
     LOGGER.info(f"Setting configured parameters.")
     exec(code)
+    _applied_parameters.update((name, globals()[name]) for name in varnames)
+    for name, value in _parameter_values.items():
+        LOGGER.info(f"Configuring parameter: {name} = {value!r}")
+        globals()[name] = value
+    _applied_parameters.update(_parameter_values)
+
+
+def load_parameters() -> dict[str, dict]:
+    """Read the parameter definitions written alongside this script
+
+    :return: a dictionary mapping each parameter name to a dictionary
+        with its type name and default value, or an empty dictionary if
+        there is no parameters file
+    """
+    import yaml
+
+    path = pathlib.Path(__file__).resolve().with_name("parameters.yaml")
+    try:
+        with open(path) as fh:
+            return yaml.safe_load(fh) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def parse_bool(value: str) -> bool:
+    match value.lower():
+        case "true" | "yes" | "1":
+            return True
+        case "false" | "no" | "0":
+            return False
+    raise ValueError(f"invalid boolean value: {value!r}")
+
+
+def parameter_converter(type_name: str):
+    """Return a function converting a command-line string to a type
+
+    :param type_name: the name of the parameter type in parameters.yaml
+    :return: a function which converts a string to the type, raising
+        ValueError if it is not a valid value
+    """
+    match type_name:
+        case "int":
+            return int
+        case "float":
+            return float
+        case "str":
+            return str
+        case "bool":
+            return parse_bool
+
+    def convert(value: str):
+        try:
+            result = ast.literal_eval(value)
+        except (SyntaxError, ValueError):
+            raise ValueError(f"not a {type_name} literal: {value!r}")
+        if type(result).__name__ != type_name:
+            raise ValueError(f"not a {type_name}: {value!r}")
+        return result
+
+    convert.__name__ = type_name
+    return convert
+
+
+# Calls of these functions may bind or modify any global variable.
+_UNANALYSABLE_CALLS = {
+    "__import__",
+    "__xce_set_params",
+    "delattr",
+    "eval",
+    "exec",
+    "get_ipython",
+    "globals",
+    "locals",
+    "setattr",
+    "vars",
+}
+_ALL_NAMES = "*"
+
+# The converter writes one of these comments before each code cell.
+_CELL_MARKER = re.compile(r"^# In\[[^\]]*\]:\s*$")
+
+
+def _analyse_statement(statement) -> tuple[set[str], set[str], set[str]]:
+    """Determine the global names a top-level statement uses and defines
+
+    The analysis is conservative: names which the statement might modify,
+    but not necessarily bind, are reported as "may-define". This includes
+    names bound in conditional or loop bodies, dotted imports, targets of
+    attribute or subscript assignments, and objects whose methods are
+    called in an expression statement, since such calls are usually made
+    for their side effects. Statements with effects which can't be
+    analysed may define any name, indicated by the name "*".
+
+    :param statement: an AST node for a top-level statement
+    :return: a tuple of (used names, defined names, may-define names)
+    """
+    used, defined, may_define = set(), set(), set()
+    for node in ast.walk(statement):
+        match node:
+            case ast.Name(id=name, ctx=ast.Load()):
+                used.add(name)
+            case ast.Name(id=name, ctx=ast.Store() | ast.Del()):
+                may_define.add(name)
+            case ast.Attribute(ctx=ast.Store() | ast.Del()) | ast.Subscript(
+                ctx=ast.Store() | ast.Del()
+            ):
+                may_define.add(_root_name(node) or _ALL_NAMES)
+            case ast.Call(func=ast.Name(id=name)) if (
+                name in _UNANALYSABLE_CALLS
+            ):
+                may_define.add(_ALL_NAMES)
+            case ast.ImportFrom(names=aliases) if any(
+                a.name == "*" for a in aliases
+            ):
+                may_define.add(_ALL_NAMES)
+            case ast.Import(names=aliases) | ast.ImportFrom(names=aliases):
+                for alias in aliases:
+                    name = alias.asname or alias.name
+                    if "." in name:
+                        may_define.add(name.split(".")[0])
+                    else:
+                        defined.add(name)
+    match statement:
+        case ast.Assign(targets=targets):
+            defined |= _target_names(targets)
+        case ast.AnnAssign(target=ast.Name(id=name), value=value) if (
+            value is not None
+        ):
+            defined.add(name)
+        case (
+            ast.FunctionDef(name=name)
+            | ast.AsyncFunctionDef(name=name)
+            | ast.ClassDef(name=name)
+        ):
+            defined.add(name)
+            # Names bound inside the definition are local to it.
+            may_define.clear()
+        case ast.Expr(value=ast.Call(func=ast.Attribute() as func)):
+            may_define.add(_root_name(func) or _ALL_NAMES)
+    return used, defined, may_define - defined
+
+
+def _target_names(targets: list) -> set[str]:
+    names = set()
+    for target in targets:
+        match target:
+            case ast.Name(id=name) | ast.Starred(value=ast.Name(id=name)):
+                names.add(name)
+            case ast.Tuple(elts=elts) | ast.List(elts=elts):
+                names |= _target_names(elts)
+    return names
+
+
+def _root_name(node) -> str | None:
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _slice_statements(statements: list, targets: set[str]) -> list:
+    """Select the top-level statements needed to compute some variables
+
+    This performs a backward slice of the statements' def-use graph,
+    starting from the values of the target variables after the last
+    statement. A dependency on a name extends back through all statements
+    which may define it, up to and including the last one which
+    definitely defines it.
 
+    :param statements: top-level statements of the user code
+    :param targets: names of the variables to compute
+    :return: the statements needed to compute the targets, in their
+        original order
+    """
+    analyses = [_analyse_statement(s) for s in statements]
+    needed: set[int] = set()
+    # Each work item is a (name, index) pair, meaning that the value of the
+    # name is required just before the statement with the given index.
+    work = [(name, len(statements)) for name in targets]
+    seen = set()
+    while work:
+        name, index = work.pop()
+        if (name, index) in seen:
+            continue
+        seen.add((name, index))
+        for i in range(index - 1, -1, -1):
+            used, defined, may_define = analyses[i]
+            definite = name in defined
+            if definite or name in may_define or _ALL_NAMES in may_define:
+                if i not in needed:
+                    needed.add(i)
+                    work.extend((n, i) for n in used)
+                if definite:
+                    break
+    return [s for i, s in enumerate(statements) if i in needed]
 
-with pathlib.Path(__file__).with_name("user_code.py").resolve().open() as fh:
-    user_code = fh.read()
 
-exec(user_code)
+def _split_cells(source: str, statements: list) -> list[list]:
+    """Group top-level statements by the notebook cell they came from
+
+    Cells are delimited by the "# In[...]:" comments which the converter
+    writes before each code cell.
+
+    :param source: the converted notebook code
+    :param statements: top-level statements parsed from the source
+    :return: a list of the (non-empty) statement lists of the cells
+    """
+    markers = [
+        number
+        for number, line in enumerate(source.splitlines(), start=1)
+        if _CELL_MARKER.match(line)
+    ]
+    cells: dict[int, list] = {}
+    for statement in statements:
+        cell = bisect.bisect_left(markers, statement.lineno)
+        cells.setdefault(cell, []).append(statement)
+    return list(cells.values())
+
+
+def _cell_dependencies(cells: list[list]) -> list[set[int]]:
+    """Determine which earlier cells each cell must run after
+
+    A cell depends on an earlier cell if it uses a name the earlier cell
+    may define, may define a name the earlier cell uses or may define, or
+    either cell has effects which can't be analysed. A name used by a cell
+    includes the global names used by any functions or classes it uses,
+    since these are looked up when the function is called.
+
+    :param cells: the top-level statements of each cell
+    :return: for each cell, the indices of the cells it depends on
+    """
+    # Global names used by the bodies of functions and classes
+    function_uses: dict[str, set[str]] = {}
+    summaries = []
+    for statements in cells:
+        used, defined = set(), set()
+        for statement in statements:
+            s_used, s_defined, s_may_define = _analyse_statement(statement)
+            used |= s_used
+            defined |= s_defined | s_may_define
+            match statement:
+                case (
+                    ast.FunctionDef(name=name)
+                    | ast.AsyncFunctionDef(name=name)
+                    | ast.ClassDef(name=name)
+                ):
+                    function_uses[name] = s_used
+                case ast.Expr(value=ast.Call(func=ast.Name())):
+                    # A bare call of a function (rather than a method) is
+                    # made for its side effects, which can't be analysed.
+                    defined.add(_ALL_NAMES)
+        summaries.append((used, defined))
+    summaries = [
+        (_expand_uses(used, function_uses), defined)
+        for used, defined in summaries
+    ]
+    dependencies = []
+    for j, (used_j, defined_j) in enumerate(summaries):
+        dependencies.append(
+            {
+                i
+                for i, (used_i, defined_i) in enumerate(summaries[:j])
+                if _ALL_NAMES in defined_i
+                or _ALL_NAMES in defined_j
+                or used_j & defined_i
+                or defined_j & used_i
+                or defined_j & defined_i
+            }
+        )
+    return dependencies
+
+
+def _expand_uses(
+    used: set[str], function_uses: dict[str, set[str]]
+) -> set[str]:
+    expanded = set(used)
+    work = list(used)
+    while work:
+        for name in function_uses.get(work.pop(), ()):
+            if name not in expanded:
+                expanded.add(name)
+                work.append(name)
+    return expanded
+
+
+def run_cells_parallel(
+    cells: list[list],
+    filename: str,
+    max_workers: int | None = None,
+    namespace: dict | None = None,
+) -> None:
+    """Execute notebook cells concurrently where their dependencies allow
+
+    Each cell starts as soon as all the cells it depends on (as
+    determined by _cell_dependencies) have finished. If a cell raises an
+    exception, no further cells are started, and the exception is
+    re-raised once the running cells have finished.
+
+    :param cells: the top-level statements of each cell, in notebook order
+    :param filename: the filename to use when compiling the statements
+    :param max_workers: maximum number of threads to use
+    :param namespace: the global namespace to execute the cells in; by
+        default, this module's globals, as for the sequential user code
+    """
+    if namespace is None:
+        namespace = globals()
+    dependencies = _cell_dependencies(cells)
+    codes = [
+        compile(ast.Module(body=body, type_ignores=[]), filename, "exec")
+        for body in cells
+    ]
+    dependents: dict[int, list[int]] = {i: [] for i in range(len(cells))}
+    for j, predecessors in enumerate(dependencies):
+        for i in predecessors:
+            dependents[i].append(j)
+    waiting_for = [len(d) for d in dependencies]
+    LOGGER.info(
+        f"Executing {len(cells)} cells in parallel where possible "
+        f"({sum(1 for n in waiting_for if n == 0)} initially runnable)"
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        running = {
+            executor.submit(exec, codes[i], namespace): i
+            for i, n in enumerate(waiting_for)
+            if n == 0
+        }
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                i = running.pop(future)
+                if (error := future.exception()) is not None:
+                    concurrent.futures.wait(running)
+                    raise error
+                LOGGER.debug(f"Finished cell {i}")
+                for j in dependents[i]:
+                    waiting_for[j] -= 1
+                    if waiting_for[j] == 0:
+                        running[executor.submit(exec, codes[j], namespace)] = j
+
+
+def run_user_code(
+    targets: set[str] | None = None,
+    parallel: bool = False,
+    max_workers: int | None = None,
+) -> None:
+    """Execute the converted notebook code in this module's namespace
+
+    :param targets: if given, execute only the statements required to
+        compute these variables
+    :param parallel: if True, execute independent cells concurrently
+    :param max_workers: maximum number of threads for parallel execution
+    """
+    user_code_path = pathlib.Path(__file__).with_name("user_code.py").resolve()
+    if not (targets or parallel):
+        exec(load_code(user_code_path), globals())
+        return
+    user_code = user_code_path.read_text()
+    module = ast.parse(user_code, filename=str(user_code_path))
+    statements = module.body
+    if targets:
+        statements = _slice_statements(statements, targets)
+        LOGGER.info(
+            f"Executing {len(statements)} of {len(module.body)} statements "
+            f"needed for {', '.join(sorted(targets))}"
+        )
+    if parallel:
+        run_cells_parallel(
+            _split_cells(user_code, statements),
+            str(user_code_path),
+            max_workers,
+        )
+    else:
+        code = compile(
+            ast.Module(body=statements, type_ignores=[]),
+            str(user_code_path),
+            "exec",
+        )
+        exec(code, globals())
+
+
+def load_code(source_path: pathlib.Path) -> types.CodeType:
+    """Load a code object for a source file, precompiled if possible
+
+    If a .pyc file next to the source file was compiled by this Python
+    version from the current source, its code object is unmarshalled;
+    otherwise the source is compiled.
+
+    :param source_path: path to a Python source file
+    :return: the code object for the file
+    """
+    source = source_path.read_bytes()
+    try:
+        data = source_path.with_suffix(".pyc").read_bytes()
+    except OSError:
+        data = b""
+    flags = int.from_bytes(data[4:8], "little")
+    if (
+        data[:4] == importlib.util.MAGIC_NUMBER
+        and flags & 0b01  # hash-based pyc
+        and data[8:16] == importlib.util.source_hash(source)
+    ):
+        LOGGER.debug(f"Using precompiled code for {source_path.name}")
+        return marshal.loads(data[16:])
+    LOGGER.debug(f"Compiling {source_path.name}")
+    return compile(source, str(source_path), "exec")
+
+
+def precompile(*source_paths: pathlib.Path) -> None:
+    """Write precompiled .pyc files for source files
+
+    The .pyc files are written next to the source files, not in
+    __pycache__, and are tied to the content of the source rather than
+    its timestamp. The code objects refer to the source files by bare
+    filename, which Python resolves via sys.path (containing the
+    directory of execute.py) when it needs to show source lines in a
+    traceback.
+    """
+    for path in source_paths:
+        py_compile.compile(
+            str(path),
+            cfile=str(path.with_suffix(".pyc")),
+            dfile=path.name,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        )
+
 
 import sys
 import argparse
 import pathlib
 
-import xarray as xr
-from xcube.server.server import Server
-from xcube.server.framework import get_framework_class
-import xcube.util.plugin
-import xcube.core.new
 
+class _GraphCollector:
+    """A Dask scheduler which records task graphs instead of running them
 
-def main():
+    Dask arrays are written by computing a graph of store tasks. Passing
+    an instance of this class as the scheduler records the graph without
+    executing it, so that the graphs of several writes can be merged and
+    executed together. The graphs are recorded unoptimized, since
+    optimization renames tasks and would hide the ones they share.
+    """
+
+    def __init__(self):
+        self.graph = {}
+        self.keys = []
+
+    def __call__(self, graph, keys, **kwargs):
+        if hasattr(graph, "__dask_graph__"):
+            graph = graph.__dask_graph__()
+        self.graph.update(graph)
+        self.keys.append(keys)
+        return self._placeholders(keys)
+
+    def _placeholders(self, keys):
+        # The results of store tasks are discarded, so any will do.
+        if isinstance(keys, list):
+            return [self._placeholders(k) for k in keys]
+        return None
+
+
+# Settings which may be given for a dataset or variable in an output
+# encoding file
+_ENCODING_SETTINGS = {
+    "add_offset",
+    "chunks",
+    "compressor",
+    "dtype",
+    "fill_value",
+    "filters",
+    "scale_factor",
+}
+
+# Blosc shuffle modes by their numcodecs numbers
+_BLOSC_SHUFFLE = {-1: "shuffle", 0: "noshuffle", 1: "shuffle", 2: "bitshuffle"}
+
+
+def load_output_encoding(path: pathlib.Path) -> dict:
+    """Read and validate an output encoding file
+
+    The file maps dataset names (or "*", for all datasets) to encoding
+    settings, which apply to all the dataset's data variables. Settings
+    for individual variables (including coordinates) can be given under
+    "variables". For example::
+
+        "*":
+          compressor: {id: blosc, cname: zstd, clevel: 5, shuffle: 2}
+        cube1:
+          chunks: {time: 1, y: 512, x: 512}
+          variables:
+            ndvi:
+              fill_value: -9999
+              compressor: {id: zstd, level: 9}
+              filters: [{id: bitround, keepbits: 10}]
+
+    Codecs are given as numcodecs configurations. Chunks may be given as
+    a mapping from dimension name to chunk size (with -1 meaning the whole
+    dimension), or as a list of chunk sizes in the variable's dimension
+    order. Other settings are passed to xarray as encoding.
+
+    :param path: path of a YAML output encoding file
+    :return: the encoding specification, with codecs instantiated
+    :raises ValueError: if the file is not a valid specification
+    """
+    import yaml
+
+    with open(path) as fh:
+        spec = yaml.safe_load(fh) or {}
+    if not isinstance(spec, dict):
+        raise ValueError("expected a mapping of dataset names to settings")
+    for dataset_name, settings in spec.items():
+        settings = dict(settings or {})
+        variables = settings.pop("variables", None) or {}
+        spec[dataset_name] = {
+            "settings": _parse_encoding_settings(settings, dataset_name),
+            "variables": {
+                name: _parse_encoding_settings(
+                    var_settings or {}, f"{dataset_name}.{name}"
+                )
+                for name, var_settings in variables.items()
+            },
+        }
+    return spec
+
+
+def _parse_encoding_settings(settings: dict, context: str) -> dict:
+    if unknown := settings.keys() - _ENCODING_SETTINGS:
+        raise ValueError(
+            f"unknown encoding setting(s) for {context}: "
+            f"{', '.join(sorted(unknown))}"
+        )
+    settings = dict(settings)
+    try:
+        if settings.get("compressor") is not None:
+            settings["compressor"] = _make_codec(settings["compressor"])
+        if "filters" in settings:
+            settings["filters"] = [
+                _make_codec(f) for f in settings["filters"] or []
+            ]
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"invalid codec for {context}: {error}")
+    return settings
+
+
+def _zarr_major_version() -> int:
+    import zarr
+
+    return int(zarr.__version__.split(".")[0])
+
+
+def _make_codec(config: dict):
+    """Create a codec for the installed version of Zarr
+
+    :param config: a numcodecs configuration, e.g. {"id": "zstd", "level": 3}
+    :return: a numcodecs codec for Zarr 2, or a Zarr 3 codec
+    """
+    import numcodecs
+
+    codec = numcodecs.get_codec(dict(config))
+    if _zarr_major_version() < 3:
+        return codec
+    import zarr.codecs
+
+    config = {k: v for k, v in config.items() if k != "id"}
+    match config_id := codec.codec_id:
+        case "blosc":
+            shuffle = config.get("shuffle", 1)
+            return zarr.codecs.BloscCodec(
+                cname=config.get("cname", "lz4"),
+                clevel=config.get("clevel", 5),
+                shuffle=_BLOSC_SHUFFLE.get(shuffle, shuffle),
+            )
+        case "zstd":
+            return zarr.codecs.ZstdCodec(level=config.get("level", 0))
+        case "gzip":
+            return zarr.codecs.GzipCodec(level=config.get("level", 5))
+    import numcodecs.zarr3
+
+    codec_class = getattr(numcodecs.zarr3, type(codec).__name__, None)
+    if codec_class is None:
+        raise ValueError(f"codec {config_id} is not supported by Zarr 3")
+    return codec_class(**config)
+
+
+def encode_dataset(name: str, dataset, spec: dict) -> tuple:
+    """Apply an output encoding specification to a dataset
+
+    :param name: the name of the dataset
+    :param dataset: the dataset to encode
+    :param spec: an output encoding specification, as returned by
+        load_output_encoding
+    :return: a tuple of the dataset, rechunked where the specification
+        requires, and the encoding to pass to to_zarr
+    """
+    general, specific = spec.get("*", {}), spec.get(name, {})
+    encoding = {}
+    for var_name, variable in dataset.variables.items():
+        settings = {}
+        if var_name in dataset.data_vars:
+            settings |= general.get("settings", {})
+            settings |= specific.get("settings", {})
+        settings |= general.get("variables", {}).get(var_name, {})
+        settings |= specific.get("variables", {}).get(var_name, {})
+        if not settings:
+            continue
+        var_encoding = {}
+        for key, value in settings.items():
+            match key:
+                case "chunks":
+                    chunks = _chunk_sizes(variable, value)
+                    var_encoding["chunks"] = chunks
+                    if variable.chunks is not None:
+                        dataset[var_name] = dataset[var_name].chunk(
+                            dict(zip(variable.dims, chunks))
+                        )
+                case "compressor" if _zarr_major_version() >= 3:
+                    var_encoding["compressors"] = (
+                        () if value is None else (value,)
+                    )
+                case "fill_value":
+                    var_encoding["_FillValue"] = value
+                case _:
+                    var_encoding[key] = value
+        encoding[var_name] = var_encoding
+    return dataset, encoding
+
+
+def _chunk_sizes(variable, chunks: dict | list) -> tuple[int, ...]:
+    if isinstance(chunks, list):
+        sizes = dict(zip(variable.dims, chunks))
+    else:
+        sizes = {dim: chunks[dim] for dim in variable.dims if dim in chunks}
+    return tuple(
+        (
+            size
+            if (size := sizes.get(dim)) not in (None, -1)
+            else (
+                variable.chunks[i][0]
+                if variable.chunks is not None and dim not in sizes
+                else variable.shape[i]
+            )
+        )
+        for i, dim in enumerate(variable.dims)
+    )
+
+
+# Default size of the chunks of output variables; see advise_chunks
+DEFAULT_CHUNK_BYTES = 64 * 2**20
+
+# Output chunks whose size is within these factors of the target size are
+# left as they are.
+_CHUNK_TOLERANCE = (1 / 8, 2)
+
+ACCESS_PATTERNS = ("map", "timeseries")
+
+_TIME_DIMENSIONS = {"time", "t", "date", "datetime"}
+
+_SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    "kb": 10**3,
+    "mb": 10**6,
+    "gb": 10**9,
+    "kib": 2**10,
+    "mib": 2**20,
+    "gib": 2**30,
+}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes, such as 64MiB or 100MB"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([a-zA-Z]*)\s*", value)
+    if not match or match.group(2).lower() not in _SIZE_UNITS:
+        raise ValueError(f"invalid size {value!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def _format_size(size: float) -> str:
+    for unit in "B", "KiB", "MiB":
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def advise_chunks(
+    sizes: dict[str, int],
+    itemsize: int,
+    target_bytes: int,
+    access: str = "map",
+    time_dims: set[str] = frozenset(),
+) -> dict[str, int]:
+    """Choose chunk sizes for an array from a byte budget
+
+    For map access, time dimensions get a chunk size of 1, so that a
+    map for one time step can be read without reading any others. For
+    time series access, time dimensions are chunked as long as the budget
+    allows, so that a time series can be read from as few chunks as
+    possible. The rest of the budget is shared among the other dimensions,
+    giving chunks that are as close to square as their sizes allow.
+
+    :param sizes: the size of each dimension of the array
+    :param itemsize: the number of bytes per array element
+    :param target_bytes: the maximum number of bytes per chunk
+    :param access: the expected access pattern, "map" or "timeseries"
+    :param time_dims: names of the array's time dimensions, in addition to
+        those with common time dimension names
+    :return: the chunk size for each dimension
+    """
+    budget = max(1, target_bytes // itemsize)
+    time_dims = {
+        d for d in sizes if d in time_dims or d.lower() in _TIME_DIMENSIONS
+    }
+    chunks = {}
+    for dim in time_dims:
+        chunks[dim] = 1 if access == "map" else min(sizes[dim], budget)
+        budget //= chunks[dim]
+    # Dividing the budget among the smallest dimensions first lets any
+    # budget they don't use go to the larger ones.
+    remaining = sorted((d for d in sizes if d not in time_dims), key=sizes.get)
+    for i, dim in enumerate(remaining):
+        side = int(round(budget ** (1 / (len(remaining) - i)), 6))
+        chunks[dim] = max(1, min(sizes[dim], side))
+        budget = max(1, budget // chunks[dim])
+    return {dim: chunks[dim] for dim in sizes}
+
+
+def _time_dimensions(dataset) -> set[str]:
+    import numpy as np
+
+    return {
+        dim
+        for dim in dataset.dims
+        if dim in dataset.coords
+        and np.issubdtype(dataset[dim].dtype, np.datetime64)
+    }
+
+
+def rechunk_dataset(
+    name: str,
+    dataset,
+    encoding: dict,
+    target_bytes: int = DEFAULT_CHUNK_BYTES,
+    access: str = "map",
+):
+    """Rechunk data variables whose chunks are much too small or large
+
+    Variables with explicitly encoded chunk sizes are left unchanged. The
+    encoding of rechunked variables is updated with their new chunks.
+
+    :param name: the name of the dataset, for logging
+    :param dataset: the dataset to rechunk
+    :param encoding: the dataset's output encoding, as returned by
+        encode_dataset; updated in place
+    :param target_bytes: the target number of bytes per chunk
+    :param access: the expected access pattern, "map" or "timeseries"
+    :return: the rechunked dataset
+    """
+    time_dims = _time_dimensions(dataset)
+    low, high = (f * target_bytes for f in _CHUNK_TOLERANCE)
+    for var_name, variable in dataset.data_vars.items():
+        if not variable.dims or "chunks" in encoding.get(var_name, {}):
+            continue
+        itemsize = variable.dtype.itemsize
+        if variable.chunks is None:
+            current = dict(variable.sizes)
+        else:
+            current = {
+                dim: max(sizes)
+                for dim, sizes in zip(variable.dims, variable.chunks)
+            }
+        chunk_bytes = itemsize * math.prod(current.values())
+        if chunk_bytes > high:
+            reason = "too large"
+        elif chunk_bytes < low and chunk_bytes < variable.nbytes:
+            reason = "too small"
+        else:
+            continue
+        chunks = advise_chunks(
+            dict(variable.sizes), itemsize, target_bytes, access, time_dims
+        )
+        if chunks == current:
+            continue
+        LOGGER.info(
+            f"Rechunking {name}.{var_name} from {current} to {chunks} "
+            f"for {access} access: chunks of "
+            f"{_format_size(chunk_bytes)} are {reason}; new chunks are "
+            f"{_format_size(itemsize * math.prod(chunks.values()))}"
+        )
+        if variable.chunks is None:
+            variable = variable.chunk(chunks)
+        else:
+            # Limiting the size of intermediate blocks bounds the memory
+            # used by the rechunking.
+            variable = variable.copy(
+                data=variable.data.rechunk(
+                    tuple(chunks.values()), block_size_limit=high
+                )
+            )
+        dataset[var_name] = variable
+        encoding.setdefault(var_name, {})["chunks"] = tuple(chunks.values())
+    return dataset
+
+
+def shard_dataset(
+    name: str,
+    dataset,
+    encoding: dict,
+    shard_bytes: int,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    access: str = "map",
+):
+    """Set up the data variables of a dataset for sharded Zarr 3 output
+
+    Each variable is stored in shards of about shard_bytes, each holding
+    chunks of about chunk_bytes, or of the chunk sizes in its encoding.
+    Shards must be written whole, so Dask-backed variables are rechunked
+    to match the shards.
+
+    :param name: the name of the dataset, for logging
+    :param dataset: the dataset to shard
+    :param encoding: the dataset's output encoding, as returned by
+        encode_dataset; updated in place
+    :param shard_bytes: the target number of bytes per shard
+    :param chunk_bytes: the target number of bytes per chunk
+    :param access: the expected access pattern, "map" or "timeseries"
+    :return: the rechunked dataset
+    """
+    time_dims = _time_dimensions(dataset)
+    for var_name, variable in dataset.data_vars.items():
+        if not variable.dims:
+            continue
+        itemsize = variable.dtype.itemsize
+        sizes = dict(variable.sizes)
+        var_encoding = encoding.setdefault(var_name, {})
+        chunks = var_encoding.get("chunks") or tuple(
+            advise_chunks(
+                sizes, itemsize, chunk_bytes, access, time_dims
+            ).values()
+        )
+        shard_advice = advise_chunks(
+            sizes, itemsize, shard_bytes, access, time_dims
+        )
+        # Shards must consist of whole chunks.
+        shards = tuple(
+            chunk * max(1, min(-(-size // chunk), shard_advice[dim] // chunk))
+            for (dim, size), chunk in zip(sizes.items(), chunks)
+        )
+        var_encoding.update(chunks=tuple(chunks), shards=shards)
+        if variable.chunks is not None:
+            data = variable.data.rechunk(
+                shards, block_size_limit=_CHUNK_TOLERANCE[1] * shard_bytes
+            )
+            if data.chunks != variable.chunks:
+                LOGGER.info(
+                    f"Rechunking {name}.{var_name} to its shards "
+                    f"{dict(zip(variable.dims, shards))}"
+                )
+                dataset[var_name] = variable.copy(data=data)
+    return dataset
+
+
+# Default memory limit for streaming writes; see write_streaming
+DEFAULT_STREAM_MEMORY = 2 * 2**30
+
+# Ratio of the memory used to write a slab of a dataset to the size of its
+# data, allowing for intermediate results and encoded chunks
+_STREAM_OVERHEAD = 4
+
+
+def _to_zarr(dataset, path: pathlib.Path, **kwargs):
+    with warnings.catch_warnings():
+        # Zarr warns that consolidated metadata is not yet part of the
+        # version 3 specification, but xarray and xcube support it.
+        warnings.filterwarnings(
+            "ignore", message="Consolidated metadata is currently not"
+        )
+        return dataset.to_zarr(path, consolidated=True, **kwargs)
+
+
+class WriteJournal:
+    """A record of the completed parts of the batch outputs
+
+    The journal is a file of JSON lines in the output directory, each
+    recording that a dataset, or a slab of a streamed dataset, has been
+    completely written. Entries are tied to a fingerprint of the dataset,
+    so that outputs are only resumed if they would be written in the same
+    way. Each entry is flushed to disk as soon as it is recorded, so the
+    journal survives the process being killed.
+    """
+
+    FILENAME = "xcengine-journal.jsonl"
+
+    def __init__(self, output_path: pathlib.Path, resume: bool = False):
+        """Open the journal in an output directory
+
+        :param output_path: the output directory
+        :param resume: whether to keep the entries of an existing
+            journal; otherwise, any existing journal is replaced when the
+            first entry is recorded
+        """
+        self.path = output_path / self.FILENAME
+        self.resume = resume
+        self.entries: list[dict] = []
+        self._replace = not resume
+        if resume and self.path.exists():
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The last line may have been cut off by a crash.
+                        LOGGER.warning(f"Ignoring bad journal entry {line}")
+
+    def record(
+        self,
+        dataset: str,
+        fingerprint: str,
+        state: str,
+        region: tuple[int, int] | None = None,
+    ) -> None:
+        entry = dict(dataset=dataset, fingerprint=fingerprint, state=state)
+        if region is not None:
+            entry["region"] = list(region)
+        self.entries.append(entry)
+        with open(self.path, "w" if self._replace else "a") as fh:
+            self._replace = False
+            fh.write(json.dumps(entry) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def has(self, dataset: str, fingerprint: str, state: str) -> bool:
+        return any(
+            e["dataset"] == dataset
+            and e["fingerprint"] == fingerprint
+            and e["state"] == state
+            for e in self.entries
+        )
+
+    def written_steps(self, dataset: str, fingerprint: str) -> set[int]:
+        """Return the indices written by the recorded slabs of a dataset"""
+        return {
+            i
+            for e in self.entries
+            if e["dataset"] == dataset
+            and e["fingerprint"] == fingerprint
+            and e["state"] == "slab"
+            for i in range(*e["region"])
+        }
+
+    def interrupted_appends(self) -> dict[str, int]:
+        """Find appends which were started but not completed
+
+        :return: the original size of the append dimension of each
+            dataset whose append was interrupted, keyed by dataset name
+        """
+        started = {}
+        for entry in self.entries:
+            if entry["state"] == "appending":
+                started[entry["dataset"]] = entry["region"][0]
+            elif entry["state"] == "complete":
+                started.pop(entry["dataset"], None)
+        return started
+
+
+def fingerprint(dataset, encoding: dict, *extra) -> str:
+    """Compute a fingerprint of how a dataset will be written
+
+    The fingerprint covers the dataset's structure (variables, dimensions,
+    data types, and chunks), its output encoding, and the notebook
+    parameters, but not the data itself.
+
+    :param dataset: the dataset to write
+    :param encoding: the dataset's output encoding
+    :param extra: any other values which affect the output
+    :return: a hexadecimal hash
+    """
+    structure = (
+        sorted(dataset.sizes.items()),
+        sorted(
+            (name, var.dims, str(var.dtype), var.chunks)
+            for name, var in dataset.variables.items()
+        ),
+        sorted((name, repr(e)) for name, e in encoding.items()),
+        sorted((k, repr(v)) for k, v in _applied_parameters.items()),
+        extra,
+    )
+    return hashlib.sha256(repr(structure).encode()).hexdigest()
+
+
+def write_streaming(
+    name: str,
+    dataset,
+    path: pathlib.Path,
+    encoding: dict,
+    dim: str,
+    memory_bytes: int = DEFAULT_STREAM_MEMORY,
+    zarr_format: int | None = None,
+    journal: WriteJournal | None = None,
+    overwrite: bool = False,
+) -> None:
+    """Write a dataset to Zarr in slabs along a dimension
+
+    The variables without the dimension, and any variables not backed by
+    Dask, are written first, together with the metadata of the others.
+    The Dask-backed variables with the dimension are then computed and
+    written one slab at a time, so that only one slab needs to be in
+    memory. Slabs are aligned with the Zarr chunks (or shards) and are
+    as large as the memory limit allows.
+
+    If a journal is given, each slab is recorded in it once written. If
+    the journal shows that the store was already set up and some slabs
+    written, with the same fingerprint, only the other slabs are written.
+
+    :param name: the name of the dataset, for logging
+    :param dataset: the dataset to write
+    :param path: the path of the Zarr store to write
+    :param encoding: the dataset's output encoding
+    :param dim: the dimension to slice the dataset along
+    :param memory_bytes: the approximate maximum memory to use for
+        computing and writing a slab
+    :param zarr_format: the Zarr format version to write
+    :param journal: a journal to record and resume progress in
+    :param overwrite: whether to replace an existing store at the path
+    """
+    streamed = [
+        var_name
+        for var_name, variable in dataset.data_vars.items()
+        if dim in variable.dims and variable.chunks is not None
+    ]
+    slabbed = dataset[streamed]
+    key = fingerprint(dataset, encoding, dim)
+    if journal and journal.has(name, key, "initialised"):
+        written = journal.written_steps(name, key)
+        LOGGER.info(f"Resuming {name}: {len(written)} {dim} step(s) written")
+    else:
+        written = set()
+        _to_zarr(
+            dataset.drop_vars(streamed),
+            path,
+            mode="w" if overwrite or (journal and journal.resume) else None,
+            encoding={k: v for k, v in encoding.items() if k not in streamed},
+            zarr_format=zarr_format,
+        )
+        if not streamed:
+            return
+        _to_zarr(
+            slabbed,
+            path,
+            mode="a",
+            compute=False,
+            encoding={k: v for k, v in encoding.items() if k in streamed},
+        )
+        if journal:
+            journal.record(name, key, "initialised")
+    step_bytes = sum(slabbed[v].nbytes // slabbed.sizes[dim] for v in streamed)
+    alignment = 1
+    for var_name in streamed:
+        axis = dataset[var_name].dims.index(dim)
+        var_encoding = encoding.get(var_name, {})
+        zarr_chunks = var_encoding.get("shards") or var_encoding.get("chunks")
+        alignment = math.lcm(
+            alignment,
+            (
+                zarr_chunks[axis]
+                if zarr_chunks
+                else dataset[var_name].chunks[axis][0]
+            ),
+        )
+    steps = memory_bytes // (_STREAM_OVERHEAD * max(1, step_bytes))
+    slab_size = max(alignment, steps // alignment * alignment)
+    size = slabbed.sizes[dim]
+    LOGGER.info(
+        f"Writing {name} in {-(-size // slab_size)} slab(s) of "
+        f"{slab_size} step(s) along {dim}"
+    )
+    slabbed = slabbed.drop_vars(
+        [c for c in slabbed.coords if dim not in slabbed[c].dims]
+    )
+    for start in range(0, size, slab_size):
+        stop = min(start + slab_size, size)
+        if written.issuperset(range(start, stop)):
+            continue
+        region = {dim: slice(start, stop)}
+        LOGGER.debug(f"Writing {name} {dim} {start}-{stop}")
+        _to_zarr(slabbed.isel(region), path, region=region)
+        if journal:
+            journal.record(name, key, "slab", (start, stop))
+
+
+def new_steps(dataset, path: pathlib.Path, dim: str) -> tuple:
+    """Select the part of a dataset which is newer than an existing store
+
+    :param dataset: the dataset to append
+    :param path: the path of an existing Zarr store
+    :param dim: the dimension to append along
+    :return: a tuple of the number of steps in the store, and the steps
+        of the dataset's data variables and coordinates with the
+        dimension which come after the last one in the store. Data
+        variables without the dimension are omitted; they are kept as
+        they are in the store.
+    """
+    import xarray as xr
+
+    existing = xr.open_zarr(path)
+    if dim not in existing.dims or existing.sizes[dim] == 0:
+        raise ValueError(f"{path} has no dimension {dim} to append to")
+    last = existing[dim].values[-1]
+    dataset = dataset.drop_vars(
+        [
+            name
+            for name, var in dataset.data_vars.items()
+            if dim not in var.dims
+        ]
+    )
+    new = dataset.isel({dim: (dataset[dim] > last).values})
+    return existing.sizes[dim], new
+
+
+def _can_align_chunks() -> bool:
+    import inspect
+
+    import xarray as xr
+
+    return "align_chunks" in inspect.signature(xr.Dataset.to_zarr).parameters
+
+
+def align_to_store(dataset, path: pathlib.Path, dim: str, offset: int):
+    """Rechunk new steps to fit the chunks of the store they are appended to
+
+    Dask chunks which only partly cover a Zarr chunk (or shard) can't be
+    written safely in parallel. Recent versions of xarray rechunk them
+    with to_zarr(align_chunks=True); this does the same for earlier ones.
+
+    :param dataset: the steps to append
+    :param path: the path of the existing Zarr store
+    :param dim: the dimension to append along
+    :param offset: the existing size of the dimension in the store
+    :return: the dataset, with its Dask-backed variables rechunked
+    """
+    import xarray as xr
+
+    existing = xr.open_zarr(path)
+    for name, variable in dataset.variables.items():
+        if variable.chunks is None or name not in existing.variables:
+            continue
+        encoding = existing[name].encoding
+        zarr_chunks = encoding.get("shards") or encoding.get("chunks")
+        if not zarr_chunks:
+            continue
+        chunks = {}
+        for var_dim, size, chunk in zip(
+            variable.dims, variable.shape, zarr_chunks
+        ):
+            first = chunk - offset % chunk if var_dim == dim else chunk
+            first = min(first, size)
+            rest = size - first
+            chunks[var_dim] = (
+                (first,)
+                + (chunk,) * (rest // chunk)
+                + ((rest % chunk,) if rest % chunk else ())
+            )
+        dataset[name] = dataset[name].chunk(chunks)
+    return dataset
+
+
+def truncate_store(path: pathlib.Path, dim: str, size: int) -> None:
+    """Shrink the arrays of a Zarr store along a dimension
+
+    :param path: the path of the Zarr store
+    :param dim: the dimension to shrink along
+    :param size: the new size of the dimension
+    """
+    import zarr
+
+    group = zarr.open_group(path, mode="r+")
+    for _, array in group.arrays():
+        dims = getattr(array.metadata, "dimension_names", None)
+        dims = dims or array.attrs.get("_ARRAY_DIMENSIONS", ())
+        if dim in dims:
+            shape = list(array.shape)
+            shape[list(dims).index(dim)] = size
+            array.resize(tuple(shape))
+    zarr.consolidate_metadata(path)
+
+
+def write_datasets(
+    datasets: dict,
+    output_path: pathlib.Path,
+    encoding: dict | None = None,
+    chunk_bytes: int | None = DEFAULT_CHUNK_BYTES,
+    access: str = "map",
+    shard_bytes: int | None = None,
+    stream_dim: str | None = None,
+    stream_memory: int = DEFAULT_STREAM_MEMORY,
+    resume: bool = False,
+    append_dim: str | None = None,
+) -> dict:
+    """Write datasets to Zarr, computing them in a single Dask graph
+
+    Each dataset's metadata and non-Dask variables are written at once,
+    but its Dask store tasks are only collected. All the collected tasks
+    are then executed as one graph, so any computations which several
+    datasets share are only done once, and the datasets are written
+    concurrently. Datasets which are streamed (see stream_dim) are
+    written afterwards, one at a time.
+
+    Progress is recorded in a WriteJournal in the output directory. When
+    resuming, datasets which the journal shows to be complete are not
+    written again, and streamed datasets are resumed from the first
+    missing slab. Other incomplete datasets are written from scratch.
+
+    :param datasets: the datasets to write, keyed by name
+    :param output_path: the directory to write the Zarr stores to
+    :param encoding: an output encoding specification, as returned by
+        load_output_encoding
+    :param chunk_bytes: the target size of output chunks, or None to
+        keep the datasets' chunks; see rechunk_dataset
+    :param access: the expected access pattern of the outputs
+    :param shard_bytes: if given, the datasets are written in Zarr format
+        3, sharded with about this many bytes per shard; see shard_dataset
+    :param stream_dim: if given, datasets with this dimension are written
+        separately, one slab at a time; see write_streaming
+    :param stream_memory: the memory limit for streaming writes
+    :param resume: whether to resume from the journal of a previous,
+        interrupted write
+    :param append_dim: if given, datasets with this dimension whose
+        stores already exist are not rewritten; instead, the steps after
+        the last one in the store are appended to it; existing stores of
+        datasets without this dimension are rewritten
+    :return: the path of each dataset's Zarr store, keyed by name
+    """
+    import dask.base
+    import dask.threaded
+
+    paths = {name: output_path / (name + ".zarr") for name in datasets}
+    collector = _GraphCollector()
+    zarr_format = 3 if shard_bytes else None
+    # Read before the journal is replaced by a new one
+    interrupted = (
+        WriteJournal(output_path, True).interrupted_appends()
+        if append_dim
+        else {}
+    )
+    journal = WriteJournal(output_path, resume)
+    streamed = {}
+    collected = {}
+    for name, dataset in datasets.items():
+        if append_dim in dataset.dims and paths[name].exists():
+            if name in interrupted:
+                LOGGER.warning(
+                    f"Removing the steps of an interrupted append "
+                    f"from {name}"
+                )
+                truncate_store(paths[name], append_dim, interrupted[name])
+            size, dataset = new_steps(dataset, paths[name], append_dim)
+            if dataset.sizes[append_dim] == 0:
+                LOGGER.info(f"Skipping {name}: no new {append_dim} steps")
+                continue
+            LOGGER.info(
+                f"Appending {dataset.sizes[append_dim]} {append_dim} "
+                f"step(s) to {name}"
+            )
+            if _can_align_chunks():
+                options = dict(align_chunks=True)
+            else:
+                dataset = align_to_store(
+                    dataset, paths[name], append_dim, size
+                )
+                options = {}
+            key = fingerprint(dataset, {}, append_dim)
+            journal.record(
+                name,
+                key,
+                "appending",
+                (size, size + dataset.sizes[append_dim]),
+            )
+            # The existing store's encoding is used for the new steps.
+            _to_zarr(
+                dataset,
+                paths[name],
+                append_dim=append_dim,
+                **options,
+                chunkmanager_store_kwargs=dict(
+                    scheduler=collector, optimize_graph=False
+                ),
+            )
+            collected[name] = key
+            continue
+        overwrite = resume
+        if append_dim and paths[name].exists():
+            # Datasets without the dimension can't be appended to, so their
+            # stores are replaced on every run.
+            LOGGER.info(f"Rewriting {name}: it has no {append_dim} dimension")
+            overwrite = True
+        dataset, dataset_encoding = encode_dataset(
+            name, dataset.copy(), encoding or {}
+        )
+        if shard_bytes:
+            dataset = shard_dataset(
+                name,
+                dataset,
+                dataset_encoding,
+                shard_bytes,
+                chunk_bytes or DEFAULT_CHUNK_BYTES,
+                access,
+            )
+        elif chunk_bytes:
+            dataset = rechunk_dataset(
+                name, dataset, dataset_encoding, chunk_bytes, access
+            )
+        key = fingerprint(dataset, dataset_encoding, stream_dim)
+        if journal.has(name, key, "complete"):
+            LOGGER.info(f"Skipping {name}: already written")
+            continue
+        if stream_dim in dataset.dims:
+            streamed[name] = dataset, dataset_encoding, key, overwrite
+            continue
+        collected[name] = key
+        _to_zarr(
+            dataset,
+            paths[name],
+            mode="w" if overwrite else None,
+            encoding=dataset_encoding,
+            zarr_format=zarr_format,
+            chunkmanager_store_kwargs=dict(
+                scheduler=collector, optimize_graph=False
+            ),
+        )
+    if collector.keys:
+        LOGGER.info(
+            f"Computing {len(collected)} dataset(s) in a "
+            f"graph of {len(collector.graph)} tasks"
+        )
+        scheduler = dask.base.get_scheduler() or dask.threaded.get
+        scheduler(collector.graph, collector.keys)
+    for name, key in collected.items():
+        journal.record(name, key, "complete")
+    for name, (dataset, dataset_encoding, key, overwrite) in streamed.items():
+        write_streaming(
+            name,
+            dataset,
+            paths[name],
+            dataset_encoding,
+            stream_dim,
+            stream_memory,
+            zarr_format,
+            journal,
+            overwrite,
+        )
+        journal.record(name, key, "complete")
+    return paths
+
+
+CGROUP_ROOT = pathlib.Path("/sys/fs/cgroup")
+
+# Environment variables which size the thread pools of numerical libraries.
+# They are read when the libraries are loaded, so they must be set before
+# NumPy is imported.
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_MAX_THREADS",
+    "DASK_NUM_WORKERS",
+)
+
+# Memory limits at least this large mean "no limit" (cgroup v1 reports an
+# unlimited cgroup as a number just below 2**63).
+_UNLIMITED_MEMORY = 2**60
+
+# Number of chunks per thread which should fit into the memory limit,
+# allowing for input chunks and intermediate results
+_CHUNKS_PER_THREAD = 8
+
+
+def _read_cgroup_file(path: pathlib.Path) -> str | None:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def cgroup_limits(
+    root: pathlib.Path = CGROUP_ROOT,
+) -> tuple[float | None, int | None]:
+    """Read the CPU quota and memory limit of this process's cgroup
+
+    Both cgroup v2 (cpu.max and memory.max) and cgroup v1 (the CFS quota
+    of the cpu controller and the limit of the memory controller) are
+    supported. In a container, the container's own cgroup is mounted at
+    the root of the cgroup filesystem.
+
+    :param root: mount point of the cgroup filesystem
+    :return: the CPU quota as a number of CPUs and the memory limit in
+        bytes, each None if there is no limit or it can't be read
+    """
+    cpus = memory = None
+    try:
+        if (cpu_max := _read_cgroup_file(root / "cpu.max")) is not None:
+            quota, _, period = cpu_max.partition(" ")
+            if quota != "max":
+                cpus = int(quota) / int(period or 100000)
+        else:
+            for controller in "cpu", "cpu,cpuacct":
+                quota = _read_cgroup_file(
+                    root / controller / "cpu.cfs_quota_us"
+                )
+                period = _read_cgroup_file(
+                    root / controller / "cpu.cfs_period_us"
+                )
+                if quota is not None and period is not None:
+                    if int(quota) > 0:
+                        cpus = int(quota) / int(period)
+                    break
+    except ValueError:
+        LOGGER.warning(f"Ignoring unreadable CPU quota in {root}")
+    memory_max = _read_cgroup_file(root / "memory.max")
+    if memory_max is None:
+        memory_max = _read_cgroup_file(
+            root / "memory" / "memory.limit_in_bytes"
+        )
+    if memory_max not in (None, "max"):
+        try:
+            memory = int(memory_max)
+        except ValueError:
+            LOGGER.warning(f"Ignoring unreadable memory limit in {root}")
+        else:
+            if memory >= _UNLIMITED_MEMORY:
+                memory = None
+    return cpus, memory
+
+
+def _physical_memory() -> int | None:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def available_resources(
+    root: pathlib.Path = CGROUP_ROOT,
+) -> tuple[int, int | None]:
+    """Determine the CPUs and memory which this process can actually use
+
+    os.cpu_count() and the memory size reported by the system are those
+    of the host, even in a container whose cgroup limits it to a fraction
+    of them. This takes the cgroup limits and the process's CPU affinity
+    into account.
+
+    :param root: mount point of the cgroup filesystem
+    :return: the number of CPUs and the memory limit in bytes, or None
+        if memory is not limited below the physical memory
+    """
+    quota, memory = cgroup_limits(root)
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    if quota is not None:
+        cpus = max(1, min(cpus, math.ceil(quota)))
+    physical = _physical_memory()
+    if memory is not None and physical is not None and memory >= physical:
+        memory = None
+    return cpus, memory
+
+
+def configure_resources(
+    cpus: int,
+    memory: int | None,
+    environ: dict[str, str] = os.environ,
+) -> tuple[int, int]:
+    """Size thread pools and memory budgets to the available resources
+
+    The thread pools of Dask, BLAS and OpenMP are set to use the given
+    number of CPUs, unless their environment variables are already set.
+    If memory is limited, Dask's default array chunk size is reduced so
+    that each thread can hold several chunks within the limit.
+
+    :param cpus: the number of CPUs to use
+    :param memory: the memory limit in bytes, or None if there is none
+    :param environ: the environment to set the variables in
+    :return: the default target chunk size for batch outputs and the
+        default memory budget for streaming them, both in bytes
+    """
+    for variable in THREAD_VARIABLES:
+        environ.setdefault(variable, str(cpus))
+    chunk_bytes = DEFAULT_CHUNK_BYTES
+    stream_memory = DEFAULT_STREAM_MEMORY
+    if memory is not None:
+        chunk_bytes = max(
+            2**20, min(chunk_bytes, memory // (cpus * _CHUNKS_PER_THREAD))
+        )
+        stream_memory = min(stream_memory, memory // 2)
+        environ.setdefault("DASK_ARRAY__CHUNK_SIZE", str(chunk_bytes))
+    LOGGER.info(
+        f"Using {environ['DASK_NUM_WORKERS']} Dask thread(s) and "
+        f"{environ['OMP_NUM_THREADS']} BLAS/OpenMP thread(s) for "
+        f"{cpus} available CPU(s); "
+        + (
+            f"memory limit {_format_size(memory)}"
+            if memory is not None
+            else "no memory limit"
+        )
+        + f", output chunk size {_format_size(chunk_bytes)}, "
+        f"stream memory {_format_size(stream_memory)}"
+    )
+    return chunk_bytes, stream_memory
+
+
+def start_cluster(
+    workers: int | None = None,
+    threads_per_worker: int | None = None,
+    memory_limit: str = "auto",
+    spill_dir: pathlib.Path | None = None,
+    dashboard_port: int | None = None,
+):
+    """Start a local Dask cluster and make it the default scheduler
+
+    Each worker is a separate process with its own memory limit. Workers
+    spill data to disk as they approach the limit, pause as they get
+    closer, and are restarted if they exceed it, so running out of memory
+    slows a computation down rather than crashing the container.
+
+    :param workers: the number of worker processes; by default, Dask
+        chooses from the number of CPUs
+    :param threads_per_worker: the number of threads per worker
+    :param memory_limit: the memory limit per worker, e.g. "4GiB", or
+        "auto" to divide the system's memory between the workers
+    :param spill_dir: the directory to spill data to; by default, a
+        temporary directory
+    :param dashboard_port: the port to serve the Dask dashboard on; by
+        default, no dashboard is served
+    :return: the client connected to the cluster
+    """
+    from dask.distributed import Client, LocalCluster
+
+    cluster = LocalCluster(
+        n_workers=workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=memory_limit,
+        local_directory=spill_dir and str(spill_dir),
+        dashboard_address=(
+            None if dashboard_port is None else f":{dashboard_port}"
+        ),
+    )
+    client = Client(cluster)
+    LOGGER.info(
+        f"Started Dask cluster with {len(cluster.workers)} worker(s)"
+        + (
+            f"; dashboard at {client.dashboard_link}"
+            if dashboard_port is not None
+            else ""
+        )
+    )
+    return client
+
+
+def make_parser(parameters: dict[str, dict]) -> argparse.ArgumentParser:
+    """Create the command-line parser for this script
+
+    :param parameters: the parameter definitions, as returned by
+        load_parameters; each parameter gets an option --NAME
+    :return: the parser
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch", action="store_true")
     parser.add_argument("--server", action="store_true")
     parser.add_argument("--from-saved", action="store_true")
+    parser.add_argument(
+        "--only",
+        action="append",
+        metavar="DATASET",
+        help="Only compute and output this dataset (may be repeated)",
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Execute independent notebook cells concurrently",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        metavar="N",
+        help="Maximum number of threads to use with --parallel "
+        "(default: the number of available CPUs)",
+    )
+    parser.add_argument(
+        "--precompile",
+        action="store_true",
+        help="Precompile this script and the user code, then exit",
+    )
+    parser.add_argument(
+        "--list-params",
+        action="store_true",
+        help="List the notebook parameters and their defaults, then exit",
+    )
+    parser.add_argument(
+        "--output-encoding",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="YAML file specifying the Zarr encoding of batch outputs",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=parse_size,
+        metavar="SIZE",
+        help="Target size of the chunks of batch outputs, e.g. 64MiB "
+        "(default: 64MiB or less, to fit the memory limit); "
+        "0 keeps the chunks of the datasets",
+    )
+    parser.add_argument(
+        "--access-pattern",
+        choices=ACCESS_PATTERNS,
+        default="map",
+        help="Chunk batch outputs for reading maps or time series",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=parse_size,
+        metavar="SIZE",
+        help="Write batch outputs in Zarr format 3, in shards of about "
+        "SIZE (e.g. 1GiB), each holding chunks of about --chunk-size",
+    )
+    parser.add_argument(
+        "--stream-dim",
+        metavar="DIM",
+        help="Compute and write batch outputs with dimension DIM "
+        "(e.g. time) in slabs along it, to limit memory use",
+    )
+    parser.add_argument(
+        "--stream-memory",
+        type=parse_size,
+        metavar="SIZE",
+        help="Approximate memory limit for writing a slab with "
+        "--stream-dim (default: 2GiB or half the memory limit)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted batch run, writing only the outputs "
+        "(or, with --stream-dim, the slabs) not yet written",
+    )
+    parser.add_argument(
+        "--append-dim",
+        metavar="DIM",
+        help="Append the new steps along DIM (e.g. time) of batch outputs "
+        "to existing outputs, instead of rewriting them",
+    )
     parser.add_argument("-v", "--verbose", action="count", default=0)
+    cluster_group = parser.add_argument_group(
+        "Dask cluster",
+        "Run Dask computations on a local cluster of worker processes "
+        "with memory limits. Any of these options enables the cluster.",
+    )
+    cluster_group.add_argument(
+        "--dask-cluster", action="store_true", help="Use a local cluster"
+    )
+    cluster_group.add_argument(
+        "--dask-workers", type=int, metavar="N", help="Number of workers"
+    )
+    cluster_group.add_argument(
+        "--dask-threads-per-worker",
+        type=int,
+        metavar="N",
+        help="Number of threads per worker",
+    )
+    cluster_group.add_argument(
+        "--dask-memory-limit",
+        metavar="SIZE",
+        help="Memory limit per worker, e.g. 4GiB (default: share of the "
+        "system memory)",
+    )
+    cluster_group.add_argument(
+        "--dask-spill-dir",
+        type=pathlib.Path,
+        metavar="DIR",
+        help="Directory for data spilled from worker memory",
+    )
+    cluster_group.add_argument(
+        "--dask-dashboard-port",
+        type=int,
+        metavar="PORT",
+        help="Serve the Dask dashboard on this port",
+    )
+    parameter_group = parser.add_argument_group("notebook parameters")
+    for name, definition in parameters.items():
+        try:
+            parameter_group.add_argument(
+                "--" + name.replace("_", "-"),
+                dest="xce_param_" + name,
+                type=parameter_converter(definition["type"]),
+                metavar=definition["type"].upper(),
+                help=f"default: {definition['default']!r}",
+            )
+        except argparse.ArgumentError:
+            parser.error(
+                f"Notebook parameter {name} clashes with an option of "
+                f"this script; rename the parameter in the notebook"
+            )
+    return parser
+
+
+def main():
+    parameters = load_parameters()
+    parser = make_parser(parameters)
     args = parser.parse_args()
     if args.verbose > 0:
         LOGGER.setLevel(logging.DEBUG)
 
+    if args.list_params:
+        for name, definition in parameters.items():
+            print(f"{name} ({definition['type']}): {definition['default']!r}")
+        return
+
+    if args.precompile:
+        # If this script is itself running from a .pyc, precompile its source.
+        script_path = pathlib.Path(__file__).resolve().with_suffix(".py")
+        precompile(script_path, script_path.with_name("user_code.py"))
+        return
+
+    # Before NumPy and Dask are imported, since they size their thread
+    # pools when they are loaded
+    cpus, memory = available_resources()
+    chunk_bytes, stream_memory = configure_resources(cpus, memory)
+    if args.chunk_size is None:
+        args.chunk_size = chunk_bytes
+    if args.stream_memory is None:
+        args.stream_memory = stream_memory
+
+    output_encoding = None
+    if args.output_encoding:
+        try:
+            output_encoding = load_output_encoding(args.output_encoding)
+        except (OSError, ValueError) as error:
+            parser.error(f"Invalid output encoding file: {error}")
+
+    if args.shard_size:
+        if not 0 < args.chunk_size <= args.shard_size:
+            parser.error("--chunk-size must be between 1 and --shard-size")
+        if _zarr_major_version() < 3:
+            parser.error("--shard-size requires Zarr version 3")
+
+    use_cluster = args.dask_cluster or any(
+        getattr(args, option) is not None
+        for option in (
+            "dask_workers",
+            "dask_threads_per_worker",
+            "dask_memory_limit",
+            "dask_spill_dir",
+            "dask_dashboard_port",
+        )
+    )
+    if use_cluster and importlib.util.find_spec("distributed") is None:
+        parser.error("A Dask cluster requires the distributed package")
+
+    _parameter_values.update(
+        (name, value)
+        for name in parameters
+        if (value := getattr(args, "xce_param_" + name)) is not None
+    )
+
+    client = None
+    if use_cluster:
+        # Started before the user code, so that it uses the cluster too
+        client = start_cluster(
+            args.dask_workers,
+            args.dask_threads_per_worker,
+            args.dask_memory_limit or "auto",
+            args.dask_spill_dir,
+            args.dask_dashboard_port,
+        )
+
+    import xarray as xr
+    from xcube.server.server import Server
+    from xcube.server.framework import get_framework_class
+    import xcube.util.plugin
+
+    run_user_code(set(args.only or []), args.parallel, args.threads or cpus)
+
     xcube.util.plugin.init_plugins()
     datasets = {
         name: thing
         for name, thing in globals().copy().items()
-        if isinstance(thing, xr.Dataset) and not name.startswith("_")
+        if isinstance(thing, xr.Dataset)
+        and not name.startswith("_")
+        and (not args.only or name in args.only)
     }
+    if missing := set(args.only or []) - datasets.keys():
+        parser.error(f"No such dataset(s): {', '.join(sorted(missing))}")
 
     saved_datasets = {}
 
@@ -64,19 +1845,31 @@ def main():
         parent_path = pathlib.Path(sys.argv[0]).parent
         output_path = pathlib.Path.home() / "output"
         output_path.mkdir(parents=True, exist_ok=True)
-        for name, dataset in datasets.items():
-            dataset_path = output_path / (name + ".zarr")
-            saved_datasets[name] = dataset_path
-            dataset.to_zarr(dataset_path)
+        saved_datasets = write_datasets(
+            datasets,
+            output_path,
+            output_encoding,
+            args.chunk_size,
+            args.access_pattern,
+            args.shard_size,
+            args.stream_dim,
+            args.stream_memory,
+            args.resume,
+            args.append_dim,
+        )
         (parent_path / "finished").touch()
 
+    if client is not None and not args.server:
+        client.close()
+        client.cluster.close()
+
     if args.server:
         xcube.util.plugin.init_plugins()
         server = Server(framework=get_framework_class("tornado")(), config={})
         context = server.ctx.get_api_ctx("datasets")
         for name in datasets:
             dataset = (
-                xr.open_zarr(saved_datasets[name])
+                xr.open_zarr(saved_datasets[name], consolidated=True)
                 if args.batch and args.from_saved
                 else datasets[name]
             )